@@ -1,3 +1,6 @@
+import argparse
+import contextlib
+import json
 import os
 from downloader_core import *
 import sys
@@ -6,8 +9,25 @@ import sys
 Author(s): TOLoneWolf
 
 This contains the code used to make the command line interface.
+Without a command it shows the interactive menu, the commands run without any input for scripted use:
+
+    curseforgePackDownloadManagerCLI.py install project-ozone-2-reloaded --dest instances --type mmc
+    curseforgePackDownloadManagerCLI.py --json install --list packs.txt --dest instances
+    curseforgePackDownloadManagerCLI.py update --all
+    curseforgePackDownloadManagerCLI.py --json check
+    curseforgePackDownloadManagerCLI.py prefetch ftb-beyond@2547658
+    curseforgePackDownloadManagerCLI.py prefetch --list nightly_packs.txt instances/my-pack/manifest.json pack.zip
+    curseforgePackDownloadManagerCLI.py cache gc --max-size-mb 2048
 '''
 
+def print_progress_event(event):
+    # File lines are printed by the core as [n/total], only phase changes and failures are added here.
+    if event.kind == EVENT.phase:
+        print('-- ' + event.name + (': ' + event.message if event.message else ''))
+    elif event.kind == EVENT.file_failed:
+        print('!! ' + event.name + ': ' + event.message)
+
+
 def isInt(source):
     try:
         intresult = int(source)
@@ -15,16 +35,196 @@ def isInt(source):
     return True
 
 
-if __name__ == '__main__':
+UPDATE_CHANNELS = {'release': 1, 'beta': 2, 'alpha': 3}
+
+
+def parse_pack_spec(pack_spec):
+    """
+    :param pack_spec: 'project' or 'project@file_id', project being a name, id or url.
+    :return: [project, file_id or None]
+    """
+    project, _, file_id = pack_spec.strip().partition('@')
+    return [project, file_id or None]
+
+
+def read_pack_list(list_file):
+    """ One pack_spec per line, blank lines and lines starting with # are skipped. """
+    with open(list_file) as file_handler:
+        return [line.strip() for line in file_handler if line.strip() and not line.strip().startswith('#')]
+
+
+def command_packs(options):
+    pack_specs = list(options.packs)
+    if options.list:
+        pack_specs.extend(read_pack_list(options.list))
+    packs = [parse_pack_spec(pack_spec) for pack_spec in pack_specs]
+    if getattr(options, 'file_id', None):
+        if len(packs) != 1:
+            raise SystemExit("--file-id needs exactly one project.")
+        packs[0][1] = options.file_id
+    return packs
+
+
+def update_result_summary(update_result):
+    """ The json safe part of a check_instance_updates result. """
+    instance_settings = update_result["instance"]["settings"]
+    return {
+        "instance": update_result["instance"]["location"],
+        "name": instance_settings["instance_name"],
+        "project": instance_settings["project_name"],
+        "current": str(update_result["current"]),
+        "latest": update_result["latest"][1] if update_result["latest"] else None,
+        "update_available": update_result["update_available"],
+        "updated": update_result.get("updated", False),
+        "error": update_result["error"]}
+
+
+def run_install(options):
+    if options.manifest:
+        # Pack already unpacked by hand, only the mods are missing.
+        instance_dir = os.path.dirname(os.path.abspath(options.manifest))
+        failed = download_mods(instance_dir, install_type=options.type)
+        if failed is None:
+            return [{"instance": instance_dir, "error": "manifest.json is not usable."}]
+        return [{"instance": instance_dir, "error": failed_downloads_message(failed) if failed else ''}]
+    if not options.dest:
+        raise SystemExit("install needs --dest.")
+    packs = command_packs(options)
+    if options.name and len(packs) != 1:
+        raise SystemExit("--name needs exactly one project.")
+    # One batch, mods shared by several packs are downloaded once.
+    scheduler = InstallScheduler()
+    for project, file_id in packs:
+        scheduler.add_install(project, options.dest, file_id, options.name, options.type,
+                              UPDATE_CHANNELS[options.channel], not options.no_update_check, options.auto_update)
+    return scheduler.run()
+
+
+def run_update(options):
+    if not options.all and not options.instances:
+        raise SystemExit("update needs instance directories or --all.")
+    return [update_result_summary(update_result)
+            for update_result in update_instances(None if options.all else options.instances)]
+
+
+def run_check(options):
+    return [update_result_summary(update_result) for update_result in check_instance_updates()]
+
+
+def run_prefetch(options):
+    # Files and names ending like one are manifest.json files or pack zips, a missing one fails as unreadable.
+    sources = [project if file_id is None and (os.path.isfile(project) or project.lower().endswith(('.json', '.zip')))
+               else (project, file_id) for project, file_id in command_packs(options)]
+    return prefetch(sources, UPDATE_CHANNELS[options.channel])
 
+
+def run_cache(options):
+    if options.cache_command == 'verify':
+        verify_result = verify_cache(options.repair)
+        return [dict(bad_file, error=bad_file["problem"]) for bad_file in verify_result["bad"]] or \
+               [{"checked": verify_result["checked"], "error": ''}]
+    reclaimed = cache_gc(options.max_size_mb, options.policy)
+    return [{"reclaimed": reclaimed, "linked_into_instances": pinned_cache_size(), "error": ''}]
+
+
+def print_results(command, results, as_json):
+    ok = not any(result.get("error") for result in results)
+    if as_json:
+        json.dump({"command": command, "ok": ok, "results": results}, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+        return ok
+    for result in results:
+        status = "FAILED: " + result["error"] if result.get("error") else "ok"
+        print(" ".join(str(key) + "=" + str(value) for key, value in sorted(result.items()) if key != "error") +
+              " -> " + status)
+    return ok
+
+
+def build_argument_parser():
+    cli_parser = argparse.ArgumentParser(description=PROGRAM_NAME + " command line.")
+    cli_parser.add_argument("--json", action="store_true", help="Print the results as json on stdout, "
+                                                                "progress goes to stderr.")
+    cli_parser.add_argument("--quiet", action="store_true", help="No progress output.")
+    # Passed to init_logging before any command runs.
+    cli_parser.add_argument("--debug", action="store_true", help="Run in debugger mode.")
+    cli_parser.add_argument("--verbose", action="store_true", help="Outputs standard operation messages to console.")
+    cli_parser.add_argument("--metrics", metavar="FILE",
+                            help="Write a JSON summary of the run (bytes, time, cache hits) to FILE.")
+    commands = cli_parser.add_subparsers(dest="command", metavar="command")
+
+    pack_options = argparse.ArgumentParser(add_help=False)
+    pack_options.add_argument("packs", nargs='*', metavar="project[@file_id]",
+                              help="curseforge project name, id or url, optionally with the file id to use.")
+    pack_options.add_argument("--list", help="file with one project[@file_id] per line.")
+    pack_options.add_argument("--file-id", help="file id of the version to use, for a single project.")
+    pack_options.add_argument("--channel", choices=sorted(UPDATE_CHANNELS), default='release',
+                              help="newest version taken when no file id is given.")
+
+    install_command = commands.add_parser("install", parents=[pack_options], help="Install packs into --dest.")
+    install_command.add_argument("--dest", help="directory the instance folders are made in.")
+    install_command.add_argument("--name", help="instance folder name, for a single project.")
+    install_command.add_argument("--type", choices=['custom', 'mmc', 'curse'], default='custom')
+    install_command.add_argument("--no-update-check", action="store_true")
+    install_command.add_argument("--auto-update", action="store_true")
+    install_command.add_argument("--manifest", help="manifest.json of an unzipped pack, installs only its mods.")
+
+    update_command = commands.add_parser("update", help="Update installed instances.")
+    update_command.add_argument("instances", nargs='*', help="instance directories.")
+    update_command.add_argument("--all", action="store_true", help="every installed instance with update check on.")
+
+    commands.add_parser("check", help="Check installed instances for updates.")
+
+    commands.add_parser("prefetch", parents=[pack_options],
+                        help="Download packs and their mods into the cache, manifest.json files and pack zips "
+                             "can be given instead of projects.")
+
+    cache_command = commands.add_parser("cache", help="Download cache maintenance.")
+    cache_commands = cache_command.add_subparsers(dest="cache_command", metavar="cache_command")
+    cache_commands.required = True
+    gc_command = cache_commands.add_parser("gc", help="Evict entries until the cache fits its budget.")
+    gc_command.add_argument("--max-size-mb", type=float, help="defaults to the program setting.")
+    gc_command.add_argument("--policy", choices=['lru', 'lfu'], help="defaults to the program setting.")
+    verify_command = cache_commands.add_parser("verify", help="Re-hash the cache and report bad files.")
+    verify_command.add_argument("--repair", action="store_true", help="quarantine bad files.")
+    return cli_parser
+
+
+COMMANDS = {"install": run_install, "update": run_update, "check": run_check, "prefetch": run_prefetch,
+            "cache": run_cache}
+
+
+def run_command(options):
+    """
+    :return: process exit code, 1 if any result has an error.
+    """
+    initialize_program_environment()
+    if options.metrics:
+        program_settings[KEY.metrics_file] = options.metrics
+    if not options.quiet:
+        subscribe_progress(print_progress_event)
+    if options.json:
+        # Everything the core prints goes to stderr, stdout only carries the json document.
+        with contextlib.redirect_stdout(sys.stderr):
+            results = COMMANDS[options.command](options)
+    elif options.quiet:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            results = COMMANDS[options.command](options)
+    else:
+        results = COMMANDS[options.command](options)
+    return 0 if print_results(options.command, results, options.json) else 1
+
+
+def interactive_menu():
     program_title = PROGRAM_NAME + ' v' + PROGRAM_VERSION_NUMBER + " " + PROGRAM_VERSION_BUILD
     print('\n' + '-' * len(program_title))
     print(program_title)
     print('-' * len(program_title))
 
     initialize_program_environment()
+    subscribe_progress(print_progress_event)
 
-    program_options_list = ['install from curse', 'check instance(s) update']
+    program_options_list = ['install from curse', 'check instance(s) update', 'clean download cache',
+                            'verify download cache']
     print('What would you like to do today?')
 
     user_selection = False
@@ -37,5 +237,30 @@ if __name__ == '__main__':
             if (int(users_response) >= 1) and (int(users_response) <= len(program_options_list)):
                 print('correct')
                 user_selection = True
-                pass
+                if int(users_response) == 1:
+                    project, file_id = parse_pack_spec(input('Project name, id or url (project@file_id for a version):'))
+                    install_result = install_modpack(project, input('Install into directory:').strip(), file_id)
+                    print(install_result['error'] or 'Installed ' + install_result['instance'])
+                if int(users_response) == 2:
+                    instance_update_check()
+                if int(users_response) == 3:
+                    print('Cache cleaned, reclaimed: ' + get_human_readable(cache_gc()))
+                    print('Linked into instances, not counted: ' + get_human_readable(pinned_cache_size()))
+                if int(users_response) == 4:
+                    verify_result = verify_cache()
+                    for bad_file in verify_result['bad']:
+                        print('!! ' + bad_file['path'] + ': ' + bad_file['problem'])
+                    print('Checked ' + str(verify_result['checked']) + ' files, ' +
+                          str(len(verify_result['bad'])) + ' bad.')
+                    if verify_result['bad'] and input('Quarantine bad files so they get downloaded again? y/n:') \
+                            .strip().lower() == 'y':
+                        verify_cache(repair=True)
 
+
+if __name__ == '__main__':
+    cli_options = build_argument_parser().parse_args()
+    init_logging(cli_options.debug, cli_options.verbose)
+    if cli_options.command is None:
+        interactive_menu()
+    else:
+        sys.exit(run_command(cli_options))
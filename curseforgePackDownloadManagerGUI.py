@@ -1,4 +1,3 @@
-import argparse
 from tkinter import *
 from tkinter import ttk, simpledialog
 from tkinter import messagebox
@@ -10,7 +9,6 @@ import threading
 import queue
 import time
 from pathlib import Path
-from distutils.util import strtobool
 
 '''
 Author(s): TOLoneWolf
@@ -29,6 +27,41 @@ def center_window(toplevel):
     toplevel.geometry("{0}x{1}+{2}+{3}".format(size[0], size[1], x, y))
 
 
+def watch_progress(widget, progress_queue, on_finished, interval=200):
+    """
+    Drains a subscribe_progress queue on the Tk thread every interval ms, printing the download progress.
+    :param on_finished: called with the PHASE.done or PHASE.failed event, the queue is unsubscribed by then.
+    """
+    transfers = {}  # file name -> [received, total] for the files in flight.
+
+    def _drain():
+        while True:
+            try:
+                event = progress_queue.get_nowait()
+            except queue.Empty:
+                break
+            if event.kind == EVENT.file_started:
+                transfers[event.name] = [event.size, event.total]
+            elif event.kind == EVENT.file_bytes and event.name in transfers:
+                transfers[event.name][0] += event.size
+            elif event.kind in (EVENT.file_finished, EVENT.file_failed):
+                transfers.pop(event.name, None)
+                if event.kind == EVENT.file_failed:
+                    log.warning(event.name + ": " + event.message)
+            elif event.kind == EVENT.phase and event.name in (PHASE.done, PHASE.failed):
+                unsubscribe_progress(progress_queue)
+                on_finished(event)
+                return
+        received = sum(transfer[0] for transfer in transfers.values())
+        total = sum(transfer[1] for transfer in transfers.values())
+        if total:
+            print(str(round(received / total * 100, 0)) + " P: " + get_human_readable(received) + "/" +
+                  get_human_readable(total) + " (" + str(len(transfers)) + " files)")
+        widget.after(interval, _drain)
+
+    widget.after(interval, _drain)
+
+
 # ----------------------------------------------------------------
 
 
@@ -204,66 +237,38 @@ class SelectUnpackDirectory(Toplevel):
             if self.entry_instance_name.get:
                 InstanceInfo.instance_name = self.entry_instance_name.get()
                 InstanceInfo.install_type = self.rdo_var_type.get()
-                InstanceInfo.update_check = bool(strtobool(self.rdo_var_check_update.get()))
-                InstanceInfo.update_automatic = bool(strtobool(self.rdo_var_auto_update.get()))
+                InstanceInfo.update_check = self.rdo_var_check_update.get() == 'True'
+                InstanceInfo.update_automatic = self.rdo_var_auto_update.get() == 'True'
                 InstanceInfo.instance_path = os.path.normpath(os.path.join(self.entry_directory.get(), self.entry_instance_name.get()))
                 log.debug("unpack process: " + str(InstanceInfo.instance_path))
-                unzip(self.src_zip, InstanceInfo.instance_path)
+                extract_modpack_zip(self.src_zip, InstanceInfo.instance_path, InstanceInfo.install_type)
                 save_instance_settings(InstanceInfo.instance_path)
                 if os.path.exists(InstanceInfo.instance_path.join("manifest.json")):
                     if not os.path.exists(InstanceInfo.instance_path.join(PDM_INSTANCE_FOLDER)):
                         os.mkdir(InstanceInfo.instance_path.join(PDM_INSTANCE_FOLDER))
                     shutil.copy(InstanceInfo.instance_path.join('manifest.json'), os.path.join(InstanceInfo.instance_path, PDM_INSTANCE_FOLDER, "manifest.json"))
-                work_thread = threading.Thread(target=download_mods, args=(InstanceInfo.instance_path,))
+                progress_queue = subscribe_progress()
+                work_thread = threading.Thread(target=download_mods, args=(InstanceInfo.instance_path,),
+                                               kwargs={'install_type': InstanceInfo.install_type})
                 work_thread.start()
+                master = self.master
                 self.close_window()
-                InstanceInfo.is_done = False
-                while not InstanceInfo.is_done:
-                    time.sleep(0.2)
-                    if InstanceInfo.file_size:
-                        percent = round((int(InstanceInfo.current_file_size) / int(InstanceInfo.file_size)) * 100, 0)
-                        print(str(percent) + " P: " + str(get_human_readable(InstanceInfo.current_file_size)) + "/" + str(get_human_readable(InstanceInfo.file_size)))
-
-                # Copy user saved settings and mods back into the instance.
-                if InstanceInfo.merge_custom:
-                    if os.path.exists(
-                            os.path.normpath(os.path.join(InstanceInfo.instance_path, PDM_INSTANCE_FOLDER, 'config'))):
-                        copytree_overwrite_dst(
-                            os.path.normpath(os.path.join(InstanceInfo.instance_path, PDM_INSTANCE_FOLDER, 'config')),
-                            os.path.normpath(os.path.join(InstanceInfo.instance_path,'minecraft', 'config')))
-
-                    if os.path.exists(
-                            os.path.normpath(os.path.join(InstanceInfo.instance_path, PDM_INSTANCE_FOLDER, 'mods'))):
-                        copytree_overwrite_dst(
-                            os.path.normpath(os.path.join(InstanceInfo.instance_path, PDM_INSTANCE_FOLDER, 'mods')),
-                            os.path.normpath(os.path.join(InstanceInfo.instance_path, 'minecraft', 'mods')))
-
-                if InstanceInfo.install_type == 'curse':
-                    movetree_overwrite_dst(
-                        os.path.join(InstanceInfo.instance_path, 'minecraft'),
-                        InstanceInfo.instance_path)
-                if InstanceInfo.install_type == 'mmc':
-                    if not os.path.exists(
-                            os.path.join(
-                                program_settings['MultiMC'], 'icons',
-                                InstanceInfo.project_name + 'icon.png')):
-                        shutil.copy(
-                            os.path.join(MODPACK_ZIP_CACHE, InstanceInfo.project_id, 'pack_icon.png'),
-                            os.path.join(
-                                program_settings['MultiMC'], 'icons',
-                                InstanceInfo.project_name + '_icon.png'))
-
-                    mmc_cfg_contents = mmc_read_cfg(InstanceInfo.instance_path)
-                    if not mmc_write_cfg(mmc_cfg_contents, InstanceInfo.instance_path):
-                        raise RuntimeError("MultiMC settings file save failed to execute correctly.")
-
-                save_instance_settings(InstanceInfo.instance_path)
-                if not {"location": InstanceInfo.instance_path} in installed_instances:
-                    installed_instances.append({"location": InstanceInfo.instance_path})
-                    save_json_file({"instances": installed_instances}, INSTALLED_INSTANCE_FILE)
-
-                print("work_thread: manager.downloads_mods 'isDone' detected.")
-                print("Manager Done Downloading")
+                watch_progress(master, progress_queue, self.finish_install)
+
+    @staticmethod
+    def finish_install(last_event):
+        """
+        Runs on the Tk thread once download_mods sent its last progress event.
+        :param last_event: the PHASE.done or PHASE.failed event.
+        """
+        if last_event.name == PHASE.failed:
+            log.error("Mod download failed: " + last_event.message)
+            messagebox.showerror("Download Failed", last_event.message)
+            return
+        finish_instance_install(InstanceInfo.instance_path)
+
+        print("work_thread: manager.downloads_mods 'isDone' detected.")
+        print("Manager Done Downloading")
 
 
 class VersionSelectionMenu(Toplevel):
@@ -283,6 +288,7 @@ class VersionSelectionMenu(Toplevel):
             self.project_id = pack_info[1]
             self.project_name = pack_info[2]
             self.pack_version_list = pack_info[3]
+            self.pack_icon_url = pack_info[4]
             self.current_version_list = []
 
             # --- GUI objects.
@@ -387,7 +393,8 @@ class VersionSelectionMenu(Toplevel):
             pack_source=self.pack_source,
             project_id=self.project_id,
             project_name=self.project_name,
-            file_id=self.current_version_list[self.listbox_version.curselection()[0]])
+            file_id=self.current_version_list[self.listbox_version.curselection()[0]],
+            pack_icon_url=self.pack_icon_url)
         print("work_thread: manager.download_modpack_zip 'isDone' detected.")
         print("Manager Done Downloading")
         if src_zip:
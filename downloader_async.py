@@ -0,0 +1,434 @@
+import asyncio
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import downloader_core as core
+from downloader_core import InstanceInfo, log
+
+try:
+    import aiohttp
+except ImportError:  # Optional, downloader_core falls back to the requests session.
+    aiohttp = None
+
+'''
+Author(s): TOLoneWolf
+
+This contains an optional asyncio transport for the downloader core.
+Selected with program_settings 'http_backend': 'asyncio', it needs the aiohttp package.
+The sync functions in downloader_core stay the entry points and call run() with the coroutines below.
+'''
+
+CHUNK_SIZE = 64 * 1024
+
+
+def is_available():
+    return aiohttp is not None
+
+
+def run(coroutine_function, *args, limit=None, limit_per_host=None):
+    """
+    Runs coroutine_function(session, *args) on a new event loop with a shared aiohttp session.
+    A new loop is used every time so it can be called from any worker thread.
+    :param limit: connections open at once. Defaults to program_settings 'async_connections'.
+    :param limit_per_host: connections open per host. Defaults to program_settings 'async_connections_per_host'.
+    :return: whatever the coroutine returns.
+    """
+    if limit is None:
+        limit = core.program_settings[core.KEY.async_connections]
+    if limit_per_host is None:
+        limit_per_host = core.program_settings[core.KEY.async_connections_per_host]
+
+    async def _main():
+        connector = aiohttp.TCPConnector(limit=int(limit), limit_per_host=int(limit_per_host))
+        async with aiohttp.ClientSession(connector=connector, headers=dict(core.http_session().headers)) as session:
+            return await coroutine_function(session, *args)
+
+    loop = asyncio.new_event_loop()
+    # Cache, lock and index calls run here, see _in_executor. One thread per connection is enough,
+    # every fetch waits for its own call before it starts the next one.
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=int(limit) or None))
+    try:
+        return loop.run_until_complete(_main())
+    finally:
+        loop.close()
+
+
+def _in_executor(function, *args):
+    """
+    Runs a blocking downloader_core call on the loop's executor, the other fetches go on meanwhile.
+    Used for everything that takes the cache locks, writes the cache index, hashes or links files.
+    """
+    return asyncio.get_event_loop().run_in_executor(None, function, *args)
+
+
+def _check_running():
+    if InstanceInfo.master_thread_running is False:
+        log.error("Main Thread Dead, Joining it in the after life.")
+        sys.exit()
+
+
+async def _write_body(response, writer):
+    """
+    asyncio version of downloader_core.stream_response, writer is an entered downloader_core.DownloadWriter.
+    A cancelled .part file is left in place, downloads with a sidecar get resumed next time.
+    """
+    read_size = core.DOWNLOAD_READ_SIZE_MIN
+    while True:
+        read_started = time.time()
+        chunk = await response.content.read(read_size)
+        if not chunk:
+            return
+        writer.write(chunk)
+        _check_running()
+        read_size = core.next_read_size(read_size, len(chunk), time.time() - read_started)
+
+
+async def _acquire_cache_lock(cache_lock):
+    """
+    asyncio version of downloader_core.CacheFileLock.acquire, polls without blocking the loop.
+    """
+    while not cache_lock.try_acquire():
+        cache_lock.mark_waiting()
+        _check_running()
+        await asyncio.sleep(core.CACHE_LOCK_POLL_SECONDS)
+    return cache_lock.waited
+
+
+async def _request_part_download(session, url, part_path):
+    """
+    asyncio version of downloader_core.request_part_download, the caller must release the response.
+    :return: [response, open_mode, offset, total_size]
+    """
+    offset, request_headers = core.resume_request_headers(part_path, url)
+    response = await session.get(url, headers=request_headers)
+    if offset and response.status == 416:  # Range not satisfiable, the part doesn't fit the file anymore.
+        core.metrics_count("retries")
+        response.release()
+        core.remove_part_download(part_path)
+        offset = 0
+        response = await session.get(url, headers=core.FILE_DOWNLOAD_HEADERS)
+    if response.status not in (200, 206):
+        return [response, 'wb', 0, 0]  # Nothing to write, the part and its sidecar are kept for a later attempt.
+    open_mode, offset, total_size = core.begin_part_download(
+        part_path, url, response.status, response.headers, offset)
+    return [response, open_mode, offset, total_size]
+
+
+async def _read_version_page(session, url, first_page=False, known_file_id=None, request_headers=None):
+    """
+    asyncio version of downloader_core.read_version_page.
+    :return: [status, final url, parser, response headers]
+    """
+    core.metrics_count("version_pages")
+    async with session.get(url, headers=request_headers) as response:
+        parser = core.VersionPageParser(first_page, known_file_id, core.response_encoding(response.headers))
+        if response.status == 200:
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                parser.feed_bytes(chunk)
+                if parser.reached_known_file:
+                    break
+            parser.finish()
+        return [response.status, str(response.url), parser, response.headers]
+
+
+async def _read_version_sub_pages(session, pack_source, project_identifier, page_count, known_file_id=None):
+    """
+    asyncio version of downloader_core.read_version_sub_pages.
+    """
+    rows = []
+    next_page = 2
+    while next_page <= page_count:
+        pages = await asyncio.gather(*[
+            _read_version_page(session, core.project_files_url(pack_source, project_identifier, page),
+                               known_file_id=known_file_id)
+            for page in range(next_page, page_count + 1)])
+        next_page = page_count + 1
+        for status, url, parser, response_headers in pages:
+            if status != 200:
+                raise ConnectionError("URL request failed sub page request: " + url)
+            rows.extend(parser.rows)
+            if parser.reached_known_file:
+                return rows
+            page_count = max(page_count, parser.page_count)
+    return rows
+
+
+async def fetch_modpack_version_list(session, project_identifier, known_file_id=None, cached=None):
+    """
+    asyncio version of downloader_core.get_modpack_version_list, sub pages are requested all at once.
+    :param project_identifier: normalized curseforge project name.
+    :param cached: stale entry from downloader_core.cached_version_list to revalidate, or None.
+    """
+    stop_file_id = cached["version_rows"][0][1] if cached and cached["version_rows"] else known_file_id
+    if cached is not None:
+        pack_source = cached["pack_source"]
+        status, url, parser, response_headers = await _read_version_page(
+            session, core.project_files_url(pack_source, project_identifier), True, stop_file_id,
+            core.version_list_revalidation_headers(cached))
+        log.debug("status code: {0}".format(status))
+        if status == 304:
+            return await _in_executor(core.version_list_from_cache, cached, known_file_id, True)
+    else:
+        status, url, parser, response_headers = await _read_version_page(
+            session, core.project_files_url('curseforge', project_identifier), True, stop_file_id)
+        pack_source = "curseforge"
+        log.debug("status code: {0}".format(status))
+        if status == 404:
+            status, url, parser, response_headers = await _read_version_page(
+                session, core.project_files_url('ftb', project_identifier), True, stop_file_id)
+            pack_source = "ftb"
+            log.debug("status code: {0}".format(status))
+
+    if status == 200 and parser.is_modpack:
+        rows = list(parser.rows)
+        if parser.page_count > 1 and not parser.reached_known_file:
+            log.debug("Page count: " + str(parser.page_count))
+            rows.extend(await _read_version_sub_pages(
+                session, pack_source, project_identifier, parser.page_count, stop_file_id))
+        return await _in_executor(
+            core.store_version_list, project_identifier, pack_source, url, parser, rows, response_headers, known_file_id, cached)
+    return ['', 0, '', [], '']
+
+
+async def _fetch_pack_icon(session, project_id, pack_icon_url):
+    if core.pack_icon_needed(project_id, pack_icon_url):
+        InstanceInfo.current_file_size = 0
+        icon_part_path = core.pack_icon_part_path()
+        async with session.get(pack_icon_url) as response:
+            with core.DownloadWriter(icon_part_path) as writer:
+                await _write_body(response, writer)
+        await _in_executor(core.store_pack_icon, icon_part_path, project_id)
+
+
+async def fetch_modpack_zip(session, pack_source, project_id, project_name, file_id, pack_icon_url=''):
+    """
+    asyncio version of downloader_core.download_modpack_zip.
+    :return: cached zip path, or '' on failure.
+    """
+    zip_path = await _in_executor(core.cached_modpack_zip, project_id, file_id)
+    if not zip_path:
+        cache_lock = core.CacheFileLock(project_id, file_id)
+        try:
+            if await _acquire_cache_lock(cache_lock):
+                # Another process was downloading this zip, take it from the cache if that worked.
+                zip_path = await _in_executor(core.cached_modpack_zip, project_id, file_id)
+            if not zip_path:
+                InstanceInfo.return_arg = await _download_modpack_file(
+                    session, pack_source, project_id, file_id, pack_icon_url)
+                InstanceInfo.is_done = True
+                return InstanceInfo.return_arg
+        finally:
+            cache_lock.release()
+    InstanceInfo.is_done = True
+    InstanceInfo.return_arg = zip_path
+    await _fetch_pack_icon(session, project_id, pack_icon_url)
+    core.emit_progress(core.EVENT.file_finished, os.path.basename(zip_path), message="in cache")
+    return InstanceInfo.return_arg
+
+
+async def _download_modpack_file(session, pack_source, project_id, file_id, pack_icon_url):
+    """
+    asyncio version of downloader_core.download_modpack_file.
+    :return: path of the cached zip, or '' on failure.
+    """
+    download_url = core.modpack_download_url(pack_source, project_id, file_id)
+    if not download_url:
+        core.emit_progress(core.EVENT.file_failed, str(file_id), message="Unknown pack source: " + str(pack_source))
+        return ''  # Error detecting pack source url.
+
+    download_started = time.time()
+    async with session.get(download_url) as response:
+        # Only the resolved url is needed, the body is requested below.
+        ttfb = time.time() - download_started
+        log.debug(str(response.url))
+        status = response.status
+        file_url = str(response.url)
+    if status != 200:
+        core.emit_progress(core.EVENT.file_failed, str(file_id), message="Download failed with status " + str(status))
+        return ''
+    file_name = core.file_name_from_url(file_url)
+    modpack_part_path = core.modpack_part_file(project_id, file_id, file_name)
+    response, open_mode, offset, InstanceInfo.file_size = await _request_part_download(
+        session, file_url, modpack_part_path)
+    InstanceInfo.current_file_size = offset
+    async with response:
+        if response.status not in (200, 206):
+            core.emit_progress(core.EVENT.file_failed, file_name,
+                               message="Download failed with status " + str(response.status))
+            return ''
+        if InstanceInfo.file_size:
+            print(str(file_name + " (DL: " + core.get_human_readable(InstanceInfo.file_size) + ")"))
+        else:
+            print(str(file_name + " (DL: " + "size: ?" + ")"))
+        core.emit_progress(core.EVENT.file_started, file_name, InstanceInfo.current_file_size, InstanceInfo.file_size)
+        with core.DownloadWriter(modpack_part_path, open_mode, offset, InstanceInfo.file_size, file_name) as writer:
+            await _write_body(response, writer)
+
+    problem = await _in_executor(core.check_file_integrity, modpack_part_path, file_name, InstanceInfo.file_size)
+    if problem:
+        await _in_executor(core.quarantine_file, modpack_part_path, problem)
+        core.emit_progress(core.EVENT.file_failed, file_name, message="Download damaged, " + problem)
+        return ''
+    core.metrics_file(file_name, writer.received, time.time() - download_started, ttfb)
+    zip_path = await _in_executor(
+        core.store_modpack_zip, modpack_part_path, project_id, file_id, file_name, writer.content_hash)
+    core.emit_progress(core.EVENT.file_finished, file_name, os.path.getsize(zip_path), os.path.getsize(zip_path))
+    await _fetch_pack_icon(session, project_id, pack_icon_url)
+    await _in_executor(core.enforce_cache_budget)
+    return zip_path
+
+
+async def resolve_mod_download(session, dependency, refresh=False):
+    """
+    asyncio version of downloader_core.resolve_mod_download.
+    :return: [file_url, file_name, remembered], or None if the file is missing from the source.
+    """
+    if not refresh:
+        resolved = await _in_executor(core.lookup_resolved_url, dependency)
+        if resolved is not None:
+            if resolved["url"] is None:
+                return None
+            return [resolved["url"], resolved["name"], True]
+
+    async with session.head(core.mod_download_url(dependency), allow_redirects=True) as file_response:
+        # Only the resolved url is needed, see downloader_core.resolve_mod_download.
+        file_url = str(file_response.url)
+        status = file_response.status
+    if status not in (200, 404):
+        async with session.get(core.mod_download_url(dependency)) as file_response:
+            file_url = str(file_response.url)
+            status = file_response.status
+    file_name = core.file_name_from_url(file_url)
+
+    if (status == 404) or (file_name == "download"):
+        log.info("{0}/{1} Trying to resolve using alternate requesting.".format(
+            dependency['projectID'], dependency['fileID']))
+        core.metrics_count("cursemeta_fallbacks")
+        async with session.get(core.cursemeta_url(dependency)) as r:
+            r.raise_for_status()
+            main_json = await r.json(content_type=None)
+        if "code" in main_json:
+            await _in_executor(core.record_resolved_url, dependency)
+            return None
+        file_url = main_json["DownloadURL"]
+        file_name = main_json["FileNameOnDisk"]
+    await _in_executor(core.record_resolved_url, dependency, file_url, file_name)
+    return [file_url, file_name, False]
+
+
+async def fetch_mod_dependency(session, dependency, mods_path):
+    """
+    asyncio version of downloader_core.download_mod_dependency.
+    :return: file name installed into mods_path, or None if the file is missing from the source
+        or could not be downloaded.
+    """
+    _check_running()
+    cached_file = await _in_executor(core.cached_mod_file, dependency)
+    if cached_file is not None:
+        file_name = await _in_executor(core.install_cached_mod, cached_file[0], cached_file[1], mods_path)
+        core.report_progress("%s (in cache)" % file_name, file_name=file_name)
+        return file_name
+
+    in_flight, owner = core.join_in_flight_download(dependency)
+    if not owner:
+        await asyncio.wrap_future(in_flight)
+        return await _in_executor(core.install_joined_download, dependency, mods_path)
+    cache_lock = core.CacheFileLock(dependency['projectID'], dependency['fileID'])
+    downloaded = None
+    try:
+        await _acquire_cache_lock(cache_lock)
+        # Another worker or process may have cached it since the check above.
+        cached_file = await _in_executor(core.cached_mod_file, dependency)
+        if cached_file is None:
+            downloaded = await fetch_mod_file(session, dependency)
+    except (OSError, ValueError, asyncio.TimeoutError, aiohttp.ClientError) as e:
+        core.report_download_error(dependency, e)
+        return None
+    finally:
+        cache_lock.release()
+        core.finish_in_flight_download(dependency, in_flight)
+    if cached_file is not None:
+        file_name = await _in_executor(core.install_cached_mod, cached_file[0], cached_file[1], mods_path)
+        core.report_progress("%s (in cache)" % file_name, file_name=file_name)
+        return file_name
+    if downloaded is None:
+        return None
+    cached_file, file_size = downloaded
+    file_name = await _in_executor(core.install_cached_mod, cached_file[0], cached_file[1], mods_path)
+    core.report_downloaded(file_name, file_size)
+    return file_name
+
+
+async def fetch_mod_file(session, dependency):
+    """
+    asyncio version of downloader_core.download_mod_file.
+    :return: [[object_path, file_name], file_size] or None if the file is missing from the source or damaged.
+    """
+    download_started = time.time()
+    for refresh in (False, True):
+        resolved_download = await resolve_mod_download(session, dependency, refresh)
+        if resolved_download is None:
+            core.report_progress("ERROR FILE MISSING FROM SOURCE", core.EVENT.file_failed,
+                                 core.mod_cache_key(dependency['projectID'], dependency['fileID']))
+            return None
+        file_url, file_name, remembered = resolved_download
+
+        part_path = core.mod_part_path(dependency, file_name)
+        request_started = time.time()
+        response, open_mode, offset, file_size = await _request_part_download(session, file_url, part_path)
+        ttfb = time.time() - request_started
+        async with response:
+            if response.status not in (200, 206):
+                if refresh:
+                    core.report_progress("ERROR DOWNLOAD FAILED WITH STATUS " + str(response.status),
+                                         core.EVENT.file_failed, file_name)
+                    return None
+                # A remembered url stopped working or the server failed once, resolve it again.
+                log.info("Download answered {0}, resolving again: {1}".format(response.status, file_url))
+                core.metrics_count("retries")
+                continue
+            core.report_download_started(file_name, file_size, offset)
+            with core.DownloadWriter(part_path, open_mode, offset, file_size, file_name) as writer:
+                await _write_body(response, writer)
+        problem = await _in_executor(core.check_file_integrity, part_path, file_name, file_size)
+        if problem:
+            await _in_executor(core.quarantine_file, part_path, problem)
+            if refresh:
+                core.report_progress("ERROR DOWNLOAD DAMAGED, " + problem, core.EVENT.file_failed, file_name)
+                return None
+            core.metrics_count("retries")
+            continue
+        break
+    await _in_executor(core.record_resolved_url, dependency, file_url, file_name, file_size)
+    core.metrics_file(file_name, writer.received, time.time() - download_started, ttfb)
+
+    cached_file = await _in_executor(core.store_mod_in_cache, part_path, dependency, file_name, writer.content_hash)
+    return [cached_file, file_size]
+
+
+async def fetch_mods(session, dependencies, mods_path, limit=None):
+    """
+    Fetches the dependencies on the running loop with a fixed number of workers,
+    so a large pack doesn't start a task and a cache lock poll for every file at once.
+    :param limit: workers at once. Defaults to the session's connection limit.
+    :return: list of installed file names in dependency order, None for files missing from the source.
+    """
+    if limit is None:
+        limit = session.connector.limit or len(dependencies)
+    results = [None] * len(dependencies)
+    pending = iter(enumerate(dependencies))
+
+    async def _worker():
+        for index, dependency in pending:
+            results[index] = await fetch_mod_dependency(session, dependency, mods_path)
+
+    workers = [asyncio.ensure_future(_worker()) for _ in range(min(int(limit), len(dependencies)))]
+    try:
+        await asyncio.gather(*workers)
+    except BaseException:
+        for worker in workers:
+            worker.cancel()
+        raise
+    return results
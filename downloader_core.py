@@ -1,17 +1,25 @@
-import argparse
+import atexit
+import codecs
 import re
 import shutil
+import threading
 import zipfile
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from html.parser import HTMLParser
 from pathlib import Path
-from urllib.parse import unquote
+from urllib.parse import unquote, urlparse
 
 import errno
-import requests
+import functools
+import hashlib
 import os
+import sqlite3
 import os.path
 import sys
 import json
 import logging
+import queue
 import time
 import stat
 
@@ -42,6 +50,21 @@ class KEY:
     MultiMC = "MultiMC"
     Vanilla_Client = "Vanilla_Client"
     cache_path = "cache_path"
+    download_threads = "download_threads"
+    download_threads_per_host = "download_threads_per_host"
+    http_backend = "http_backend"
+    async_connections = "async_connections"
+    async_connections_per_host = "async_connections_per_host"
+    install_strategy = "install_strategy"
+    cache_max_size_mb = "cache_max_size_mb"
+    cache_eviction_policy = "cache_eviction_policy"
+    resolved_url_ttl_hours = "resolved_url_ttl_hours"
+    missing_file_ttl_hours = "missing_file_ttl_hours"
+    version_list_ttl_minutes = "version_list_ttl_minutes"
+    metrics_file = "metrics_file"
+    metrics_prometheus_file = "metrics_prometheus_file"
+    http_pool_hosts = "http_pool_hosts"
+    http_pool_per_host = "http_pool_per_host"
 
 
 # Defaults settings in case we want to reset_dl to them later.
@@ -56,7 +79,22 @@ DEFAULT_PROGRAM_SETTINGS = {
     "curse_client": "",
     "MultiMC": "",
     "Vanilla_Client": "",
-    "cache_path": "curse_download_cache"
+    "cache_path": "curse_download_cache",
+    "download_threads": 8,
+    "download_threads_per_host": 4,
+    "http_backend": "requests",  # requests, asyncio (needs aiohttp)
+    "async_connections": 100,
+    "async_connections_per_host": 16,
+    "install_strategy": "hardlink",  # hardlink, reflink, symlink, copy. Falls back to copy when unsupported.
+    "cache_max_size_mb": 0,  # 0 = no limit. Mods hardlinked or symlinked into instances don't count toward it.
+    "cache_eviction_policy": "lru",  # lru, lfu
+    "resolved_url_ttl_hours": 168,  # How long a resolved mod download url is reused, 0 = always resolve.
+    "missing_file_ttl_hours": 24,  # How long a file missing from every source is not asked for again.
+    "version_list_ttl_minutes": 30,  # How long a project version list is used before asking the site again.
+    "metrics_file": "",  # Write a JSON summary of the last run here, e.g. pdm_metrics.json.
+    "metrics_prometheus_file": "",  # Also write the summary as a Prometheus textfile here, e.g. for node_exporter.
+    "http_pool_hosts": 10,  # Hosts the shared session keeps connections open to.
+    "http_pool_per_host": 16  # Connections kept open per host, raised to download_threads when that is higher.
 }
 # program_settings should get new values on load if user changed them.
 program_settings = {}
@@ -66,44 +104,194 @@ installed_instances = []
 CACHE_PATH = "curse_download_cache"  # FIXME:
 MODPACK_ZIP_CACHE = os.path.join(CACHE_PATH, "modpacks_cache")
 MOD_CACHE = os.path.join(CACHE_PATH, "mods_cache")
+MOD_CACHE_OBJECTS = os.path.join(MOD_CACHE, "objects")  # Mod files stored by content hash.
+MOD_CACHE_REFS = os.path.join(MOD_CACHE, "refs")  # <projectID>/<fileID>.json naming the object of each file.
+MOD_CACHE_INDEX_FILE = os.path.join(MOD_CACHE, "cache_index.json")  # Replaced by CACHE_INDEX_DB, imported once.
+CACHE_INDEX_DB = os.path.join(CACHE_PATH, "cache_index.sqlite")
+QUARANTINE_PATH = os.path.join(CACHE_PATH, "quarantine")  # Damaged downloads and cache files kept for inspection.
+CACHE_LOCK_PATH = os.path.join(CACHE_PATH, "locks")  # <projectID>-<fileID>.lock of entries being downloaded.
+CACHE_LOCK_POLL_SECONDS = 0.2
+CACHE_GC_GRACE_SECONDS = 60  # Entries used this recently are kept by cache_gc, a process may be installing them.
+CACHE_HASH_ALGORITHM = 'sha256'
 PDM_SETTINGS_FILE = "pdm_settings.json"
 INSTALLED_INSTANCE_FILE = "pdm_installed_instances.json"  # FIXME:
 PDM_INSTANCE_FOLDER = 'pdm_instance'
 PDM_INSTANCE_FILE = 'pdm_instance.json'
+INSTALLED_MODS_FILE = 'installed_mods.json'
+MOD_ERRORS_LOG_FILE = 'cursePackDownloaderModErrors.log'  # In the instance, the files of the last run that failed.
 
+CURSEFORGE_URL = "https://minecraft.curseforge.com"
+FTB_URL = "https://www.feed-the-beast.com"
+CURSEMETA_URL = "https://cursemeta.dries007.net"
 
-req_sess = requests.session()
-req_sess.headers.update({
-    'User-Agent': requests.utils.default_user_agent() +
-    ' ' + PROGRAM_NAME + '/' + PROGRAM_VERSION_NUMBER + '-' + PROGRAM_VERSION_BUILD})
+
+# Made on first use by http_session and init_logging, so importing this module stays cheap for the front ends
+# and for tools that only need a few of its functions.
+_http_session = None
+_http_session_lock = threading.Lock()
+_http_pool_lock = threading.Lock()
+_http_pool_size = 0  # Connections kept per host by the mounted adapter.
+_retired_http_stats = {"requests": 0, "connections": 0}
+log = logging.getLogger()
+_logging_initialized = False
 
 
-# --- Parse in arguments.
-parser = argparse.ArgumentParser(description="Download Curse modpack mods")
-parser.add_argument("--manifest", help="manifest.json file from unzipped pack")
-parser.add_argument("--debug", action="store_true", dest="debug", help="Run in debugger mode.")
-parser.add_argument("--verbose", action="store_true", dest="verbose", help="Outputs standard operation messages to console.")
-args, unknown = parser.parse_known_args()
+def http_session():
+    """
+    The requests session shared by every operation, requests is imported when this is first called.
+    The session and its connection pools are kept until the program exits,
+    so back to back installs and update checks reuse the open connections instead of connecting again.
+    """
+    global _http_session
+    if _http_session is None:
+        with _http_session_lock:
+            if _http_session is None:
+                import requests
+                session = requests.session()
+                session.headers.update({
+                    'User-Agent': requests.utils.default_user_agent() +
+                    ' ' + PROGRAM_NAME + '/' + PROGRAM_VERSION_NUMBER + '-' + PROGRAM_VERSION_BUILD})
+                ensure_http_pool_size(session=session)
+                _http_session = session
+                atexit.register(close_http_client)
+    return _http_session
+
+
+def pooled_http_adapter(pool_connections, pool_maxsize):
+    """
+    HTTPAdapter that keeps the request and connection counts of host pools it drops, see http_connection_stats.
+    urllib3 has no public hook for dropped pools, its RecentlyUsedContainer.dispose_func is used when it is there
+    (urllib3 1.x and 2.x, see requirements.txt), else only the counts of open pools are reported.
+    """
+    from requests.adapters import HTTPAdapter
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    pools = getattr(adapter.poolmanager, 'pools', None)
+    if not hasattr(pools, 'dispose_func'):
+        log.debug("urllib3 pools have no dispose_func, counts of dropped pools are not kept.")
+        return adapter
+    dispose_pool = pools.dispose_func
+
+    def retire_pool(pool):
+        _retire_pool_stats(pool)
+        if dispose_pool is not None:
+            dispose_pool(pool)
+        else:  # urllib3 2 leaves dropped pools to the garbage collector.
+            pool.close()
+    pools.dispose_func = retire_pool
+    return adapter
+
+
+def _retire_pool_stats(pool):
+    with _http_pool_lock:
+        _retired_http_stats["requests"] += getattr(pool, 'num_requests', 0)
+        _retired_http_stats["connections"] += getattr(pool, 'num_connections', 0)
+
+
+def ensure_http_pool_size(pool_size=None, session=None):
+    """
+    Makes the shared session keep at least pool_size connections per host, more workers than that would open
+    connections that are thrown away after one request. Pools only grow, the adapter is replaced once when they do.
+    :param pool_size: defaults to program_settings 'http_pool_per_host'.
+    :param session: session to set up, http_session() when not given.
+    """
+    global _http_pool_size
+    if session is None:
+        session = http_session()
+    pool_size = max(int(pool_size or 0), int(program_settings[KEY.http_pool_per_host]))
+    with _http_pool_lock:
+        if pool_size <= _http_pool_size:
+            return
+        _http_pool_size = pool_size
+    adapter = pooled_http_adapter(int(program_settings[KEY.http_pool_hosts]), pool_size)
+    old_adapters = set(session.adapters.values())
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    for old_adapter in old_adapters:
+        old_adapter.close()  # Open connections go, their counts are kept by retire_pool.
+
+
+def http_connection_stats():
+    """
+    Counts of the shared session since the program started, all 0 before it is made.
+    :return: {"requests": n, "new_connections": n, "reused_connections": n}
+    """
+    with _http_pool_lock:
+        requests_sent = _retired_http_stats["requests"]
+        connections = _retired_http_stats["connections"]
+        adapters = set(_http_session.adapters.values()) if _http_session is not None else set()
+    for adapter in adapters:
+        pools = getattr(getattr(adapter, 'poolmanager', None), 'pools', None)
+        # Reading through pools[key] would change their least recently used order, so the container is read
+        # directly under the pools' lock. Skipped if a urllib3 release drops them, the counts are only a report.
+        open_pools_by_key = getattr(pools, '_container', None)
+        pools_lock = getattr(pools, 'lock', None)
+        if open_pools_by_key is None or pools_lock is None:
+            continue
+        with pools_lock:
+            open_pools = list(open_pools_by_key.values())
+        for pool in open_pools:
+            requests_sent += getattr(pool, 'num_requests', 0)
+            connections += getattr(pool, 'num_connections', 0)
+    return {"requests": requests_sent, "new_connections": connections,
+            "reused_connections": max(0, requests_sent - connections)}
+
+
+def close_http_client():
+    """ Closes the shared session and its pools, registered to run at exit once the session is made. """
+    stats = http_connection_stats()
+    log.info("HTTP connections: {0} requests, {1} new connections, {2} reused".format(
+        stats["requests"], stats["new_connections"], stats["reused_connections"]))
+    _http_session.close()
+
+
+def parse_core_arguments(argv=None):
+    """
+    Reads the options the core understands, anything else is left for the front end.
+    :param argv: defaults to sys.argv.
+    :return: argparse namespace with 'debug' and 'verbose'.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description="Download Curse modpack mods", add_help=False)  # --help is the CLI's.
+    parser.add_argument("--debug", action="store_true", dest="debug", help="Run in debugger mode.")
+    parser.add_argument("--verbose", action="store_true", dest="verbose",
+                        help="Outputs standard operation messages to console.")
+    args, unknown = parser.parse_known_args(argv if argv is not None else sys.argv[1:])
+    return args
 
-if args.debug:
-    log_level = "DEBUG"
-elif args.verbose:
-    log_level = "INFO"
-else:
-    log_level = "WARNING"  # Default.
 
-# --- Logger
-logFormatter = logging.Formatter("%(asctime)s[%(threadName)-12.12s][%(levelname)-5.5s][ln:%(lineno)d]%(message)s")
-log = logging.getLogger()
-log.setLevel(log_level)
+def init_logging(debug=None, verbose=None):
+    """
+    Sets the log level and adds the LOG_FILE and console handlers, only the first call does anything.
+    initialize_program_environment calls it, front ends that parse their own options can call it first.
+    :param debug, verbose: taken from parse_core_arguments when not given.
+    """
+    global _logging_initialized
+    if _logging_initialized:
+        return
+    _logging_initialized = True
+    if debug is None or verbose is None:
+        args = parse_core_arguments()
+        debug = args.debug if debug is None else debug
+        verbose = args.verbose if verbose is None else verbose
+    if debug:
+        log_level = "DEBUG"
+    elif verbose:
+        log_level = "INFO"
+    else:
+        log_level = "WARNING"  # Default.
 
-fileHandler = logging.FileHandler(LOG_FILE)
-fileHandler.setFormatter(logFormatter)
-log.addHandler(fileHandler)
+    log_formatter = logging.Formatter(
+        "%(asctime)s[%(threadName)-12.12s][%(levelname)-5.5s][ln:%(lineno)d]%(message)s")
+    log.setLevel(log_level)
+
+    file_handler = logging.FileHandler(LOG_FILE)
+    file_handler.setFormatter(log_formatter)
+    log.addHandler(file_handler)
+
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(log_formatter)
+    log.addHandler(console_handler)
 
-consoleHandler = logging.StreamHandler()
-consoleHandler.setFormatter(logFormatter)
-log.addHandler(consoleHandler)
 
 # # --- Test logger levels.
 # log.critical("critical")  # numeric value 50
@@ -119,9 +307,17 @@ def load_json_file(src_file):
         return json.load(file)
 
 
+def unique_temp_path(path):
+    """ Temporary name next to path that no other process or thread writing path uses. """
+    return "{0}.{1}-{2}.tmp".format(path, os.getpid(), threading.get_ident())
+
+
 def save_json_file(json_configs, dst_file):
-    with open(dst_file, 'w') as file:
+    # Written under a temporary name and renamed over dst_file, so other processes never read half a file.
+    temp_file = unique_temp_path(dst_file)
+    with open(temp_file, 'w') as file:
         json.dump(json_configs, file, indent=4, sort_keys=True)
+    os.replace(temp_file, dst_file)
 
 
 # TODO: Create, save, and load instance settings.
@@ -297,6 +493,9 @@ def copytree_overwrite_dst(m_src, m_dest, m_ignore=None):
                         os.path.join(dest, f),
                         ignore)
         else:
+            if os.path.lexists(dest):
+                # dest may be linked to the mod cache, writing through it would change the cached file.
+                os.remove(dest)
             shutil.copyfile(src, dest)
     _recursive_overwrite(m_src, m_dest, m_ignore)
 
@@ -364,6 +563,143 @@ def get_human_readable(size, precision=2, requestz=-1):
     return str(round(size, precision)) + suffixes[suffix_index]
 
 
+_metrics_lock = threading.Lock()
+_metrics = None  # Run being measured, see measured_run.
+_metrics_depth = 0
+METRICS_COUNTERS = [
+    "cache_hits", "cache_misses", "bytes_saved", "retries", "cursemeta_fallbacks", "resolved_url_hits",
+    "version_pages", "version_list_cache_hits", "version_list_revalidated", "verification_failures",
+    "in_flight_joins", "plan_duplicates", "lock_waits"]
+
+
+def measured_run(operation):
+    """
+    Decorator measuring an entry point. Nested and concurrent measured calls count into the run that is
+    already going, the summary is written when the outermost one returns.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            metrics_begin(operation)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                metrics_end()
+        return wrapper
+    return decorator
+
+
+def metrics_begin(operation):
+    global _metrics, _metrics_depth
+    with _metrics_lock:
+        if _metrics_depth == 0:
+            _metrics = {"operations": [], "started": time.time(), "files": [],
+                        "counters": dict.fromkeys(METRICS_COUNTERS, 0), "http": http_connection_stats()}
+        _metrics_depth += 1
+        _metrics["operations"].append(operation)
+
+
+def metrics_count(counter, amount=1):
+    with _metrics_lock:
+        if _metrics is not None:
+            _metrics["counters"][counter] += amount
+
+
+def metrics_file(file_name, received, wall_time, ttfb=None):
+    """
+    Records one transfer.
+    :param received: bytes downloaded in this run, without what a resumed part already had.
+    :param wall_time: seconds from resolving the download to the file being stored.
+    :param ttfb: seconds from sending the request to the response headers.
+    """
+    with _metrics_lock:
+        if _metrics is not None:
+            _metrics["files"].append({
+                "name": file_name, "bytes": received, "wall_seconds": round(wall_time, 4),
+                "ttfb_seconds": round(ttfb, 4) if ttfb is not None else None,
+                "bytes_per_second": int(received / wall_time) if wall_time > 0 else 0})
+
+
+def _percentile(values, fraction):
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def metrics_summary(run_metrics):
+    wall_time = time.time() - run_metrics["started"]
+    received = sum(file_metrics["bytes"] for file_metrics in run_metrics["files"])
+    ttfbs = sorted(file_metrics["ttfb_seconds"] for file_metrics in run_metrics["files"]
+                   if file_metrics["ttfb_seconds"] is not None)
+    return {
+        "operations": run_metrics["operations"],
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(run_metrics["started"])),
+        "wall_seconds": round(wall_time, 4),
+        "files_downloaded": len(run_metrics["files"]),
+        "bytes_downloaded": received,
+        "bytes_per_second": int(received / wall_time) if wall_time > 0 else 0,
+        "ttfb_seconds": {
+            "mean": round(sum(ttfbs) / len(ttfbs), 4) if ttfbs else None,
+            "p50": _percentile(ttfbs, 0.5) if ttfbs else None,
+            "p95": _percentile(ttfbs, 0.95) if ttfbs else None,
+            "max": ttfbs[-1] if ttfbs else None},
+        "counters": run_metrics["counters"],
+        # Only counts the requests session, the asyncio backend opens its own connections per run.
+        "http_connections": dict((name, value - run_metrics["http"][name])
+                                 for name, value in http_connection_stats().items()),
+        "files": run_metrics["files"]}
+
+
+def write_prometheus_textfile(summary, dst_file):
+    """ Writes the run summary as gauges, replacing dst_file in one step so a scraper never reads half of it. """
+    operation = summary["operations"][0] if summary["operations"] else ""
+    gauges = [
+        ["wall_seconds", summary["wall_seconds"], "Wall time of the last run."],
+        ["files_downloaded", summary["files_downloaded"], "Files downloaded in the last run."],
+        ["bytes_downloaded", summary["bytes_downloaded"], "Bytes downloaded in the last run."],
+        ["bytes_per_second", summary["bytes_per_second"], "Download throughput of the last run."]]
+    for quantile in ("p50", "p95", "max"):
+        if summary["ttfb_seconds"][quantile] is not None:
+            gauges.append(["ttfb_" + quantile + "_seconds", summary["ttfb_seconds"][quantile],
+                           "Time to first byte " + quantile + " of the last run."])
+    for name, value in summary["http_connections"].items():
+        gauges.append(["http_" + name, value, "HTTP " + name.replace("_", " ") + " of the last run."])
+    for counter, value in summary["counters"].items():
+        gauges.append([counter, value, "Number of " + counter.replace("_", " ") + " in the last run."])
+    lines = []
+    for name, value, help_text in gauges:
+        lines.append("# HELP pdm_last_run_{0} {1}".format(name, help_text))
+        lines.append("# TYPE pdm_last_run_{0} gauge".format(name))
+        lines.append('pdm_last_run_{0}{{operation="{1}"}} {2}'.format(name, operation, value))
+    with open(dst_file + ".tmp", 'w') as file_handler:
+        file_handler.write("\n".join(lines) + "\n")
+    os.replace(dst_file + ".tmp", dst_file)
+
+
+def metrics_end():
+    """
+    Ends a measured call, the outermost one writes the summary to program_settings 'metrics_file'
+    and 'metrics_prometheus_file'.
+    :return: the summary dictionary when this ended the run, else None.
+    """
+    global _metrics, _metrics_depth
+    with _metrics_lock:
+        _metrics_depth -= 1
+        if _metrics_depth > 0:
+            return None
+        run_metrics, _metrics = _metrics, None
+    summary = metrics_summary(run_metrics)
+    log.info("Run metrics: {0} files, {1} in {2}s, cache hits: {3}".format(
+        summary["files_downloaded"], get_human_readable(summary["bytes_downloaded"]),
+        summary["wall_seconds"], summary["counters"]["cache_hits"]))
+    try:
+        if program_settings.get(KEY.metrics_file):
+            save_json_file(summary, program_settings[KEY.metrics_file])
+        if program_settings.get(KEY.metrics_prometheus_file):
+            write_prometheus_textfile(summary, program_settings[KEY.metrics_prometheus_file])
+    except OSError as e:
+        log.error("Could not write run metrics: " + str(e))
+    return summary
+
+
 class InstanceInfo:
     source = ''
     project_id = 0
@@ -377,7 +713,6 @@ class InstanceInfo:
     merge_custom = True
 
     instance_path = ''
-    pack_icon_url = ''
     update_version_id = 0
     list_version_id = []
 
@@ -389,13 +724,15 @@ class InstanceInfo:
     current_progress = 0
     return_arg = ''
 
-    def reset_dl(self):
-        self.is_done = False
-        self.file_size = 0
-        self.current_file_size = 0
-        self.total_progress = 0
-        self.current_progress = 0
-        self.return_arg = ''
+    @classmethod
+    def reset_dl(cls):
+        # classmethod so InstanceInfo().reset_dl() resets the shared values instead of a throwaway instance.
+        cls.is_done = False
+        cls.file_size = 0
+        cls.current_file_size = 0
+        cls.total_progress = 0
+        cls.current_progress = 0
+        cls.return_arg = ''
 
     def clear_instance(self):
         self.source = ''
@@ -404,71 +741,571 @@ class InstanceInfo:
         self.version_id = 0
         self.instance_name = ''
         self.instance_path = ''
-        self.pack_icon_url = ''
         self.list_version_id[:] = []
         self.reset_dl()
 
+def collect_update_check_instances():
+    """
+    First update check phase, drops installed instances that are gone and loads the settings of the rest.
+    :return: list of dictionaries with 'location', 'config_path' and 'settings' (the 'instance_settings'),
+        for the instances that have update_check on.
+    """
+    if not os.path.exists(INSTALLED_INSTANCE_FILE):
+        # TODO: Make one at program start if doesn't exist.
+        log.error("No pdm_installed_instances.json found.")
+        return []
+    pack_instance_list = load_json_file(INSTALLED_INSTANCE_FILE)["instances"]
+    log.debug(str(INSTALLED_INSTANCE_FILE))
+    log.debug(str(pack_instance_list))
+    existing_instances = [instance_config for instance_config in pack_instance_list if
+                          os.path.exists(os.path.join(instance_config["location"], PDM_INSTANCE_FOLDER, PDM_INSTANCE_FILE))]
+    if len(existing_instances) != len(pack_instance_list):
+        # FIXME: Do this in a better way to inform the user and give them a chance to fix the path?
+        save_json_file({"instances": existing_instances}, INSTALLED_INSTANCE_FILE)
+    instances = []
+    for instance_config in existing_instances:
+        config_path = os.path.join(instance_config["location"], PDM_INSTANCE_FOLDER, PDM_INSTANCE_FILE)
+        instance_settings = load_json_file(config_path)["instance_settings"]
+        if instance_settings["update_check"]:
+            instances.append({
+                "location": instance_config["location"],
+                "config_path": config_path,
+                "settings": instance_settings})
+    return instances
+
+
+def latest_pack_version(version_list, update_type):
+    """
+    :param version_list: rows from get_modpack_version_list, newest first.
+    :param update_type: newest channel to accept, 1=release, 2=beta, 3=alpha. Anything else accepts all.
+    :return: newest [type, file_id, title] in the channel, or None.
+    """
+    if update_type not in (1, 2, 3):
+        update_type = 3
+    for version_row in version_list:
+        if version_row[0] <= update_type:
+            return version_row
+    return None
+
+
+@measured_run("check_instance_updates")
+def check_instance_updates(instances=None, max_workers=None):
+    """
+    Second update check phase, every project is looked up once for all the instances that use it,
+    the projects concurrently.
+    :param instances: from collect_update_check_instances, collected when not given.
+    :param max_workers: projects looked up at once. Defaults to program_settings 'download_threads'.
+    :return: list of dictionaries, one per instance, with 'instance' (the collect_update_check_instances entry),
+        'current' installed file id, 'channel' update_type, 'latest' [type, file_id, title] or None,
+        'version_list' (get_modpack_version_list result), 'update_available' and 'error' ('' if none).
+    """
+    if instances is None:
+        instances = collect_update_check_instances()
+    if max_workers is None:
+        max_workers = program_settings[KEY.download_threads]
+    projects = {}
+    for instance in instances:
+        project_identifier = normalize_project_identifier(instance["settings"]["project_name"])
+        projects.setdefault(project_identifier, []).append(instance)
+
+    def _check_project(project_identifier):
+        # Read the listing down to the oldest version installed, every instance of the project finds its own.
+        oldest_version_id = min(int(instance["settings"]["version_id"]) for instance in projects[project_identifier])
+        return get_modpack_version_list(project_identifier, oldest_version_id)
+
+    version_lists = {}
+    errors = {}
+    with ThreadPoolExecutor(max_workers=max(1, int(max_workers))) as executor:
+        pending = {executor.submit(_check_project, project_identifier): project_identifier
+                   for project_identifier in projects}
+        for future in as_completed(pending):
+            try:
+                version_lists[pending[future]] = future.result()
+            except OSError as e:  # requests.RequestException and ConnectionError are both OSErrors.
+                log.error("Update check failed for " + pending[future] + ": " + str(e))
+                errors[pending[future]] = str(e)
+
+    results = []
+    for instance in instances:
+        project_identifier = normalize_project_identifier(instance["settings"]["project_name"])
+        version_list = version_lists.get(project_identifier, ['', 0, '', [], ''])
+        channel = instance["settings"].get("update_type")
+        latest = latest_pack_version(version_list[3], channel)
+        error = errors.get(project_identifier, '')
+        if not error and latest is None:
+            error = "No versions found for project: " + instance["settings"]["project_name"]
+        results.append({
+            "instance": instance,
+            "current": instance["settings"]["version_id"],
+            "channel": channel,
+            "latest": latest,
+            "version_list": version_list,
+            "update_available": latest is not None and int(latest[1]) > int(instance["settings"]["version_id"]),
+            "error": error})
+    return results
+
+
+def update_instance(update_result):
+    """
+    Installs the latest version found by check_instance_updates into the instance.
+    The new version is only recorded once all its mods are in place, so a failed update is found again
+    by the next update check.
+    :param update_result: one entry of the check_instance_updates result with update_available set,
+        'error' is set on it if the update failed.
+    :return: True if the instance was updated.
+    """
+    instance_dir = unpack_instance_update(update_result)
+    failed = update_mods(instance_dir, install_type=update_result["instance"]["settings"]['install_type'])
+    if failed is None:
+        update_result["error"] = "Instance manifest.json is not usable."
+        return False
+    if failed:
+        update_result["error"] = failed_downloads_message(failed)
+        return False
+    finish_instance_update(update_result)
+    return True
+
+
+def unpack_instance_update(update_result):
+    """
+    Unpacks the latest pack version over the instance, the mods are not touched yet.
+    :return: the instance directory.
+    """
+    instance = update_result["instance"]
+    version_list = update_result["version_list"]
+    instance_dir = os.path.dirname(os.path.dirname(instance["config_path"]))
+    src_zip = download_modpack_zip(version_list[0], version_list[1], version_list[2], update_result["latest"][1],
+                                   version_list[4])
+
+    # The previous manifest stays in pdm_instance so only changed mods are touched.
+    install_type = instance["settings"]['install_type']
+    unpack_modpack_zip(src_zip, os.path.basename(instance_dir), os.path.dirname(instance_dir), install_type)
+    return instance_dir
+
+
+def finish_instance_update(update_result):
+    """
+    Records the new version in the instance settings once its mods are updated.
+    """
+    instance = update_result["instance"]
+    instance_dir = os.path.dirname(os.path.dirname(instance["config_path"]))
+    instance_settings = {"instance_settings": instance["settings"]}
+    install_type = instance["settings"]['install_type']
+    instance["settings"]["version_id"] = update_result["latest"][1]  # update version id.
+    if 'mmc' in install_type:
+        mmc_file_contents = mmc_read_cfg(instance_dir)
+        if mmc_write_cfg(mmc_file_contents, instance_dir):
+            print("MultiMC settings Saved.")
+        else:
+            raise RuntimeError("MultiMC settings file save failed to execute correctly.")
+    save_json_file(instance_settings, instance["config_path"])
+
+
+@measured_run("instance_update_check")
 def instance_update_check():
-    # FIXME: redo this to use internal copy instead of loading file every time.
-    # TODO: Change to 2 functions, on that supplies list to check to the seond that does the check of each instances passed.
-    # TODO: Some kind of project specific update check cache,
-    #   to prevent checking same project multiple times within short time frame.
-    # Store as dictionary key of project ID, storing version information and pass that on to the update check.
-    if os.path.exists(INSTALLED_INSTANCE_FILE):
-        pack_instance_list = load_json_file(INSTALLED_INSTANCE_FILE)["instances"]
-        log.debug(str(INSTALLED_INSTANCE_FILE))
-        log.debug(str(pack_instance_list))
-        if pack_instance_list:
-            pack_instance_list[:] = [instance_config for instance_config in pack_instance_list if
-                                     os.path.exists(os.path.join(instance_config["location"], PDM_INSTANCE_FOLDER, PDM_INSTANCE_FILE))]
-            if pack_instance_list:
-                save_json_file({"instances": pack_instance_list}, INSTALLED_INSTANCE_FILE)  # FIXME: Do this in a better way to inform the user and give them a chance to fix the path?
-                for instance_config in pack_instance_list:
-                    instance_config = os.path.join(instance_config["location"], PDM_INSTANCE_FOLDER, PDM_INSTANCE_FILE)
-                    if os.path.exists(instance_config):  # If config file exist.
-                        instance_settings = load_json_file(instance_config)
-                        if not instance_settings["instance_settings"]["update_check"]:
-                            continue
-                        request_results = get_modpack_version_list(instance_settings["instance_settings"]["project_name"])
-                        # results <- [pack_source, project_id, project_name, bare_pack_version_list]
-                        print("Instance Name: " + instance_settings["instance_settings"]["instance_name"])
-                        log.debug(
-                            "Local Version: " + str(instance_settings["instance_settings"]["version_id"]) +
-                            "\nRemote Version: " + str(request_results[3][0][1]))
-                        if int(request_results[3][0][1]) == int(instance_settings["instance_settings"]["version_id"]):
-                            print("Same Version")
-                        elif int(request_results[3][0][1]) > int(instance_settings["instance_settings"]["version_id"]):
-                            print("New Version Found")
-                            if instance_settings["instance_settings"]["update_automatic"]:
-                                dst_dir = os.path.dirname(os.path.dirname(instance_config))
-                                dst_folder_name = os.path.basename(os.path.dirname(instance_config))
-                                src_zip = download_modpack_zip(request_results[0], request_results[1],
-                                                                          request_results[2],
-                                                                          request_results[3][0][1])
-
-                                # TODO: copy old manifest to safety for use in update comparision of mods???.
-                                unpack_modpack_zip(src_zip, dst_folder_name, (dst_dir + "\\"))
-                                download_mods(os.path.join(dst_dir, dst_folder_name))
-                                instance_settings["instance_settings"]["version_id"] = request_results[3][0][1]  # update version id.
-                                if 'mmc' in instance_settings['instance_settings']['install_type']:
-                                    mmc_file_contents = mmc_read_cfg(dst_dir)
-                                    if mmc_write_cfg(mmc_file_contents, dst_dir):
-                                        print("MultiMC settings Saved.")
-                                    else:
-                                        raise RuntimeError("MultiMC settings file save failed to execute correctly.")
-                                save_json_file(instance_settings, instance_config)
-                        else:
-                            print("idk how but you got a newer version then is available?")
-                    else:
-                        # TODO handle bad instance paths and remove them?.
-                        print("instance not found at this path:")
-                        print(instance_config)
-                        pass
+    """
+    Checks every installed instance for updates and installs them where update_automatic is on.
+    :return: check_instance_updates results.
+    """
+    instances = collect_update_check_instances()
+    if not instances:
+        print("No instances seam to exist right now.")
+        return []
+    results = check_instance_updates(instances)
+    for update_result in results:
+        print("Instance Name: " + update_result["instance"]["settings"]["instance_name"])
+        if update_result["error"]:
+            print(update_result["error"])
+            continue
+        log.debug(
+            "Local Version: " + str(update_result["current"]) +
+            "\nRemote Version: " + str(update_result["latest"][1]))
+        if not update_result["update_available"]:
+            print("Same Version")
+            continue
+        print("New Version Found")
+        if update_result["instance"]["settings"]["update_automatic"] and not update_instance(update_result):
+            print("Update failed: " + update_result["error"])
+    return results
+
+
+def update_instances(instance_dirs=None):
+    """
+    Installs the latest version into every given instance that has one, update_automatic is not asked.
+    :param instance_dirs: instance directories to update, every installed instance with update_check on when None.
+    :return: check_instance_updates results, 'updated' set on each and 'error' set if updating failed.
+    """
+    instances = collect_update_check_instances()
+    if instance_dirs is not None:
+        wanted = set(os.path.normcase(os.path.abspath(instance_dir)) for instance_dir in instance_dirs)
+        instances = [instance for instance in instances
+                     if os.path.normcase(os.path.abspath(instance["location"])) in wanted]
+    results = check_instance_updates(instances)
+    scheduler = InstallScheduler()
+    for update_result in results:
+        update_result["updated"] = False
+        if not update_result["error"] and update_result["update_available"]:
+            scheduler.add_update(update_result)
+    # The instances share one download plan, mods common to several updates are fetched once.
+    scheduler.run()
+    return results
+
+
+def finish_instance_install(instance_dir):
+    """
+    Last install steps once the mods are in place, for the pack described by InstanceInfo:
+    puts the user's own configs and mods from pdm_instance back, sets up MultiMC and registers the instance.
+    """
+    game_dir = instance_game_dir(instance_dir, InstanceInfo.install_type)
+    if InstanceInfo.merge_custom:
+        for custom_folder in ('config', 'mods'):
+            custom_path = os.path.normpath(os.path.join(instance_dir, PDM_INSTANCE_FOLDER, custom_folder))
+            if os.path.exists(custom_path):
+                copytree_overwrite_dst(custom_path, os.path.normpath(os.path.join(game_dir, custom_folder)))
+
+    if InstanceInfo.install_type == 'mmc':
+        pack_icon = os.path.join(MODPACK_ZIP_CACHE, str(InstanceInfo.project_id), 'pack_icon.png')
+        mmc_icon = os.path.join(program_settings['MultiMC'], 'icons', InstanceInfo.project_name + '_icon.png')
+        if os.path.exists(pack_icon) and not os.path.exists(mmc_icon):
+            shutil.copy(pack_icon, mmc_icon)
+        mmc_cfg_contents = mmc_read_cfg(instance_dir)
+        if not mmc_write_cfg(mmc_cfg_contents, instance_dir):
+            raise RuntimeError("MultiMC settings file save failed to execute correctly.")
+
+    save_instance_settings(instance_dir)
+    if not {"location": instance_dir} in installed_instances:
+        installed_instances.append({"location": instance_dir})
+        save_json_file({"instances": installed_instances}, INSTALLED_INSTANCE_FILE)
+
+
+def prepare_modpack_install(project_identifier, dst_dir, file_id=None, instance_name=None, install_type='custom',
+                            update_type=1, update_check=True, update_automatic=False):
+    """
+    First install_modpack steps, leaves the pack extracted into the instance with its settings saved
+    and InstanceInfo describing it, the mods are not fetched yet.
+    :return: install_modpack result dictionary, 'error' is set if the pack could not be set up.
+    """
+    result = {"project": project_identifier, "instance": '', "file_id": file_id, "error": ''}
+    pack_source, project_id, project_name, version_list, pack_icon_url = \
+        get_modpack_version_list(project_identifier, file_id)
+    if not pack_source:
+        result["error"] = "Project not found: " + str(project_identifier)
+        return result
+    if file_id is None:
+        latest = latest_pack_version(version_list, update_type)
+        if latest is None:
+            result["error"] = "No versions found for project: " + project_name
+            return result
+        file_id = latest[1]
+    result["file_id"] = file_id = str(file_id)
+
+    InstanceInfo().clear_instance()
+    InstanceInfo.source = pack_source
+    InstanceInfo.project_id = project_id
+    InstanceInfo.project_name = project_name
+    InstanceInfo.version_id = file_id
+    InstanceInfo.instance_name = instance_name or project_name
+    InstanceInfo.install_type = install_type
+    InstanceInfo.update_type = update_type
+    InstanceInfo.update_check = update_check
+    InstanceInfo.update_automatic = update_automatic
+    InstanceInfo.instance_path = result["instance"] = os.path.normpath(
+        os.path.abspath(os.path.join(dst_dir, InstanceInfo.instance_name)))
+
+    src_zip = download_modpack_zip(pack_source, project_id, project_name, file_id, pack_icon_url)
+    if not src_zip:
+        result["error"] = "Pack download failed: " + project_name + " " + file_id
+        return result
+    extract_modpack_zip(src_zip, InstanceInfo.instance_path, install_type)
+    save_instance_settings(InstanceInfo.instance_path)
+    return result
+
+
+def install_modpack(project_identifier, dst_dir, file_id=None, instance_name=None, install_type='custom',
+                    update_type=1, update_check=True, update_automatic=False):
+    """
+    Installs a pack version in one call, the steps the GUI walks through one window at a time.
+    :param project_identifier: curseforge project name, id or url.
+    :param dst_dir: directory the instance folder is made in.
+    :param file_id: version to install, the newest in the update_type channel when not given.
+    :param instance_name: instance folder name, defaults to the project name.
+    :param install_type: 'custom', 'mmc' or 'curse'.
+    :param update_type: update channel, 1=release, 2=beta, 3=alpha.
+    :return: dictionary with 'project', 'instance' path, 'file_id' and 'error' ('' on success).
+    """
+    result = prepare_modpack_install(project_identifier, dst_dir, file_id, instance_name, install_type,
+                                     update_type, update_check, update_automatic)
+    if result["error"]:
+        return result
+    failed = download_mods(InstanceInfo.instance_path, install_type=install_type)
+    if failed is None:
+        result["error"] = "Instance manifest.json is not usable."
+        return result
+    finish_instance_install(InstanceInfo.instance_path)
+    if failed:
+        # Installed without them, like the batch installs, the next install or update fetches them again.
+        result["error"] = failed_downloads_message(failed)
+    return result
+
+
+def merge_download_plan(dependency_lists):
+    """
+    Merges the dependencies of several manifests into one download plan, repeats count as plan_duplicates.
+    :param dependency_lists: lists of manifest 'files' entries.
+    :return: list with every (projectID, fileID) once, in the order first listed.
+    """
+    plan = []
+    planned_keys = set()  # Kept apart from plan, dicts only keep their order from python 3.6 on.
+    for dependencies in dependency_lists:
+        for dependency in dependencies:
+            key = mod_cache_key(dependency['projectID'], dependency['fileID'])
+            if key in planned_keys:
+                metrics_count("plan_duplicates")
+            else:
+                planned_keys.add(key)
+                plan.append(dependency)
+    return plan
+
+
+class InstallScheduler:
+    """
+    Installs and updates several instances as one batch.
+    The packs are set up one after the other, then the mods of every instance are merged into one
+    download plan where each (projectID, fileID) is fetched once and linked into every instance listing it.
+    """
+
+    def __init__(self):
+        self.jobs = []
+
+    def add_install(self, project_identifier, dst_dir, file_id=None, instance_name=None, install_type='custom',
+                    update_type=1, update_check=True, update_automatic=False):
+        """
+        Queues an install_modpack.
+        :return: the result dictionary of the install, filled in by run.
+        """
+        job = {"install": (project_identifier, dst_dir, file_id, instance_name, install_type,
+                           update_type, update_check, update_automatic),
+               "result": {"project": project_identifier, "instance": '', "file_id": file_id, "error": ''}}
+        self.jobs.append(job)
+        return job["result"]
+
+    def add_update(self, update_result):
+        """
+        Queues an update_instance.
+        :param update_result: one entry of the check_instance_updates result with update_available set,
+            'updated' and 'error' are set on it by run.
+        """
+        update_result["updated"] = False
+        self.jobs.append({"update": update_result, "result": update_result})
+        return update_result
+
+    def _prepare_job(self, job):
+        """
+        Sets the pack of a job up and plans its mods, sets job 'instance_dir', 'to_fetch' and 'installed_mods'.
+        :return: False with the job result 'error' set if the job can not go on.
+        """
+        if "install" in job:
+            job["result"].update(prepare_modpack_install(*job["install"]))
+            if job["result"]["error"]:
+                return False
+            job["instance_dir"] = job["result"]["instance"]
+            install_type = job["install"][4]
+        else:
+            job["instance_dir"] = unpack_instance_update(job["update"])
+            install_type = job["update"]["instance"]["settings"]['install_type']
+        manifest_json, job["mods_path"] = prepare_mod_install(job["instance_dir"], install_type)
+        if manifest_json is None:
+            job["result"]["error"] = "Instance manifest.json is not usable."
+            return False
+        job["to_fetch"], job["installed_mods"] = plan_mod_update(job["instance_dir"], manifest_json, job["mods_path"])
+        return True
+
+    def _finish_job(self, job):
+        """
+        Links the planned mods of a job out of the cache and runs its last install or update steps.
+        Planned files that failed to download set the job result 'error', the instance is finished without them.
+        """
+        cache_entries_found = lookup_cache_entries("mod", job["to_fetch"])
+        missing = 0
+        failed = []
+        for dependency in job["to_fetch"]:
+            key = mod_cache_key(dependency['projectID'], dependency['fileID'])
+            cached_file = None
+            if key in cache_entries_found:
+                cached_file = cached_mod_file(dependency, cache_entries_found[key])
+            if cached_file is None:
+                missing += 1
+                if not known_missing_file(dependency):
+                    failed.append(dependency)
+                continue
+            job["installed_mods"][key] = install_cached_mod(cached_file[0], cached_file[1], job["mods_path"])
+        save_installed_state(job["instance_dir"], job["installed_mods"])
+        record_failed_downloads(job["instance_dir"], failed)
+        job["result"]["mods"] = len(job["installed_mods"])
+        job["result"]["missing"] = missing
+        if failed:
+            job["result"]["error"] = failed_downloads_message(failed)
+        if "install" in job:
+            load_instance_settings(job["instance_dir"])
+            finish_instance_install(job["instance_dir"])
         else:
-            print("No instances seam to exist right now.")
+            finish_instance_update(job["update"])
+            job["result"]["updated"] = True
+
+    @measured_run("install_scheduler")
+    def run(self, max_workers=None, max_per_host=None):
+        """
+        Runs every queued job, a job that fails is reported in its result and does not stop the others.
+        :param max_workers: see fetch_dependencies.
+        :param max_per_host: see fetch_dependencies.
+        :return: the job result dictionaries, in the order they were added.
+        """
+        InstanceInfo.is_done = False
+        InstanceInfo().reset_dl()
+        ready = []
+        for job in self.jobs:
+            try:
+                if self._prepare_job(job):
+                    ready.append(job)
+            except (OSError, RuntimeError) as e:  # requests.RequestException is an OSError.
+                log.error("Preparing " + str(job["result"].get("project", job["result"].get("instance"))) +
+                          " failed: " + str(e))
+                job["result"]["error"] = str(e)
+
+        plan = merge_download_plan([job["to_fetch"] for job in ready])
+        log.info("Download plan: {0} files for {1} instances".format(len(plan), len(ready)))
+        try:
+            emit_progress(EVENT.phase, PHASE.mods, total=len(plan))
+            # Fill the cache once for everyone, each instance links its own files after.
+            fetch_dependencies(plan, None, max_workers, max_per_host)
+        except (OSError, RuntimeError) as e:
+            # Failed downloads of single files are in the job results already, this stopped the whole plan.
+            log.error("Download plan failed: " + str(e))
+            for job in ready:
+                job["result"]["error"] = str(e)
+            ready = []
+        except BaseException as e:
+            InstanceInfo.is_done = True
+            emit_progress(EVENT.phase, PHASE.failed, message=str(e) or type(e).__name__)
+            raise e
+
+        for job in ready:
+            try:
+                self._finish_job(job)
+            except (OSError, RuntimeError) as e:
+                log.error("Finishing " + job["instance_dir"] + " failed: " + str(e))
+                job["result"]["error"] = str(e)
+        enforce_cache_budget()
+        InstanceInfo.is_done = True
+        emit_progress(EVENT.phase, PHASE.done)
+        return [job["result"] for job in self.jobs]
+
+
+def read_zip_manifest(path_to_zip_file):
+    """
+    :return: the manifest.json of a pack zip as a dictionary, None if it has none.
+    """
+    with zipfile.ZipFile(path_to_zip_file, "r") as zip_ref:
+        if 'manifest.json' not in zip_ref.namelist():
+            return None
+        return json.loads(zip_ref.read('manifest.json').decode('utf-8'))
+
+
+def prefetch_modpack(project_identifier, file_id=None, update_type=1):
+    """
+    Downloads a pack version and its mods into the cache without installing them anywhere,
+    so later installs of it need no network. See prefetch.
+    :param file_id: version to fetch, the newest in the update_type channel when not given.
+    :return: dictionary with 'project', 'file_id', 'mods' (files in the cache), 'missing' and 'error'.
+    """
+    return prefetch([(project_identifier, file_id)], update_type)[0]
+
+
+def read_prefetch_source(source, update_type=1):
+    """
+    Finds the manifest of one prefetch source, a pack version is downloaded into the cache for it.
+    :param source: see prefetch.
+    :return: [result, manifest_json] manifest_json is None and result 'error' set if there is no usable manifest.
+    """
+    if isinstance(source, str):
+        result = {"source": source, "mods": 0, "missing": 0, "error": ''}
+        manifest_path = source
     else:
-        # TODO: Make one at program start if doesn't exist.
-        log.error("No pdm_installed_instances.json found.")
+        result = {"project": source[0], "file_id": source[1], "mods": 0, "missing": 0, "error": ''}
+    try:
+        if not isinstance(source, str):
+            manifest_path = download_prefetch_pack(result, update_type)
+            if not manifest_path:
+                return [result, None]
+        if zipfile.is_zipfile(manifest_path):
+            manifest_json = read_zip_manifest(manifest_path)
+        else:
+            manifest_json = load_json_file(manifest_path)
+    except (OSError, ValueError) as e:  # requests.RequestException is an OSError.
+        if isinstance(source, str):
+            result["error"] = "Can not read " + source + ": " + str(e)
+        else:
+            result["error"] = "Can not fetch " + str(result["project"]) + ": " + str(e)
+        return [result, None]
+    if not isinstance(manifest_json, dict) or not isinstance(manifest_json.get('files'), list):
+        result["error"] = "No usable manifest.json in: " + manifest_path
+        return [result, None]
+    return [result, manifest_json]
+
+
+def download_prefetch_pack(result, update_type):
+    """
+    Downloads the pack zip of a prefetch result with 'project' and 'file_id' into the cache,
+    'file_id' is set to the version picked.
+    :return: path of the cached zip, or '' with result 'error' set.
+    """
+    project_identifier, file_id = result["project"], result["file_id"]
+    pack_source, project_id, project_name, version_list, pack_icon_url = \
+        get_modpack_version_list(project_identifier, file_id)
+    if not pack_source:
+        result["error"] = "Project not found: " + str(project_identifier)
+        return ''
+    if file_id is None:
+        latest = latest_pack_version(version_list, update_type)
+        if latest is None:
+            result["error"] = "No versions found for project: " + project_name
+            return ''
+        file_id = latest[1]
+    result["file_id"] = file_id = str(file_id)
+    src_zip = download_modpack_zip(pack_source, project_id, project_name, file_id, pack_icon_url)
+    if not src_zip:
+        result["error"] = "Pack download failed: " + project_name + " " + file_id
+    return src_zip
+
+
+@measured_run("prefetch")
+def prefetch(sources, update_type=1, max_workers=None, max_per_host=None):
+    """
+    Fills the cache for several sources as one batch without extracting anything or making an instance,
+    e.g. to warm the cache of a build image so later installs are all cache hits.
+    The pack zips are downloaded first, their manifests name the mods. Then the mods of every source go into
+    one download plan fetched concurrently, a mod listed by several sources is downloaded once.
+    :param sources: list of manifest.json paths, pack zip paths and (project_identifier, file_id) pairs,
+        file_id None for the newest version in the update_type channel.
+    :param max_workers: see fetch_dependencies.
+    :param max_per_host: see fetch_dependencies.
+    :return: one dictionary per source with 'mods' (files in the cache), 'missing' and 'error', plus 'source' for
+        paths or 'project' and 'file_id' for pack versions.
+    """
+    prefetched = [read_prefetch_source(source, update_type) for source in sources]
+    plan = merge_download_plan([manifest_json['files'] for result, manifest_json in prefetched if manifest_json])
+    log.info("Prefetch plan: {0} files for {1} sources".format(len(plan), len(sources)))
+    emit_progress(EVENT.phase, PHASE.mods, total=len(plan))
+    cached_mods = fetch_dependencies(plan, None, max_workers, max_per_host)
+    for result, manifest_json in prefetched:
+        for dependency in manifest_json['files'] if manifest_json else []:
+            if mod_cache_key(dependency['projectID'], dependency['fileID']) in cached_mods:
+                result["mods"] += 1
+            else:
+                result["missing"] += 1
+    enforce_cache_budget()
+    emit_progress(EVENT.phase, PHASE.done)
+    return [result for result, manifest_json in prefetched]
 
 
 def unzip(path_to_zip_file, dst_dir=None):
@@ -513,126 +1350,773 @@ def copy_instance(existing_instance_dir, new_copy_dir, sym_links=True):
     shutil.copytree(src=existing_instance_dir, dst=new_copy_dir, symlinks=sym_links)
 
 
-def get_modpack_version_list(project_identifier):
+def normalize_project_identifier(project_identifier):
+    """
+    :param project_identifier: curseforge project name as typed by the user.
+    :return: url safe project name, or '' if it can't be used.
+    """
+    if type(project_identifier) is str:
+        return project_identifier.strip().replace(" ", "-").replace(".", "-").lower()
+    return ''
+
+
+def project_files_url(pack_source, project_identifier, page=1):
+    """
+    :param pack_source: which site it comes from ['curseforge','ftb']
+    :param project_identifier: normalized project name.
+    :param page: files list page number, page 1 has no page query.
+    """
+    if pack_source == 'ftb':
+        url = FTB_URL + "/projects/" + project_identifier + "/files"
+    else:
+        url = CURSEFORGE_URL + "/projects/" + project_identifier + "/files"
+    if page > 1:
+        url += "/?page=" + str(page)
+    return url
+
+
+def response_encoding(headers):
+    """
+    :return: charset from the content-type header, utf-8 if it is missing or unknown.
+    """
+    charset = re.search(r'charset=([\w-]+)', headers.get('content-type', ''))
+    if charset:
+        try:
+            return codecs.lookup(charset.group(1)).name
+        except LookupError:
+            pass
+    return 'utf-8'
+
+
+class VersionPageParser(HTMLParser):
+    """
+    Collects file rows from a project files page while it is being downloaded.
+    Feed it the body with feed_bytes, a row is added to self.rows as soon as its </tr> arrives.
+    Rows are [type(1=release, 2=beta, 3=alpha), file_id, title].
+    """
+    release_types = {"release": 1, "beta": 2, "alpha": 3}
+
+    def __init__(self, first_page=False, known_file_id=None, encoding='utf-8'):
+        """
+        :param first_page: only the first page holds the pack icon and the modpack category link.
+        :param known_file_id: reached_known_file is set once the row of this file is parsed.
+        """
+        HTMLParser.__init__(self)
+        self._decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        self.first_page = first_page
+        self.known_file_id = str(known_file_id) if known_file_id else None
+        self.is_modpack = not first_page
+        self.reached_known_file = False
+        self.page_count = 1
+        self.project_id = ''
+        self.pack_icon_url = ''
+        self.rows = []
+        self._row = None
+        self._title_parts = None
+
+    def feed_bytes(self, chunk):
+        self.feed(self._decoder.decode(chunk))
+
+    def finish(self):
+        self.feed(self._decoder.decode(b'', final=True))
+        self.close()
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        classes = (attrs.get('class') or '').split()
+        href = attrs.get('href') or ''
+        if tag == 'a':
+            for page_number in re.findall(r'[?&]page=(\d+)', href):
+                self.page_count = max(self.page_count, int(page_number))
+            if self.first_page:
+                if 'e-avatar64' in classes and not self.pack_icon_url:
+                    self.pack_icon_url = href
+                if urlparse(href).path.rstrip('/') == '/modpacks':
+                    self.is_modpack = True
+
+        if tag == 'tr' and 'project-file-list-item' in classes:
+            self._row = [0, '', '']
+        elif self._row is None:
+            return
+        elif tag == 'div':
+            for class_name in classes:
+                if class_name.endswith('-phase') and class_name[:-len('-phase')] in self.release_types:
+                    self._row[0] = self.release_types[class_name[:-len('-phase')]]
+        elif tag == 'a' and not self._row[1]:
+            file_link = re.search(r'/files/(\d+)/?$', href)  # Not the /files/<id>/download button.
+            if file_link:
+                self._row[1] = file_link.group(1)
+                self._title_parts = []
+                if not self.project_id:
+                    self.project_id = attrs.get('data-id') or ''
+
+    def handle_data(self, data):
+        if self._title_parts is not None:
+            self._title_parts.append(data)
+
+    def handle_endtag(self, tag):
+        if tag == 'a' and self._title_parts is not None:
+            self._row[2] = ''.join(self._title_parts).strip()
+            self._title_parts = None
+        elif tag == 'tr' and self._row is not None:
+            if self._row[0] and self._row[1]:
+                self.rows.append(self._row)
+                if self._row[1] == self.known_file_id:
+                    self.reached_known_file = True
+            self._row = None
+
+
+def read_version_page(url, first_page=False, known_file_id=None, request_headers=None):
+    """
+    Streams a project files page through VersionPageParser, reading stops once known_file_id is parsed.
+    :param request_headers: extra headers, e.g. from version_list_revalidation_headers.
+    :return: [status_code, final url, parser, response headers]
+    """
+    metrics_count("version_pages")
+    response = http_session().get(url, stream=True, headers=request_headers)
+    parser = VersionPageParser(first_page, known_file_id, response_encoding(response.headers))
+    try:
+        if response.status_code == 200:
+            for chunk in response.iter_content(chunk_size=16 * 1024):
+                parser.feed_bytes(chunk)
+                if parser.reached_known_file:
+                    break
+            parser.finish()
+    finally:
+        response.close()
+    return [response.status_code, response.url, parser, response.headers]
+
+
+def read_version_sub_pages(pack_source, project_identifier, page_count, known_file_id=None, max_workers=None):
+    """
+    Requests pages 2..page_count all at once. The pagination only links nearby pages,
+    pages past page_count found on the way are requested in a next round.
+    :param max_workers: pages requested at once. Defaults to program_settings 'download_threads'.
+    :return: file rows of the sub pages in page order, up to the page holding known_file_id.
+    """
+    if max_workers is None:
+        max_workers = program_settings[KEY.download_threads]
+    max_workers = max(1, int(max_workers))
+    ensure_http_pool_size(max_workers)
+    rows = []
+    next_page = 2
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while next_page <= page_count:
+            pages = executor.map(
+                lambda page: read_version_page(
+                    project_files_url(pack_source, project_identifier, page), known_file_id=known_file_id),
+                range(next_page, page_count + 1))
+            next_page = page_count + 1
+            for status_code, url, parser, response_headers in pages:
+                log.debug("URL: " + url)
+                if status_code != 200:
+                    raise ConnectionError("URL request failed sub page request: " + url)
+                rows.extend(parser.rows)
+                if parser.reached_known_file:
+                    return rows
+                page_count = max(page_count, parser.page_count)
+    return rows
+
+
+def build_version_list(pack_source, project_id, project_name, rows, known_file_id=None, pack_icon_url=''):
+    """
+    :param rows: file rows of every page read, in page order. Files listed twice,
+        when the listing shifted between page requests, are only kept the first time.
+    :param known_file_id: rows after this file are older and left out.
+    :return: [pack_source, project_id, project_name, version_list[0=type,1=id,2=title]]
+    """
+    bare_pack_version_list = []  # bare_pack_version_list[<VersionType>, <FileID>, <VersionTitle>]
+    seen_file_ids = set()
+    log.debug("Project Name: " + str(project_name))
+    for row in rows:
+        if row[1] in seen_file_ids:
+            continue
+        seen_file_ids.add(row[1])
+        bare_pack_version_list.append(row)
+        if known_file_id and row[1] == str(known_file_id):
+            break
+
+    log.debug(str(bare_pack_version_list))
+    return [pack_source, project_id, project_name, bare_pack_version_list, pack_icon_url]
+
+
+def cached_version_list(project_identifier, known_file_id=None):
+    """
+    :param known_file_id: a list that was cut short is only usable if it reaches this file.
+    :return: dictionary of the version_lists row with 'version_rows' decoded, or None if there is no usable one.
+    """
+    with _cache_db_lock:
+        row = cache_db().execute(
+            "SELECT * FROM version_lists WHERE project_identifier = ?", (project_identifier,)).fetchone()
+    if row is None:
+        return None
+    cached = dict(row)
+    cached["version_rows"] = json.loads(cached["version_rows"])
+    if not cached["complete"] and str(known_file_id) not in [version_row[1] for version_row in cached["version_rows"]]:
+        return None
+    return cached
+
+
+def version_list_is_fresh(cached):
+    return time.time() - cached["fetched_at"] < float(program_settings[KEY.version_list_ttl_minutes]) * 60
+
+
+def version_list_revalidation_headers(cached):
+    """
+    :return: If-None-Match / If-Modified-Since headers for the first page of a cached list.
+    """
+    request_headers = {}
+    if cached is not None:
+        if cached["etag"]:
+            request_headers['If-None-Match'] = cached["etag"]
+        if cached["last_modified"]:
+            request_headers['If-Modified-Since'] = cached["last_modified"]
+    return request_headers
+
+
+def version_list_from_cache(cached, known_file_id=None, revalidated=False):
+    """
+    :param revalidated: the server answered 304, the list counts as fetched now.
+    :return: same as get_modpack_version_list.
+    """
+    if revalidated:
+        metrics_count("version_list_revalidated")
+        with _cache_db_lock:
+            cache_db().execute("UPDATE version_lists SET fetched_at = ? WHERE project_identifier = ?",
+                               (time.time(), cached["project_identifier"]))
+    else:
+        metrics_count("version_list_cache_hits")
+    return build_version_list(cached["pack_source"], cached["project_id"], cached["project_name"],
+                              cached["version_rows"], known_file_id, cached["pack_icon_url"] or '')
+
+
+def store_version_list(project_identifier, pack_source, url, first_parser, rows, response_headers,
+                       known_file_id=None, cached=None):
+    """
+    Records a fetched list, joined with the cached one when reading stopped at its newest file.
+    :param first_parser: parser of the first page.
+    :param rows: file rows of every page read.
+    :param response_headers: headers of the first page, holding its ETag / Last-Modified.
+    :return: same as get_modpack_version_list.
     """
+    project_name = url.split("/")[-2:-1][0]  # strip down to project name.
+    file_ids = set(row[1] for row in rows)
+    if cached is not None and cached["version_rows"] and cached["version_rows"][0][1] in file_ids:
+        rows = rows + cached["version_rows"]
+        complete = cached["complete"]
+    else:
+        complete = not known_file_id or str(known_file_id) not in file_ids
+    version_list = build_version_list(pack_source, first_parser.project_id, project_name, rows)
+    with _cache_db_lock:
+        cache_db().execute(
+            "INSERT OR REPLACE INTO version_lists VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (project_identifier, pack_source, first_parser.project_id, project_name, first_parser.pack_icon_url,
+             json.dumps(version_list[3]), int(complete), response_headers.get('etag'),
+             response_headers.get('last-modified'), time.time()))
+    return build_version_list(pack_source, first_parser.project_id, project_name, version_list[3], known_file_id,
+                              first_parser.pack_icon_url)
+
+
+@measured_run("get_modpack_version_list")
+def get_modpack_version_list(project_identifier, known_file_id=None):
+    """
+    Lists are kept in the cache index for program_settings 'version_list_ttl_minutes',
+    after that the first page is requested again and a 304 reply keeps the cached list.
     :param project_identifier: curseforge project name or numeric id.
-    :return: [project_id, project_name, version_list[0=type,1=id,2=title]] or [] if None.\n
+    :param known_file_id: newest file id already known, e.g. the installed version.
+        Pages are only read until this file is found, it is the last entry of the returned list.
+    :return: [pack_source, project_id, project_name, version_list[0=type,1=id,2=title], pack_icon_url]
+        or ['', 0, '', [], ''] if None.\n
 
     Example URL's to search.\n
     :ex: https://minecraft.curseforge.com/projects/project-ozone-2-reloaded/files
     :ex: https://www.feed-the-beast.com/projects/ftb-beyond/files
     """
-    if type(project_identifier) is str:
-        project_identifier = project_identifier.strip().replace(" ", "-").replace(".", "-").lower()
-        if project_identifier == "":
-            return ['', 0, '', []]
+    project_identifier = normalize_project_identifier(project_identifier)
+    if project_identifier == "":
+        return ['', 0, '', [], '']
+    emit_progress(EVENT.phase, PHASE.version_list)
+    cached = cached_version_list(project_identifier, known_file_id)
+    if cached is not None and version_list_is_fresh(cached):
+        log.debug("Version list from cache: " + project_identifier)
+        return version_list_from_cache(cached, known_file_id)
+    if use_async_backend():
+        import downloader_async
+        return downloader_async.run(
+            downloader_async.fetch_modpack_version_list, project_identifier, known_file_id, cached)
+
+    # Stop at the newest cached file, the rest of the list is known.
+    stop_file_id = cached["version_rows"][0][1] if cached and cached["version_rows"] else known_file_id
+    if cached is not None:
+        pack_source = cached["pack_source"]
+        status_code, url, parser, response_headers = read_version_page(
+            project_files_url(pack_source, project_identifier), True, stop_file_id,
+            version_list_revalidation_headers(cached))
+        log.debug("status code: {0}".format(status_code))
+        if status_code == 304:
+            return version_list_from_cache(cached, known_file_id, revalidated=True)
     else:
-        return ['', 0, '', []]
-
-    log.debug("https://minecraft.curseforge.com/projects/" + project_identifier + "/files")
-    sess_response = req_sess.get(
-        "https://minecraft.curseforge.com/projects/" + project_identifier + "/files")
-    pack_source = "curseforge"
-    log.debug("status code: {0}".format(sess_response.status_code))
-
-    if sess_response.status_code == 404:
-        log.debug("https://www.feed-the-beast.com/projects/" + project_identifier + "/files")
-        sess_response = req_sess.get(
-            "https://www.feed-the-beast.com/projects/" + project_identifier + "/files")
-        pack_source = "ftb"
-        log.debug("status code: {0}".format(sess_response.status_code))
-
-    if sess_response.status_code == 200:
-        project_name = sess_response.url.split("/")[-2:-1][0]  # strip down to project name.
-        content_list = str(sess_response.content)
-        content_list = content_list.split("\\r\\n")
-        combine_lines = False
-        content_version_list = []
-        build_version_element = []
-        bare_pack_version_list = []  # bare_pack_version_list[<VersionType>, <FileID>, <VersionTitle>]
-        mod_pack_url_true = False
-        current_page_count = 1
-        InstanceInfo.pack_icon_url = ''
-        for line in content_list:
-            line = line.strip().replace("&#x27;", "'")
-            if not InstanceInfo.pack_icon_url:
-                if line.startswith('<a class="e-avatar64 lightbox" href="') and line.endswith('.png">'):
-                    InstanceInfo.pack_icon_url = line[37:-2]
-                    continue
-            if mod_pack_url_true:  # Have we seen if it's modpack, before we look for versions in the next lines?
-                for test_number in re.findall('(?<=page=)\w+', line):
-                    test_number = int(test_number)
-                    if current_page_count < test_number:
-                        current_page_count = test_number
-                if line == "":  # Skip empty lines sooner.
-                    pass
-                elif line == '<tr class="project-file-list-item">':
-                    combine_lines = True
-                elif line == "</tr>":
-                    if combine_lines:
-                        content_version_list.append(build_version_element)
-                        build_version_element = []
-                        combine_lines = False
-                if not line == "":
-                    if combine_lines:
-                        build_version_element.append(line)
+        log.debug(project_files_url('curseforge', project_identifier))
+        status_code, url, parser, response_headers = read_version_page(
+            project_files_url('curseforge', project_identifier), True, stop_file_id)
+        pack_source = "curseforge"
+        log.debug("status code: {0}".format(status_code))
+
+        if status_code == 404:
+            log.debug(project_files_url('ftb', project_identifier))
+            status_code, url, parser, response_headers = read_version_page(
+                project_files_url('ftb', project_identifier), True, stop_file_id)
+            pack_source = "ftb"
+            log.debug("status code: {0}".format(status_code))
+
+    if status_code == 200 and parser.is_modpack:
+        rows = list(parser.rows)
+        if parser.page_count > 1 and not parser.reached_known_file:
+            log.debug("Page count: " + str(parser.page_count))
+            rows.extend(read_version_sub_pages(pack_source, project_identifier, parser.page_count, stop_file_id))
+        return store_version_list(
+            project_identifier, pack_source, url, parser, rows, response_headers, known_file_id, cached)
+    return ['', 0, '', [], '']
+
+
+def file_name_from_url(url):
+    """ Last path part of a download url without any query data. """
+    return unquote(Path(url).name).split('?')[0]
+
+
+def modpack_download_url(pack_source, project_id, file_id):
+    """
+    :return: download url for the pack file, or '' if the pack source is unknown.
+    """
+    if pack_source == "curseforge":
+        return CURSEFORGE_URL + "/projects/{0}/files/{1}/download".format(project_id, file_id)
+    elif pack_source == "ftb":
+        return FTB_URL + "/projects/{0}/files/{1}/download".format(project_id, file_id)
+    return ''
+
+
+def modpack_zip_path(project_id, file_id, file_name):
+    return MODPACK_ZIP_CACHE + "/" + str(project_id) + "/" + str(file_id) + "/" + file_name
+
+
+def cached_modpack_zip(project_id, file_id):
+    """
+    :return: MODPACK_ZIP_CACHE + "/" + project_id + "/" + file_id + "/" + file_name if cached, else ''.
+    """
+    with cache_wide_lock:  # The touch keeps cache_gc off the zip while it is unpacked.
+        cache_entry = lookup_cache_entry("modpack", project_id, file_id)
+        if cache_entry is not None:
+            zip_path = modpack_zip_path(project_id, file_id, cache_entry["name"])
+            if os.path.exists(zip_path) and os.path.getsize(zip_path) != cache_entry["size"]:
+                quarantine_file(zip_path, "size does not match the cache index")
+            if os.path.exists(zip_path):
+                log.debug(zip_path)
+                touch_cache_entry("modpack", project_id, file_id)
+                metrics_count("cache_hits")
+                metrics_count("bytes_saved", cache_entry["size"])
+                return zip_path
+            remove_cache_entry("modpack", project_id, file_id)
+    metrics_count("cache_misses")
+    return ''
+
+
+def store_modpack_zip(part_path, project_id, file_id, file_name, content_hash=None):
+    """
+    Moves a finished download into the modpack cache.
+    :param content_hash: hash of the zip if it was taken while downloading, see DownloadWriter.
+    :return: path of the cached zip.
+    """
+    zip_path = modpack_zip_path(project_id, file_id, file_name)
+    finish_part_download(part_path)
+    with cache_wide_lock:
+        publish_cache_file(part_path, zip_path)
+        record_cache_entry("modpack", project_id, file_id, file_name, os.path.getsize(zip_path), content_hash)
+    return zip_path
+
+
+def pack_icon_needed(project_id, pack_icon_url):
+    return pack_icon_url and not os.path.exists(
+        os.path.join(MODPACK_ZIP_CACHE, str(project_id), 'pack_icon.png'))
+
+
+def pack_icon_part_path():
+    return unique_temp_path(os.path.join(CACHE_PATH, 'pack_icon.png'))
+
+
+def store_pack_icon(part_path, project_id):
+    publish_cache_file(part_path, os.path.join(MODPACK_ZIP_CACHE, str(project_id), 'pack_icon.png'))
+
+
+def cache_pack_icon(project_id, pack_icon_url):
+    """
+    :param pack_icon_url: from the get_modpack_version_list result of the project, '' when it has none.
+    """
+    if pack_icon_needed(project_id, pack_icon_url):
+        InstanceInfo.current_file_size = 0
+        icon_part_path = pack_icon_part_path()
+        request_file_response = http_session().get(pack_icon_url, stream=True)
+        with DownloadWriter(icon_part_path) as writer:
+            stream_response(request_file_response, writer)
+        store_pack_icon(icon_part_path, project_id)
+
+
+def publish_cache_file(src, dst):
+    """
+    Moves a finished file into the cache so other processes see either all of it or nothing at dst.
+    Renamed in one step on the same file system, else copied under a temporary name next to dst first.
+    """
+    create_dir_if_not_exist(os.path.dirname(dst))
+    try:
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        temp_path = unique_temp_path(dst)
+        shutil.copyfile(src, temp_path)
+        os.replace(temp_path, dst)
+        os.remove(src)
+
+
+class CacheFileLock:
+    """
+    Lock on one cache entry shared with every process using CACHE_PATH, e.g. build workers with the cache on
+    shared storage. It is held while the entry is downloaded, a peer waits for it and then takes the file
+    from the cache instead of downloading it too. flock on posix, msvcrt.locking on windows.
+    Lock files are left in place, removing one could let two processes lock different files of the same name.
+    """
+    def __init__(self, project_id, file_id):
+        self.name = "{0}-{1}".format(project_id, file_id)
+        self.path = os.path.join(CACHE_LOCK_PATH, self.name + ".lock")
+        self.waited = False
+        self._file = None
+
+    def try_acquire(self):
+        """
+        :return: True if the lock is held now, False if someone else holds it.
+        """
+        lock_file = open_lock_file(self.path, blocking=False)
+        if lock_file is None:
+            return False
+        self._file = lock_file
+        return True
+
+    def mark_waiting(self):
+        if not self.waited:
+            log.info("Waiting for another download of " + self.name)
+            metrics_count("lock_waits")
+            self.waited = True
+
+    def acquire(self):
+        """
+        Waits until the lock is held, gives up like the downloads when InstanceInfo.master_thread_running is cleared.
+        :return: True if someone else held it first, the entry may be in the cache now.
+        """
+        while not self.try_acquire():
+            self.mark_waiting()
+            if InstanceInfo.master_thread_running is False:
+                sys.exit()
+            time.sleep(CACHE_LOCK_POLL_SECONDS)
+        return self.waited
+
+    def release(self):
+        if self._file is None:
+            return
+        close_lock_file(self._file)
+        self._file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
+
+
+def open_lock_file(path, blocking):
+    """
+    Opens and exclusively locks a lock file, flock on posix, msvcrt.locking on windows.
+    :param blocking: wait for the lock, else give up at once when someone else holds it.
+    :return: the locked file, or None if not blocking and it is held elsewhere.
+    """
+    create_dir_if_not_exist(os.path.dirname(path))
+    lock_file = open(path, 'a+b')
+    while True:
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
             else:
-                if line == '<a href="/modpacks">Modpacks</a>':
-                    mod_pack_url_true = True
-        if current_page_count > 1:
-            log.debug("Page count: " + str(current_page_count))
-            for page in range(2, current_page_count+1):
-                if pack_source == 'curseforge':
-                    sess_response = req_sess.get(
-                        "https://minecraft.curseforge.com/projects/" + project_identifier + "/files/?page=" + str(current_page_count))
-                elif pack_source == 'ftb':
-                    sess_response = req_sess.get(
-                        "https://www.feed-the-beast.com/projects/" + project_identifier + "/files/?page=" + str(current_page_count))
-                log.debug("URL: " + sess_response.url)
-                if sess_response.status_code == 200:
-                    content_list = str(sess_response.content)
-                    content_list = content_list.split("\\r\\n")
-                    combine_lines = False
-                    for line in content_list:
-                        line = line.strip().replace("&#x27;", "'")
-                        if line == "":  # Skip empty lines sooner.
-                            pass
-                        elif line == '<tr class="project-file-list-item">':
-                            combine_lines = True
-                        elif line == "</tr>":
-                            if combine_lines:
-                                content_version_list.append(build_version_element)
-                                build_version_element = []
-                                combine_lines = False
-                        if not line == "":
-                            if combine_lines:
-                                build_version_element.append(line)
-                else:
-                    raise ConnectionError("URL request failed sub page request: " + sess_response.url)
-
-        if mod_pack_url_true:
-            # print(len('<a class="overflow-tip twitch-link" href="/projects//files/'))  # len: 59
-            fileid_start_pos = len(project_name) + 59
-            log.debug("Project Name: " + str(project_name))
-            log.debug("Start Pos: " + str(fileid_start_pos))
-            project_id = content_version_list[0][9][9:15]
-            for listElement in content_version_list:
-                if listElement[2] == '<div class="release-phase tip" title="Release"></div>':
-                    bare_pack_version_list.append(
-                        [1, listElement[7][fileid_start_pos:-1], listElement[9][28:-4].split(">", 1)[1]])
-                elif listElement[2] == '<div class="beta-phase tip" title="Beta"></div>':
-                    bare_pack_version_list.append(
-                        [2, listElement[7][fileid_start_pos:-1], listElement[9][28:-4].split(">", 1)[1]])
-                elif listElement[2] == '<div class="alpha-phase tip" title="Alpha"></div>':
-                    bare_pack_version_list.append(
-                        [3, listElement[7][fileid_start_pos:-1], listElement[9][28:-4].split(">", 1)[1]])
-
-            print(bare_pack_version_list)
-            return [pack_source, project_id, project_name, bare_pack_version_list]
-    return ['', 0, '', []]
-
-
-def download_modpack_zip(pack_source, project_id, project_name, file_id):
+                import fcntl
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return lock_file
+        except OSError:
+            if not blocking:
+                lock_file.close()
+                return None
+            # msvcrt.LK_LOCK gives up after 10 seconds, keep waiting.
+
+
+def close_lock_file(lock_file):
+    if os.name == 'nt':
+        import msvcrt
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+    lock_file.close()  # Drops the flock.
+
+
+class CacheWideLock:
+    """
+    Lock on the whole cache shared with every process using CACHE_PATH. Held while a mod object is stored
+    and indexed, while a cached file is checked before installing it and while cache_gc deletes files,
+    so gc never deletes an object another process has just stored but not indexed yet, or is about to link.
+    Reentrant, threads of one process queue on an RLock so only one of them waits on the lock file.
+    Take it before _cache_db_lock, never while holding that.
+    """
+    def __init__(self):
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        if self._depth == 0:
+            try:
+                self._file = open_lock_file(os.path.join(CACHE_LOCK_PATH, "cache.lock"), blocking=True)
+            except BaseException:
+                self._thread_lock.release()
+                raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._depth -= 1
+        if self._depth == 0:
+            close_lock_file(self._file)
+            self._file = None
+        self._thread_lock.release()
+        return False
+
+
+cache_wide_lock = CacheWideLock()
+
+
+def part_cache_lock(part_name):
+    """
+    :param part_name: file name of a .part file in CACHE_PATH, named <projectID>-<fileID>-<name>.part.
+    :return: the CacheFileLock guarding it, or None for parts not named like that.
+    """
+    name_parts = part_name.split('-', 2)
+    if len(name_parts) == 3 and name_parts[0].isdigit() and name_parts[1].isdigit():
+        return CacheFileLock(name_parts[0], name_parts[1])
+    return None
+
+
+def part_sidecar_path(part_path):
+    """ Sidecar json next to a .part file recording where it came from, used to resume it. """
+    return part_path + '.json'
+
+
+def remove_part_download(part_path):
+    for leftover in (part_path, part_sidecar_path(part_path)):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+
+
+def finish_part_download(part_path):
+    """ Drops the sidecar once the .part file is complete and about to be moved into the cache. """
+    if os.path.exists(part_sidecar_path(part_path)):
+        os.remove(part_sidecar_path(part_path))
+
+
+# Files are asked for unencoded, the .part file, Content-Length and Range offsets then all count the same bytes.
+# A gzip body is decoded while streaming and would never match its Content-Length.
+FILE_DOWNLOAD_HEADERS = {'Accept-Encoding': 'identity'}
+
+
+def resume_request_headers(part_path, url):
+    """
+    Checks if an earlier attempt left a usable .part file for url.
+    :return: [offset, headers] where headers hold FILE_DOWNLOAD_HEADERS and the Range request for the
+        missing bytes, or [0, FILE_DOWNLOAD_HEADERS] if there is nothing to resume.
+    """
+    if not (os.path.exists(part_path) and os.path.exists(part_sidecar_path(part_path))):
+        return [0, dict(FILE_DOWNLOAD_HEADERS)]
+    try:
+        part_info = load_json_file(part_sidecar_path(part_path))
+    except ValueError:
+        return [0, dict(FILE_DOWNLOAD_HEADERS)]
+    offset = os.path.getsize(part_path)
+    if part_info.get("url") != url or offset == 0 or (part_info.get("length") and offset >= part_info["length"]):
+        return [0, dict(FILE_DOWNLOAD_HEADERS)]
+    headers = dict(FILE_DOWNLOAD_HEADERS, Range='bytes={0}-'.format(offset))
+    # If-Range makes the server send the whole file again if it changed since the part was started.
+    if part_info.get("etag"):
+        headers['If-Range'] = part_info["etag"]
+    elif part_info.get("last_modified"):
+        headers['If-Range'] = part_info["last_modified"]
+    log.info("Resuming " + os.path.basename(part_path) + " from " + get_human_readable(offset))
+    return [offset, headers]
+
+
+def begin_part_download(part_path, url, status_code, headers, offset):
+    """
+    Decides from the response if the .part file is continued or started over and records the sidecar.
+    :param offset: bytes asked for with resume_request_headers, 0 if nothing was asked.
+    :return: [open_mode, offset, total_size] total_size is 0 if the server didn't say.
+    """
+    if headers.get('content-encoding', 'identity').lower() != 'identity':
+        # Sent encoded anyway, the lengths and ranges are of the encoded body and not of the decoded file
+        # written, so the size is unknown and the part can't be resumed.
+        if os.path.exists(part_sidecar_path(part_path)):
+            os.remove(part_sidecar_path(part_path))
+        return ['wb', 0, 0]
+    content_length = int(headers.get('content-length', 0))
+    content_range = re.match(r'bytes (\d+)-', headers.get('content-range', ''))
+    if offset and status_code == 206 and content_range and int(content_range.group(1)) == offset:
+        open_mode = 'ab'
+        total_size = offset + content_length if content_length else 0
+    else:
+        open_mode = 'wb'
+        offset = 0
+        total_size = content_length
+    save_json_file({
+        "url": url,
+        "etag": headers.get('etag', ''),
+        "last_modified": headers.get('last-modified', ''),
+        "length": total_size
+    }, part_sidecar_path(part_path))
+    return [open_mode, offset, total_size]
+
+
+def request_part_download(url, part_path, response=None):
+    """
+    Starts streaming url for part_path, resuming with a Range request when an earlier attempt left bytes behind.
+    Check the response status before writing, only 200 and 206 replies are file contents.
+    :param response: already open streamed response for url, requested with FILE_DOWNLOAD_HEADERS,
+        used as is when there is nothing to resume.
+    :return: [response, open_mode, offset, total_size]
+    """
+    offset, request_headers = resume_request_headers(part_path, url)
+    if offset:
+        if response is not None:
+            response.close()
+        response = http_session().get(url, stream=True, headers=request_headers)
+        if response.status_code == 416:  # Range not satisfiable, the part doesn't fit the file anymore.
+            metrics_count("retries")
+            response.close()
+            remove_part_download(part_path)
+            offset = 0
+            response = http_session().get(url, stream=True, headers=FILE_DOWNLOAD_HEADERS)
+    elif response is None:
+        response = http_session().get(url, stream=True, headers=request_headers)
+    if response.status_code not in (200, 206):
+        return [response, 'wb', 0, 0]  # Nothing to write, the part and its sidecar are kept for a later attempt.
+    open_mode, offset, total_size = begin_part_download(
+        part_path, url, response.status_code, response.headers, offset)
+    return [response, open_mode, offset, total_size]
+
+
+DOWNLOAD_READ_SIZE_MIN = 64 * 1024
+DOWNLOAD_READ_SIZE_MAX = 4 * 1024 * 1024
+
+
+def next_read_size(read_size, received, read_time):
+    """
+    Grows the read size while reads come back full and fast, shrinks it when a read waits long on a slow link
+    so progress and cancelling stay responsive.
+    """
+    if received >= read_size and read_time < 0.05:
+        return min(read_size * 2, DOWNLOAD_READ_SIZE_MAX)
+    if read_time > 0.25:
+        return max(read_size // 2, DOWNLOAD_READ_SIZE_MIN)
+    return read_size
+
+
+def preallocate_file(file_data, size):
+    """ Reserves size bytes on disk up front, so a big file doesn't end up fragmented. """
+    try:
+        os.posix_fallocate(file_data.fileno(), 0, size)
+    except (AttributeError, OSError):  # Not on windows / mac, or not supported by the file system.
+        file_data.truncate(size)
+
+
+class DownloadWriter:
+    """
+    Writes a download into its .part file, hashing it with CACHE_HASH_ALGORITHM on the way and
+    counting every chunk with add_download_size.
+    Use it as a context manager, the file is preallocated when the total size is known and cut back
+    to what was written on close, so a cancelled or short download keeps the right size to resume from.
+    """
+    def __init__(self, part_path, open_mode='wb', offset=0, total_size=0, file_name=''):
+        """
+        :param open_mode, offset, total_size: as returned by request_part_download.
+        :param file_name: name used in the file_bytes progress events, '' to not emit any.
+        """
+        self.part_path = part_path
+        self.offset = offset if open_mode == 'ab' else 0
+        self.total_size = total_size
+        self.file_name = file_name
+        self.received = 0
+        self._hasher = hashlib.new(CACHE_HASH_ALGORITHM)
+        self._file = None
+
+    def __enter__(self):
+        if self.offset:
+            # The bytes of the earlier attempt are part of the hash, read them once before appending.
+            self._file = open(self.part_path, 'r+b')
+            remaining = self.offset
+            while remaining > 0:
+                block = self._file.read(min(remaining, DOWNLOAD_READ_SIZE_MAX))
+                if not block:
+                    break
+                self._hasher.update(block)
+                remaining -= len(block)
+            self._file.seek(self.offset)
+        else:
+            self._file = open(self.part_path, 'wb')
+        if self.total_size > self.offset:
+            preallocate_file(self._file, self.total_size)
+        return self
+
+    def write(self, chunk):
+        self._file.write(chunk)
+        self._hasher.update(chunk)
+        self.received += len(chunk)
+        add_download_size(chunk_size=len(chunk), file_name=self.file_name)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._file.truncate(self.offset + self.received)
+        self._file.close()
+        return False
+
+    @property
+    def content_hash(self):
+        """ Hash of the whole file, the resumed part included. """
+        return self._hasher.hexdigest()
+
+
+def stream_response(response, writer):
+    """
+    Copies a streamed requests response into a DownloadWriter, see next_read_size.
+    :return: False if InstanceInfo.master_thread_running was cleared, the response is closed then.
+    """
+    read_size = DOWNLOAD_READ_SIZE_MIN
+    while True:
+        read_started = time.time()
+        chunk = response.raw.read(read_size, decode_content=True)
+        if not chunk:
+            return True
+        writer.write(chunk)
+        if InstanceInfo.master_thread_running is False:
+            response.close()
+            return False
+        read_size = next_read_size(read_size, len(chunk), time.time() - read_started)
+
+
+@measured_run("download_modpack_zip")
+def download_modpack_zip(pack_source, project_id, project_name, file_id, pack_icon_url=''):
     # TODO: remove project_name? curese seems to respond now to ids in the project url while requesting the download.
     """
     Downloads a specific modpack.zip and returns the file path to it in the cache directory.
@@ -640,124 +2124,1204 @@ def download_modpack_zip(pack_source, project_id, project_name, file_id):
     :param project_id: the numberic id for the modpack project '242493'
     :param project_name: The text id/url name 'what-ever-my-name'
     :param file_id: The id for the specific version requested. '2287097'
+    :param pack_icon_url: pack_icon_url of the get_modpack_version_list result, cached next to the zip.
     :return: MODPACK_ZIP_CACHE + "/" + project_id + "/" + file_id + "/" + file_name
     """
     InstanceInfo().reset_dl()
     log.info("download_modpack_zip\n" + "project_name: " + project_name + " file_id: " + file_id)
+    emit_progress(EVENT.phase, PHASE.modpack_zip, total=1)
+    if use_async_backend():
+        import downloader_async
+        return downloader_async.run(
+            downloader_async.fetch_modpack_zip, pack_source, project_id, project_name, file_id, pack_icon_url)
     #  Check cache for file first.
-    dep_cache_dir = Path(MODPACK_ZIP_CACHE + "/" + str(project_id) + "/" + str(file_id))
-    if dep_cache_dir.is_dir():
-        cache_file = [files for files in dep_cache_dir.iterdir()]  # Create list with files from directory.
-        if len(cache_file) >= 1:  # if there is at least one file.
-            file_name = os.path.basename(os.path.normpath(cache_file[0]))  # copy name of first file to var.
-            log.debug(MODPACK_ZIP_CACHE + "/" + project_id + "/" + file_id + "/" + file_name)
-            InstanceInfo.is_done = True
-            InstanceInfo.return_arg = MODPACK_ZIP_CACHE + "/" + project_id + "/" + file_id + "/" + file_name
+    zip_path = cached_modpack_zip(project_id, file_id)
+    if not zip_path:
+        with CacheFileLock(project_id, file_id) as cache_lock:
+            if cache_lock.waited:
+                # Another process was downloading this zip, take it from the cache if that worked.
+                zip_path = cached_modpack_zip(project_id, file_id)
+            if not zip_path:
+                InstanceInfo.return_arg = download_modpack_file(pack_source, project_id, file_id, pack_icon_url)
+                InstanceInfo.is_done = True
+                return InstanceInfo.return_arg
+    InstanceInfo.is_done = True
+    InstanceInfo.return_arg = zip_path
+    cache_pack_icon(project_id, pack_icon_url)
+    emit_progress(EVENT.file_finished, os.path.basename(zip_path), message="in cache")
+    return InstanceInfo.return_arg
 
-            if not os.path.exists(os.path.join(MODPACK_ZIP_CACHE, project_id, 'pack_icon.png')):
-                InstanceInfo.current_file_size = 0
-                request_file_response = req_sess.get(InstanceInfo.pack_icon_url, stream=True)
-                with open(os.path.join(CACHE_PATH, 'pack_icon.png'), 'wb') as fh:
-                    for chunk in request_file_response.iter_content(1024):
-                        InstanceInfo.current_file_size += len(chunk)
-                        fh.write(chunk)
-                shutil.move(
-                    os.path.join(CACHE_PATH, 'pack_icon.png'),
-                    os.path.join(MODPACK_ZIP_CACHE, project_id, 'pack_icon.png'))
 
-            return InstanceInfo.return_arg
+def modpack_part_file(project_id, file_id, file_name):
+    # Named like mod_part_path so part_cache_lock finds the lock guarding it.
+    return os.path.join(CACHE_PATH, str(project_id) + "-" + str(file_id) + "-" + file_name + '.part')
 
-    if pack_source == "curseforge":
-        request_file_response = req_sess.get(
-            "https://minecraft.curseforge.com/projects/{0}/files/{1}/download".format(
-                project_id, file_id), stream=True)
-    elif pack_source == "ftb":
-        request_file_response = req_sess.get(
-            "https://www.feed-the-beast.com/projects/{0}/files/{1}/download".format(
-                project_id, file_id), stream=True)
-    else:
-        InstanceInfo.is_done = True
-        InstanceInfo.return_arg = ''
-        return InstanceInfo.return_arg  # Error detecting pack source url.
+
+def download_modpack_file(pack_source, project_id, file_id, pack_icon_url):
+    """
+    Downloads a pack zip that is not cached into the cache, hold its CacheFileLock while calling this.
+    :return: path of the cached zip, or '' on failure.
+    """
+    download_url = modpack_download_url(pack_source, project_id, file_id)
+    if not download_url:
+        emit_progress(EVENT.file_failed, str(file_id), message="Unknown pack source: " + str(pack_source))
+        return ''  # Error detecting pack source url.
+    download_started = time.time()
+    request_file_response = http_session().get(download_url, stream=True, headers=FILE_DOWNLOAD_HEADERS)
+    ttfb = time.time() - download_started
 
     log.debug(request_file_response.url)
-    if request_file_response.status_code == 200:
-        file_url = Path(request_file_response.url)
-        file_name = unquote(file_url.name).split('?')[0]
-        InstanceInfo.file_size = int(request_file_response.headers.get('content-length', 0))
-        if InstanceInfo.file_size:
-            print(str(file_name + " (DL: " + get_human_readable(InstanceInfo.file_size) + ")"))
+    if request_file_response.status_code != 200:
+        emit_progress(EVENT.file_failed, str(file_id),
+                      message="Download failed with status " + str(request_file_response.status_code))
+        return ''
+    file_name = file_name_from_url(request_file_response.url)
+    modpack_part_path = modpack_part_file(project_id, file_id, file_name)
+    request_file_response, open_mode, offset, InstanceInfo.file_size = \
+        request_part_download(request_file_response.url, modpack_part_path, request_file_response)
+    if request_file_response.status_code not in (200, 206):
+        request_file_response.close()
+        emit_progress(EVENT.file_failed, file_name,
+                      message="Download failed with status " + str(request_file_response.status_code))
+        return ''
+    InstanceInfo.current_file_size = offset
+    if InstanceInfo.file_size:
+        print(str(file_name + " (DL: " + get_human_readable(InstanceInfo.file_size) + ")"))
+    else:
+        print(str(file_name + " (DL: " + "size: ?" + ")"))
+    emit_progress(EVENT.file_started, file_name, InstanceInfo.current_file_size, InstanceInfo.file_size)
+
+    # The .part file and its sidecar are kept on cancel or error so the next attempt resumes them.
+    with DownloadWriter(modpack_part_path, open_mode, offset, InstanceInfo.file_size, file_name) as writer:
+        if not stream_response(request_file_response, writer):
+            sys.exit()
+
+    problem = check_file_integrity(modpack_part_path, file_name, InstanceInfo.file_size)
+    if problem:
+        quarantine_file(modpack_part_path, problem)
+        emit_progress(EVENT.file_failed, file_name, message="Download damaged, " + problem)
+        return ''
+    metrics_file(file_name, writer.received, time.time() - download_started, ttfb)
+    zip_path = store_modpack_zip(modpack_part_path, project_id, file_id, file_name, writer.content_hash)
+    emit_progress(EVENT.file_finished, file_name, os.path.getsize(zip_path), os.path.getsize(zip_path))
+    cache_pack_icon(project_id, pack_icon_url)
+    enforce_cache_budget()
+    return zip_path
+
+
+def unpack_modpack_zip(src_dir, dst_folder_name, dst_dir, install_type=None):
+    extract_modpack_zip(src_dir, os.path.join(dst_dir, dst_folder_name), install_type)
+
+
+def instance_install_type(instance_dir):
+    """
+    :return: install_type saved in the instance settings, 'custom' if there are none.
+    """
+    settings_path = os.path.join(instance_dir, PDM_INSTANCE_FOLDER, PDM_INSTANCE_FILE)
+    if os.path.exists(settings_path):
+        return load_json_file(settings_path)['instance_settings'].get('install_type') or 'custom'
+    return 'custom'
+
+
+def instance_game_dir(instance_dir, install_type=None):
+    """
+    :param install_type: 'custom', 'mmc' or 'curse'. Read from the instance settings when not given.
+    :return: directory the pack overrides and mods belong in.
+        Curse instances keep them in the instance root, the other install types in instance_dir/minecraft.
+    """
+    if install_type is None:
+        install_type = instance_install_type(instance_dir)
+    if install_type == 'curse':
+        return os.path.normpath(instance_dir)
+    return os.path.normpath(os.path.join(instance_dir, "minecraft"))
+
+
+def extract_modpack_zip(path_to_zip_file, instance_dir, install_type=None):
+    """
+    Extracts a modpack zip in one pass, overrides are written straight to instance_game_dir
+    and everything else (manifest.json, modlist.html) to instance_dir.
+    :param install_type: see instance_game_dir.
+    """
+    instance_dir = os.path.abspath(instance_dir)
+    game_dir = os.path.abspath(instance_game_dir(instance_dir, install_type))
+    log.debug("extract_modpack_zip\npath to zip: " + str(path_to_zip_file) + " game_dir: " + str(game_dir))
+    emit_progress(EVENT.phase, PHASE.extract)
+    manifest_json = read_zip_manifest(path_to_zip_file) or {}
+    with zipfile.ZipFile(path_to_zip_file, "r") as zip_ref:
+        overrides = manifest_json.get('overrides', 'overrides')
+        overrides_prefix = overrides.strip('/') + '/'
+        for entry in zip_ref.infolist():
+            if entry.filename.startswith(overrides_prefix):
+                base_dir, entry_path = game_dir, entry.filename[len(overrides_prefix):]
+            else:
+                base_dir, entry_path = instance_dir, entry.filename
+            target_path = os.path.normpath(os.path.join(base_dir, entry_path))
+            if os.path.commonpath([base_dir, target_path]) != base_dir:
+                log.warning("Skipping zip entry outside the instance: " + entry.filename)
+                continue
+            if entry.filename.endswith('/'):
+                create_dir_if_not_exist(target_path)
+                continue
+            create_dir_if_not_exist(os.path.dirname(target_path))
+            if os.path.lexists(target_path):
+                # target may be linked to the mod cache, writing through it would change the cached file.
+                os.remove(target_path)
+            with zip_ref.open(entry) as src_file, open(target_path, 'wb') as dst_file:
+                shutil.copyfileobj(src_file, dst_file, 1024 * 1024)
+
+
+def use_async_backend():
+    """
+    :return: True if program_settings asks for the asyncio transport and aiohttp can be imported.
+    """
+    if program_settings[KEY.http_backend] != 'asyncio':
+        return False
+    import downloader_async
+    if not downloader_async.is_available():
+        log.warning("http_backend is set to asyncio but aiohttp is not installed, using requests.")
+        return False
+    return True
+
+
+class HostLimiter:
+    """
+    Bounds how many requests may be in flight to a single host at the same time.
+    One semaphore is created per host the first time it is seen.
+    """
+    def __init__(self, per_host):
+        self.per_host = max(1, int(per_host))
+        self._lock = threading.Lock()
+        self._slots = {}
+
+    def slot(self, url):
+        """
+        :param url: the url about to be requested.
+        :return: semaphore to hold for the whole request, including reading the body.
+        """
+        host = urlparse(url).netloc.lower()
+        with self._lock:
+            if host not in self._slots:
+                self._slots[host] = threading.BoundedSemaphore(self.per_host)
+            return self._slots[host]
+
+
+class EVENT:
+    """ ProgressEvent kinds. """
+    phase = "phase"  # name: one of the PHASE values, total: files in the phase.
+    file_started = "file_started"  # size: bytes already there when resuming, total: file size (0 if unknown).
+    file_bytes = "file_bytes"  # size: bytes received since the last event.
+    file_finished = "file_finished"  # size: file size, message: the [n/total] line.
+    file_failed = "file_failed"  # message: why.
+
+
+class PHASE:
+    version_list = "version_list"
+    modpack_zip = "modpack_zip"
+    extract = "extract"
+    mods = "mods"
+    done = "done"  # Last event of a run.
+    failed = "failed"  # Last event of a run that raised, message: the error.
+
+
+ProgressEvent = namedtuple("ProgressEvent", ["kind", "name", "size", "total", "message"])
+_progress_lock = threading.Lock()
+_progress_subscribers = []
+
+
+def subscribe_progress(callback=None):
+    """
+    Registers for ProgressEvents. Events are sent from whichever worker thread or loop made progress,
+    so a callback has to be thread safe and quick.
+    :param callback: called with each ProgressEvent. When not given a queue.Queue is made that receives them,
+        for consumers that drain events on their own thread, like the GUI with Tk after().
+    :return: the subscriber to hand to unsubscribe_progress, the queue when no callback was given.
+    """
+    if callback is None:
+        callback = queue.Queue()
+    with _progress_lock:
+        _progress_subscribers.append(callback)
+    return callback
+
+
+def unsubscribe_progress(subscriber):
+    with _progress_lock:
+        if subscriber in _progress_subscribers:
+            _progress_subscribers.remove(subscriber)
+
+
+def emit_progress(kind, name='', size=0, total=0, message=''):
+    event = ProgressEvent(kind, name, size, total, message)
+    with _progress_lock:
+        subscribers = list(_progress_subscribers)
+    for subscriber in subscribers:
+        if isinstance(subscriber, queue.Queue):
+            subscriber.put(event)
         else:
-            print(str(file_name + " (DL: " + "size: ?" + ")"))
-
-        modpack_part_path = os.path.join(CACHE_PATH, file_name + '.part')
-        with open(modpack_part_path, 'wb') as f:
-            for chunk in request_file_response.iter_content(1024):
-                InstanceInfo.current_file_size += len(chunk)
-                f.write(chunk)
-                if InstanceInfo.master_thread_running is False:
-                    sys.exit()
+            subscriber(event)
 
-        create_dir_if_not_exist(MODPACK_ZIP_CACHE + "/" + project_id + "/" + file_id)
-        shutil.move(modpack_part_path,
-                    MODPACK_ZIP_CACHE + "/" + project_id + "/" + file_id + "/" + file_name)
-
-        if not os.path.exists(os.path.join(MODPACK_ZIP_CACHE, project_id, 'pack_icon.png')):
-            InstanceInfo.current_file_size = 0
-            request_file_response = req_sess.get(InstanceInfo.pack_icon_url, stream=True)
-            with open(os.path.join(CACHE_PATH, 'pack_icon.png'), 'wb') as fh:
-                for chunk in request_file_response.iter_content(1024):
-                    InstanceInfo.current_file_size += len(chunk)
-                    fh.write(chunk)
-            shutil.move(
-                os.path.join(CACHE_PATH, 'pack_icon.png'),
-                os.path.join(MODPACK_ZIP_CACHE, project_id, 'pack_icon.png'))
+
+def report_progress(message, kind=EVENT.file_finished, file_name='', file_size=0):
+    """
+    Prints a '[n/total] message' line, advances InstanceInfo.current_progress and emits a file event.
+    The counter is only touched while holding the lock so concurrent workers never share a number.
+    """
+    with _progress_lock:
+        message = str("[%d/%d] " + message) % (InstanceInfo.current_progress, InstanceInfo.total_progress)
+        print(message)
+        InstanceInfo.current_progress += 1
+        log.debug("InstanceInfo.current_progress: " + str(InstanceInfo.current_progress))
+    emit_progress(kind, file_name, file_size, file_size, message)
+
+
+def report_downloaded(file_name, file_size):
+    if file_size:
+        report_progress(file_name + " (DL: " + get_human_readable(file_size) + ")",
+                        file_name=file_name, file_size=file_size)
     else:
-        InstanceInfo.is_done = True
-        InstanceInfo.return_arg = ''
-        return InstanceInfo.return_arg
+        report_progress(file_name + " (DL: MISSING FILE SIZE)", file_name=file_name)
 
-    InstanceInfo.is_done = True
-    InstanceInfo.return_arg = MODPACK_ZIP_CACHE + "/" + project_id + "/" + file_id + "/" + file_name
-    return InstanceInfo.return_arg
 
+def add_download_size(file_size=0, chunk_size=0, file_name=''):
+    """
+    Counts bytes into the InstanceInfo totals, received chunks are emitted as file_bytes events.
+    """
+    with _progress_lock:
+        InstanceInfo.file_size += file_size
+        InstanceInfo.current_file_size += chunk_size
+    if chunk_size and file_name and not file_size:
+        emit_progress(EVENT.file_bytes, file_name, chunk_size)
+
+
+def report_download_started(file_name, file_size, offset=0):
+    """
+    :param file_size: 0 if the server didn't say.
+    :param offset: bytes a resumed download already had.
+    """
+    add_download_size(file_size=file_size, chunk_size=offset)
+    emit_progress(EVENT.file_started, file_name, offset, file_size)
 
-def unpack_modpack_zip(src_dir, dst_folder_name, dst_dir):
-    # FIXME: unpack.
-    print(src_dir, dst_dir+dst_folder_name)
-    unzip(src_dir, dst_dir+dst_folder_name)
 
+def mod_download_url(dependency):
+    return CURSEFORGE_URL + "/projects/{0}/files/{1}/download".format(
+        dependency['projectID'], dependency['fileID'])
 
-def download_mods(instance_dir):
-    InstanceInfo.is_done = False
+
+def cursemeta_url(dependency):
+    # If curse website fails to provide correct url try Dries API list.
+    return "%s/%s/%s.json" % (CURSEMETA_URL, dependency['projectID'], dependency['fileID'])
+
+
+def mod_part_path(dependency, file_name):
+    # Part files are named per dependency so two workers never write to the same one,
+    # other processes keep off it while the dependency's CacheFileLock is held.
+    return os.path.join(
+        CACHE_PATH, str(dependency['projectID']) + "-" + str(dependency['fileID']) + "-" + file_name + '.part')
+
+
+def file_hash(file_path):
+    """
+    :return: hex digest of the file contents using CACHE_HASH_ALGORITHM.
+    """
+    file_hasher = hashlib.new(CACHE_HASH_ALGORITHM)
+    with open(str(file_path), 'rb') as file_data:
+        for block in iter(lambda: file_data.read(1024 * 1024), b''):
+            file_hasher.update(block)
+    return file_hasher.hexdigest()
+
+
+def check_file_integrity(file_path, file_name, expected_size=0, expected_hash=None, content_hash=None):
+    """
+    Checks a download or cached file for truncation and corruption.
+    :param file_name: real name of the file, .zip and .jar files must have a readable zip directory.
+    :param expected_size: 0 if unknown.
+    :param expected_hash: CACHE_HASH_ALGORITHM hex digest the file must have, None if unknown.
+        Only known for files already in the cache, the pack sources publish no such hash for downloads.
+    :param content_hash: hash already taken of the file, e.g. by DownloadWriter. Read from the file if needed.
+    :return: '' if the file is fine, else what is wrong with it.
+    """
+    try:
+        size = os.path.getsize(str(file_path))
+    except OSError:
+        return "missing"
+    if expected_size and size != expected_size:
+        return "size is {0} bytes instead of {1}".format(size, expected_size)
+    if expected_hash:
+        if content_hash is None:
+            content_hash = file_hash(file_path)
+        if content_hash != expected_hash:
+            return "content hash does not match"
+    if os.path.splitext(file_name)[1].lower() in ('.zip', '.jar'):
+        try:
+            zipfile.ZipFile(str(file_path)).close()  # Only reads the directory at the end, cut off files fail.
+        except (zipfile.BadZipFile, OSError):
+            return "not a readable zip file"
+    return ''
+
+
+def quarantine_file(file_path, problem):
+    """
+    Moves a damaged file out of the cache into QUARANTINE_PATH, the sidecar of a .part file is dropped.
+    :return: quarantined path.
+    """
+    create_dir_if_not_exist(QUARANTINE_PATH)
+    quarantine_path = os.path.join(QUARANTINE_PATH, "{0}.{1}".format(
+        os.path.basename(str(file_path)), int(time.time() * 1000)))
+    log.warning("Quarantined {0} ({1}): {2}".format(file_path, problem, quarantine_path))
+    shutil.move(str(file_path), quarantine_path)
+    if os.path.exists(part_sidecar_path(str(file_path))):
+        os.remove(part_sidecar_path(str(file_path)))
+    metrics_count("verification_failures")
+    return quarantine_path
+
+
+def mod_cache_key(project_id, file_id):
+    return str(project_id) + "/" + str(file_id)
+
+
+def mod_object_path(content_hash):
+    """ Objects are spread over sub directories named after the first two hash characters. """
+    return Path(MOD_CACHE_OBJECTS, content_hash[:2], content_hash)
+
+
+def mod_ref_path(project_id, file_id):
+    """ Small json per (projectID, fileID) naming its object, lets rebuild_cache_index recover the mapping. """
+    return os.path.join(MOD_CACHE_REFS, str(project_id), str(file_id) + ".json")
+
+
+CACHE_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache_entries (
+    kind TEXT NOT NULL,
+    project_id TEXT NOT NULL,
+    file_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    hash TEXT,
+    last_access REAL NOT NULL DEFAULT 0,
+    hits INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (kind, project_id, file_id)
+);
+CREATE INDEX IF NOT EXISTS cache_entries_hash ON cache_entries (hash);
+CREATE TABLE IF NOT EXISTS resolved_urls (
+    project_id TEXT NOT NULL,
+    file_id TEXT NOT NULL,
+    url TEXT,
+    name TEXT,
+    size INTEGER NOT NULL DEFAULT 0,
+    resolved_at REAL NOT NULL,
+    PRIMARY KEY (project_id, file_id)
+);
+CREATE TABLE IF NOT EXISTS version_lists (
+    project_identifier TEXT PRIMARY KEY,
+    pack_source TEXT NOT NULL,
+    project_id TEXT NOT NULL,
+    project_name TEXT NOT NULL,
+    pack_icon_url TEXT,
+    version_rows TEXT NOT NULL,
+    complete INTEGER NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    fetched_at REAL NOT NULL
+);
+"""
+# kind is 'mod' or 'modpack', hash is set for mods and for modpack zips downloaded with DownloadWriter.
+# resolved_urls rows without url are files known to be missing from every source.
+# version_lists holds the json [type, file_id, title] rows of a project, complete is 0 if reading stopped early.
+_cache_db = None
+_cache_db_lock = threading.RLock()
+
+
+def cache_db():
+    """
+    Opens the sqlite cache index on first use. A new index is filled from disk with rebuild_cache_index.
+    The connection is shared by all threads, use it while holding _cache_db_lock.
+    """
+    global _cache_db
+    with _cache_db_lock:
+        if _cache_db is None:
+            create_dir_if_not_exist(CACHE_PATH)
+            new_index = not os.path.exists(CACHE_INDEX_DB)
+            _cache_db = sqlite3.connect(CACHE_INDEX_DB, timeout=30, check_same_thread=False, isolation_level=None)
+            _cache_db.row_factory = sqlite3.Row
+            _cache_db.execute("PRAGMA journal_mode=WAL")
+            _cache_db.execute("PRAGMA synchronous=NORMAL")
+            _cache_db.executescript(CACHE_INDEX_SCHEMA)
+            if new_index:
+                rebuild_cache_index()
+        return _cache_db
+
+
+def close_cache_db():
+    """ Closes the cache index, the next cache_db call opens it again, e.g. after CACHE_PATH moved. """
+    global _cache_db
+    with _cache_db_lock:
+        if _cache_db is not None:
+            _cache_db.close()
+            _cache_db = None
+
+
+def rebuild_cache_index():
+    """
+    Refills the cache index from disk: mod refs, the modpack zip directories and the json index
+    used before the sqlite one. Access times of entries without a record are taken from the files.
+    :return: number of entries indexed.
+    """
+    access_data = {}
+    with _cache_db_lock:
+        db = cache_db()
+        if os.path.exists(MOD_CACHE_INDEX_FILE):
+            old_index = load_json_file(MOD_CACHE_INDEX_FILE)
+            for key, cache_entry in old_index["mods"].items():
+                project_id, file_id = key.split("/")
+                write_mod_ref(project_id, file_id, cache_entry["hash"], cache_entry["name"])
+                access_data[("mod", project_id, file_id)] = cache_entry
+            for key, cache_entry in old_index.get("modpacks", {}).items():
+                project_id, file_id = key.split("/")
+                access_data[("modpack", project_id, file_id)] = cache_entry
+
+        rows = []
+        if os.path.isdir(MOD_CACHE_REFS):
+            for project_id in os.listdir(MOD_CACHE_REFS):
+                for ref_name in os.listdir(os.path.join(MOD_CACHE_REFS, project_id)):
+                    file_id = os.path.splitext(ref_name)[0]
+                    mod_ref = load_json_file(os.path.join(MOD_CACHE_REFS, project_id, ref_name))
+                    object_path = str(mod_object_path(mod_ref["hash"]))
+                    if os.path.exists(object_path):
+                        rows.append(["mod", project_id, file_id, mod_ref["name"], os.path.getsize(object_path),
+                                     mod_ref["hash"], os.path.getmtime(object_path)])
+        if os.path.isdir(MODPACK_ZIP_CACHE):
+            for project_id in os.listdir(MODPACK_ZIP_CACHE):
+                if not os.path.isdir(os.path.join(MODPACK_ZIP_CACHE, project_id)):
+                    continue  # pack_icon.png
+                for file_id in os.listdir(os.path.join(MODPACK_ZIP_CACHE, project_id)):
+                    file_dir = os.path.join(MODPACK_ZIP_CACHE, project_id, file_id)
+                    if os.path.isdir(file_dir) and os.listdir(file_dir):
+                        zip_path = os.path.join(file_dir, os.listdir(file_dir)[0])
+                        rows.append(["modpack", project_id, file_id, os.path.basename(zip_path),
+                                     os.path.getsize(zip_path), None, os.path.getmtime(zip_path)])
+        db.execute("BEGIN")
+        db.execute("DELETE FROM cache_entries")
+        for row in rows:
+            known = access_data.get((row[0], row[1], row[2]), {})
+            db.execute("INSERT OR REPLACE INTO cache_entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                       row[:6] + [known.get("last_access", row[6]), known.get("hits", 0)])
+        db.execute("COMMIT")
+        if os.path.exists(MOD_CACHE_INDEX_FILE):
+            os.remove(MOD_CACHE_INDEX_FILE)
+    log.info("Cache index rebuilt with {0} entries".format(len(rows)))
+    return len(rows)
+
+
+def lookup_cache_entry(kind, project_id, file_id):
+    """
+    :return: dictionary of the cache_entries row, or None if not indexed.
+    """
+    with _cache_db_lock:
+        row = cache_db().execute(
+            "SELECT * FROM cache_entries WHERE kind = ? AND project_id = ? AND file_id = ?",
+            (kind, str(project_id), str(file_id))).fetchone()
+    if row is None:
+        return None
+    return dict(row)
+
+
+def lookup_cache_entries(kind, dependencies):
+    """
+    Batch version of lookup_cache_entry for a whole manifest.
+    :param dependencies: manifest 'files' entries with 'projectID' and 'fileID'.
+    :return: dictionary of mod_cache_key -> cache_entries row for the ones that are indexed.
+    """
+    cache_entries_found = {}
+    keys = [(str(dependency['projectID']), str(dependency['fileID'])) for dependency in dependencies]
+    with _cache_db_lock:
+        db = cache_db()
+        for start in range(0, len(keys), 400):  # Stay below sqlite's 999 bound parameters.
+            batch = keys[start:start + 400]
+            query = ("SELECT * FROM cache_entries WHERE kind = ? AND (project_id, file_id) IN (VALUES " +
+                     ", ".join(["(?, ?)"] * len(batch)) + ")")
+            parameters = [kind]
+            for key in batch:
+                parameters.extend(key)
+            for row in db.execute(query, parameters):
+                cache_entries_found[mod_cache_key(row["project_id"], row["file_id"])] = dict(row)
+    return cache_entries_found
+
+
+def record_cache_entry(kind, project_id, file_id, name, size, content_hash=None):
+    with _cache_db_lock:
+        cache_db().execute(
+            "INSERT OR REPLACE INTO cache_entries VALUES (?, ?, ?, ?, ?, ?, ?, 0)",
+            (kind, str(project_id), str(file_id), name, size, content_hash, time.time()))
+
+
+def touch_cache_entry(kind, project_id, file_id):
+    """ Records an access for cache eviction. """
+    with _cache_db_lock:
+        cache_db().execute(
+            "UPDATE cache_entries SET last_access = ?, hits = hits + 1 "
+            "WHERE kind = ? AND project_id = ? AND file_id = ?",
+            (time.time(), kind, str(project_id), str(file_id)))
+
+
+def remove_cache_entry(kind, project_id, file_id):
+    """ Forgets an entry, the files themselves are left to the caller. """
+    with _cache_db_lock:
+        cache_db().execute(
+            "DELETE FROM cache_entries WHERE kind = ? AND project_id = ? AND file_id = ?",
+            (kind, str(project_id), str(file_id)))
+    if kind == "mod" and os.path.exists(mod_ref_path(project_id, file_id)):
+        os.remove(mod_ref_path(project_id, file_id))
+
+
+def write_mod_ref(project_id, file_id, content_hash, file_name):
+    create_dir_if_not_exist(os.path.dirname(mod_ref_path(project_id, file_id)))
+    save_json_file({"hash": content_hash, "name": file_name}, mod_ref_path(project_id, file_id))
+
+
+def add_mod_cache_object(src_file, project_id, file_id, file_name, content_hash=None):
+    """
+    Moves src_file into the content addressed store and maps (project_id, file_id) to it.
+    If identical bytes are already stored src_file is removed instead.
+    :param content_hash: hash of src_file if already known, read from the file when not given.
+    :return: Path of the stored object.
+    """
+    if content_hash is None:
+        content_hash = file_hash(src_file)
+    object_path = mod_object_path(content_hash)
+    with cache_wide_lock:
+        if object_path.exists():
+            log.debug("mod cache dedup: " + str(src_file) + " == " + str(object_path))
+            os.remove(str(src_file))
+        else:
+            log.debug("publish_cache_file: src: " + str(src_file) + " dst: " + str(object_path))
+            publish_cache_file(str(src_file), str(object_path))
+        write_mod_ref(project_id, file_id, content_hash, file_name)
+        record_cache_entry("mod", project_id, file_id, file_name, object_path.stat().st_size, content_hash)
+    return object_path
+
+
+def migrate_mod_cache():
+    """
+    Moves files from the old mods_cache/<projectID>/<fileID>/<name> layout into the content addressed store.
+    :return: number of files migrated.
+    """
+    migrated = 0
+    if not os.path.isdir(MOD_CACHE):
+        return migrated
+    for project_dir in os.listdir(MOD_CACHE):
+        if not project_dir.isdigit() or not os.path.isdir(os.path.join(MOD_CACHE, project_dir)):
+            continue
+        for file_dir in os.listdir(os.path.join(MOD_CACHE, project_dir)):
+            dep_cache_dir = os.path.join(MOD_CACHE, project_dir, file_dir)
+            if not os.path.isdir(dep_cache_dir):
+                continue
+            dep_files = os.listdir(dep_cache_dir)
+            if dep_files:
+                add_mod_cache_object(os.path.join(dep_cache_dir, dep_files[0]), project_dir, file_dir, dep_files[0])
+                migrated += 1
+        shutil.rmtree(os.path.join(MOD_CACHE, project_dir), onerror=shutil_rmtree_on_rm_error)
+    if migrated:
+        log.info("Migrated {0} cached mods into {1}".format(migrated, MOD_CACHE_OBJECTS))
+    return migrated
+
+
+def cache_entries():
+    """
+    Groups the cache contents into removable units. Mod objects shared by several index keys are one unit.
+    Mod objects instances link to are left out, see mod_object_pinned and pinned_cache_size.
+    :return: list of dictionaries with 'paths', 'size', 'last_access', 'hits', 'keys' [kind, projectID, fileID]
+        and 'lock', the CacheFileLock to hold while removing an interrupted download, else None.
+    """
+    entries = []
+    objects = {}
+    with _cache_db_lock:
+        rows = [dict(row) for row in cache_db().execute("SELECT * FROM cache_entries")]
+    for row in rows:
+        row_key = [row["kind"], row["project_id"], row["file_id"]]
+        if row["kind"] == "modpack":
+            entries.append({
+                "paths": [modpack_zip_path(row["project_id"], row["file_id"], row["name"])], "size": row["size"],
+                "last_access": row["last_access"], "hits": row["hits"], "keys": [row_key], "lock": None})
+            continue
+        if row["hash"] not in objects:
+            objects[row["hash"]] = {
+                "paths": [str(mod_object_path(row["hash"]))], "size": row["size"],
+                "last_access": 0, "hits": 0, "keys": [], "lock": None}
+        cache_object = objects[row["hash"]]
+        cache_object["last_access"] = max(cache_object["last_access"], row["last_access"])
+        cache_object["hits"] += row["hits"]
+        cache_object["keys"].append(row_key)
+    if program_settings[KEY.install_strategy] == 'symlink':
+        log.debug("install_strategy is symlink, cached mods are kept since instances point at them.")
+    entries.extend(cache_object for cache_object in objects.values()
+                   if not mod_object_pinned(cache_object["paths"][0]))
+
+    # Interrupted downloads waiting to be resumed.
+    for file_name in os.listdir(CACHE_PATH) if os.path.isdir(CACHE_PATH) else []:
+        if file_name.endswith('.part'):
+            part_path = os.path.join(CACHE_PATH, file_name)
+            cache_lock = part_cache_lock(file_name)
+            if cache_lock is not None:
+                if not cache_lock.try_acquire():
+                    continue  # Being downloaded right now, here or by another process.
+                cache_lock.release()
+            entries.append({
+                "paths": [part_path, part_sidecar_path(part_path)], "size": os.path.getsize(part_path),
+                "last_access": os.path.getmtime(part_path), "hits": 0, "keys": [], "lock": cache_lock})
+    # Quarantined files are only kept for inspection, they go first.
+    for file_name in os.listdir(QUARANTINE_PATH) if os.path.isdir(QUARANTINE_PATH) else []:
+        quarantine_path = os.path.join(QUARANTINE_PATH, file_name)
+        entries.append({"paths": [quarantine_path], "size": os.path.getsize(quarantine_path),
+                        "last_access": 0, "hits": -1, "keys": [], "lock": None})
+    return entries
+
+
+def mod_object_pinned(object_path):
+    """
+    :return: True if instances link to the cached mod object. Removing a hardlinked one would free nothing,
+        removing a symlinked one would break the instances.
+    """
+    if program_settings[KEY.install_strategy] == 'symlink':
+        return True
+    try:
+        return os.stat(object_path).st_nlink > 1
+    except OSError:
+        return False
+
+
+def pinned_cache_size():
+    """
+    Size of the cached mod objects instances link to. They are not counted against the cache budget,
+    that disk space belongs to the instances and is freed once the last one using a mod is removed.
+    :return: bytes.
+    """
+    with _cache_db_lock:
+        object_sizes = dict((row["hash"], row["size"]) for row in
+                            cache_db().execute("SELECT hash, size FROM cache_entries WHERE kind = 'mod'"))
+    return sum(object_size for object_hash, object_size in object_sizes.items()
+               if mod_object_pinned(str(mod_object_path(object_hash))))
+
+
+def remove_orphan_mod_objects():
+    """
+    Deletes objects no index entry points at, left behind when a run stopped between storing and indexing.
+    :return: bytes reclaimed.
+    """
+    reclaimed = 0
+    if not os.path.isdir(MOD_CACHE_OBJECTS):
+        return reclaimed
+    with cache_wide_lock, _cache_db_lock:
+        known_hashes = set(row[0] for row in cache_db().execute(
+            "SELECT DISTINCT hash FROM cache_entries WHERE kind = 'mod'"))
+        for hash_prefix in os.listdir(MOD_CACHE_OBJECTS):
+            for content_hash in os.listdir(os.path.join(MOD_CACHE_OBJECTS, hash_prefix)):
+                if content_hash not in known_hashes:
+                    object_path = os.path.join(MOD_CACHE_OBJECTS, hash_prefix, content_hash)
+                    reclaimed += os.path.getsize(object_path)
+                    os.remove(object_path)
+    return reclaimed
+
+
+def cache_gc(max_size_mb=None, policy=None):
+    """
+    Evicts cache entries until the cache fits its budget. Entries used in the last CACHE_GC_GRACE_SECONDS are kept,
+    so the cache can stay over budget until the next run. Mod objects instances link to are neither evicted nor
+    counted against the budget, their size is logged, see pinned_cache_size.
+    :param max_size_mb: cache budget, 0 for no limit. Defaults to program_settings 'cache_max_size_mb'.
+    :param policy: 'lru' evicts the least recently used first, 'lfu' the least often used.
+        Defaults to program_settings 'cache_eviction_policy'.
+    :return: bytes reclaimed.
+    """
+    if max_size_mb is None:
+        max_size_mb = program_settings[KEY.cache_max_size_mb]
+    if policy is None:
+        policy = program_settings[KEY.cache_eviction_policy]
+    max_size = int(float(max_size_mb) * 1024 * 1024)
+    with cache_wide_lock, _cache_db_lock:
+        reclaimed = remove_orphan_mod_objects()
+        entries = cache_entries()
+        cache_size = sum(cache_entry["size"] for cache_entry in entries)
+        log.debug("cache size: " + get_human_readable(cache_size) + " budget: " + get_human_readable(max_size))
+        if max_size > 0 and cache_size > max_size:
+            if policy == 'lfu':
+                entries.sort(key=lambda cache_entry: (cache_entry["hits"], cache_entry["last_access"]))
+            else:
+                entries.sort(key=lambda cache_entry: cache_entry["last_access"])
+            in_use_since = time.time() - CACHE_GC_GRACE_SECONDS
+            for cache_entry in entries:
+                if cache_size <= max_size:
+                    break
+                if cache_entry["keys"] and cache_entry["last_access"] > in_use_since:
+                    continue  # Just stored or looked up, maybe by a process still installing it.
+                cache_lock = cache_entry["lock"]
+                if cache_lock is not None and not cache_lock.try_acquire():
+                    continue  # Download resumed since the entries were listed.
+                try:
+                    for entry_path in cache_entry["paths"]:
+                        if os.path.exists(entry_path):
+                            os.remove(entry_path)
+                finally:
+                    if cache_lock is not None:
+                        cache_lock.release()
+                for kind, project_id, file_id in cache_entry["keys"]:
+                    remove_cache_entry(kind, project_id, file_id)
+                    if kind == "modpack":
+                        try:
+                            os.rmdir(os.path.join(MODPACK_ZIP_CACHE, project_id, file_id))
+                        except OSError:
+                            pass
+                cache_size -= cache_entry["size"]
+                reclaimed += cache_entry["size"]
+    log.info("Cache gc reclaimed {0}, {1} more is linked into instances and not counted.".format(
+        get_human_readable(reclaimed), get_human_readable(pinned_cache_size())))
+    return reclaimed
+
+
+def enforce_cache_budget():
+    """ Runs cache_gc after an install when program_settings sets a cache budget. """
+    if float(program_settings[KEY.cache_max_size_mb]) > 0:
+        cache_gc()
+
+
+def verify_cache(repair=False, max_workers=None):
+    """
+    Hashes every cached mod object and modpack zip again and compares them with the cache index.
+    Files are checked on worker threads, hashlib releases the GIL while hashing so this uses several cores
+    without multiprocessing, which the frozen builds leave out.
+    :param repair: quarantine bad files and drop their index entries so the next install downloads them again.
+        Instances with a hardlink to a bad object keep their copy, check the listed keys.
+    :param max_workers: files checked at once, defaults to the cpu count.
+    :return: {"checked": number of files, "bad": list of dictionaries with 'path', 'problem' and
+        'keys' [kind, projectID, fileID], "repaired": repair}
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    with _cache_db_lock:
+        rows = [dict(row) for row in cache_db().execute("SELECT * FROM cache_entries")]
+    # [path, file name, size, hash, keys] of each file, mod objects shared by several keys are checked once.
+    cache_files = {}
+    for row in rows:
+        if row["kind"] == "modpack":
+            path = modpack_zip_path(row["project_id"], row["file_id"], row["name"])
+        else:
+            path = str(mod_object_path(row["hash"]))
+        if path not in cache_files:
+            cache_files[path] = [path, row["name"], row["size"], row["hash"], []]
+        cache_files[path][4].append([row["kind"], row["project_id"], row["file_id"]])
+
+    bad = []
+    with ThreadPoolExecutor(max_workers=max(1, int(max_workers))) as executor:
+        futures = {executor.submit(check_file_integrity, *cache_file[:4]): cache_file
+                   for cache_file in cache_files.values()}
+        for future in as_completed(futures):
+            path, file_name, size, content_hash, keys = futures[future]
+            problem = future.result()
+            if problem:
+                log.warning("Bad cache file {0}: {1}".format(path, problem))
+                bad.append({"path": path, "problem": problem, "keys": keys})
+
+    if repair:
+        for bad_file in bad:
+            if os.path.exists(bad_file["path"]):
+                quarantine_file(bad_file["path"], bad_file["problem"])
+            for kind, project_id, file_id in bad_file["keys"]:
+                remove_cache_entry(kind, project_id, file_id)
+    log.info("Cache verified: {0} files, {1} bad".format(len(cache_files), len(bad)))
+    return {"checked": len(cache_files), "bad": bad, "repaired": repair}
+
+
+def cached_mod_file(dependency, cache_entry=None):
+    """
+    :param dependency: manifest 'files' entry with 'projectID' and 'fileID'.
+    :param cache_entry: index row from lookup_cache_entries, looked up when not given.
+    :return: [object_path, file_name] of the cached file, or None if it is not cached.
+    """
+    if cache_entry is None:
+        cache_entry = lookup_cache_entry("mod", dependency['projectID'], dependency['fileID'])
+        if cache_entry is None:
+            return None
+    object_path = mod_object_path(cache_entry["hash"])
+    with cache_wide_lock:  # The touch keeps cache_gc off the object until the caller has linked it.
+        try:
+            object_size = object_path.stat().st_size
+        except OSError:
+            object_size = -1
+        if object_size != cache_entry["size"]:
+            # Object missing or changed on disk, forget it so the file gets downloaded again.
+            log.warning("Cached mod does not match index, dropping: " +
+                        mod_cache_key(dependency['projectID'], dependency['fileID']))
+            if object_size >= 0:
+                quarantine_file(object_path, "size does not match the cache index")
+            remove_cache_entry("mod", dependency['projectID'], dependency['fileID'])
+            return None
+        touch_cache_entry("mod", dependency['projectID'], dependency['fileID'])
+    metrics_count("cache_hits")
+    metrics_count("bytes_saved", object_size)
+    return [object_path, cache_entry["name"]]
+
+
+def store_mod_in_cache(part_path, dependency, file_name, content_hash=None):
+    """
+    Moves a finished download into the mod cache.
+    :param content_hash: see add_mod_cache_object.
+    :return: [object_path, file_name] of the cached file.
+    """
+    finish_part_download(part_path)
+    object_path = add_mod_cache_object(
+        part_path, dependency['projectID'], dependency['fileID'], file_name, content_hash)
+    return [object_path, file_name]
+
+
+# Strategies tried in order for each install_strategy setting.
+INSTALL_STRATEGY_FALLBACKS = {
+    'hardlink': ['hardlink', 'reflink', 'copy'],
+    'reflink': ['reflink', 'copy'],
+    'symlink': ['symlink', 'copy'],
+    'copy': ['copy']
+}
+FICLONE = 0x40049409  # linux/fs.h ioctl, copy on write clone on btrfs, xfs and similar.
+# (strategy, st_dev) pairs that already failed, so every later file goes straight to the next strategy.
+_unsupported_install_strategies = set()
+
+
+def reflink_file(src, dst):
+    """
+    Creates dst as a copy on write clone of src. Only supported on linux filesystems with FICLONE.
+    :raises OSError: when the platform or filesystem can't clone.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError(errno.EOPNOTSUPP, "reflink not supported on this platform", dst)
+    with open(src, 'rb') as src_file:
+        with open(dst, 'wb') as dst_file:
+            try:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            except OSError:
+                dst_file.close()
+                os.remove(dst)
+                raise
+
+
+def link_or_copy_file(src, dst, strategy=None):
+    """
+    Puts src at dst using the install strategy, falling back to cheaper supported ones.
+    An existing dst is removed first so a linked file is never written through.
+    :param strategy: hardlink, reflink, symlink or copy. Defaults to program_settings 'install_strategy'.
+    :return: strategy that was used.
+    """
+    if strategy is None:
+        strategy = program_settings[KEY.install_strategy]
+    if os.path.lexists(dst):
+        os.remove(dst)
+    dst_device = os.stat(os.path.dirname(os.path.abspath(dst))).st_dev
+    for install_type in INSTALL_STRATEGY_FALLBACKS.get(strategy, ['copy']):
+        if (install_type, dst_device) in _unsupported_install_strategies:
+            continue
+        try:
+            if install_type == 'hardlink':
+                os.link(src, dst)
+            elif install_type == 'reflink':
+                reflink_file(src, dst)
+            elif install_type == 'symlink':
+                os.symlink(os.path.abspath(src), dst)
+            else:
+                shutil.copyfile(src, dst)
+            return install_type
+        except (OSError, NotImplementedError) as e:
+            if install_type == 'copy':
+                raise
+            log.debug(install_type + " install failed, trying next: " + str(e))
+            _unsupported_install_strategies.add((install_type, dst_device))
+    raise OSError("No install strategy worked for: " + str(dst))
+
+
+def install_cached_mod(object_path, file_name, mods_path):
+    """
+    Links or copies a cached mod into the instance mods directory.
+    :param mods_path: None to only have the file in the cache, e.g. for prefetch_modpack.
+    :return: installed file name.
+    """
+    if mods_path is None:
+        return file_name
+    target_file = mods_path / file_name
+    install_type = link_or_copy_file(str(object_path), str(target_file))
+    log.debug(install_type + ": src: " + str(object_path) + " dst: " + str(target_file))
+    return target_file.name
+
+
+def lookup_resolved_url(dependency):
+    """
+    :param dependency: manifest 'files' entry with 'projectID' and 'fileID'.
+    :return: dictionary with 'url', 'name' and 'size' of an unexpired resolution, 'url' is None for files
+        known to be missing. None if the download has to be resolved again.
+    """
+    with _cache_db_lock:
+        row = cache_db().execute(
+            "SELECT * FROM resolved_urls WHERE project_id = ? AND file_id = ?",
+            (str(dependency['projectID']), str(dependency['fileID']))).fetchone()
+    if row is None:
+        return None
+    if row["url"] is None:
+        ttl_hours = program_settings[KEY.missing_file_ttl_hours]
+    else:
+        ttl_hours = program_settings[KEY.resolved_url_ttl_hours]
+    if time.time() - row["resolved_at"] > float(ttl_hours) * 3600:
+        return None
+    metrics_count("resolved_url_hits")
+    return dict(row)
+
+
+def known_missing_file(dependency):
+    """
+    :return: True if the last resolve found the file missing from every source, False if it was found
+        or not resolved yet, e.g. when resolving raised.
+    """
+    with _cache_db_lock:
+        row = cache_db().execute(
+            "SELECT url FROM resolved_urls WHERE project_id = ? AND file_id = ?",
+            (str(dependency['projectID']), str(dependency['fileID']))).fetchone()
+    return row is not None and row["url"] is None
+
+
+def record_resolved_url(dependency, file_url=None, file_name=None, file_size=0):
+    """
+    Remembers where a mod downloads from. Without file_url the file is remembered as missing.
     """
+    with _cache_db_lock:
+        cache_db().execute(
+            "INSERT OR REPLACE INTO resolved_urls VALUES (?, ?, ?, ?, ?, ?)",
+            (str(dependency['projectID']), str(dependency['fileID']), file_url, file_name, file_size or 0,
+             time.time()))
+
+
+def resolve_mod_download(dependency, host_limiter, refresh=False):
+    """
+    Follows the curseforge download redirect, falling back to cursemeta, unless the result is remembered.
+    :param refresh: ignore the remembered resolution, used when a remembered url stopped working.
+    :return: [file_url, file_name, remembered], or None if the file is missing from the source.
+    """
+    if not refresh:
+        resolved = lookup_resolved_url(dependency)
+        if resolved is not None:
+            if resolved["url"] is None:
+                return None
+            return [resolved["url"], resolved["name"], True]
+
+    download_url = mod_download_url(dependency)
+    with host_limiter.slot(download_url):
+        # Only the resolved url is needed, HEAD follows the redirects without opening the file itself,
+        # closing an unread GET body would drop the connection from the pool.
+        file_response = http_session().head(download_url, allow_redirects=True)
+        if file_response.status_code not in (200, 404):
+            file_response = http_session().get(download_url, stream=True)
+            file_response.close()
+    file_url = file_response.url
+    file_name = file_name_from_url(file_url)
+
+    log.debug(str(file_response.status_code))
+
+    if (file_response.status_code == 404) or (file_name == "download"):
+        log.info("{0}/{1} Trying to resolve using alternate requesting.".format(
+            dependency['projectID'], dependency['fileID']))
+        metrics_count("cursemeta_fallbacks")
+        metaurl = cursemeta_url(dependency)
+        with host_limiter.slot(metaurl):
+            r = http_session().get(metaurl)
+        # TODO: catch 502 badgateway erros and continue with the rest of download?
+        r.raise_for_status()
+        main_json = r.json()
+        if "code" in main_json:
+            # TODO: READD: erred_mod_downloads.append(metaurl.url)
+            record_resolved_url(dependency)
+            return None
+        file_url = main_json["DownloadURL"]
+        file_name = main_json["FileNameOnDisk"]
+    record_resolved_url(dependency, file_url, file_name)
+    return [file_url, file_name, False]
+
+
+_in_flight_lock = threading.Lock()
+_in_flight_downloads = {}  # mod_cache_key -> Future of the thread downloading it, done once it is cached or failed.
+
+
+def join_in_flight_download(dependency):
+    """
+    Makes the caller the one downloading dependency, unless another thread already is.
+    :return: [future, owner] the owner downloads and calls finish_in_flight_download,
+        everyone else waits for future and then takes the file from the cache.
+    """
+    key = mod_cache_key(dependency['projectID'], dependency['fileID'])
+    with _in_flight_lock:
+        if key in _in_flight_downloads:
+            return [_in_flight_downloads[key], False]
+        _in_flight_downloads[key] = Future()
+        return [_in_flight_downloads[key], True]
+
+
+def finish_in_flight_download(dependency, future):
+    with _in_flight_lock:
+        _in_flight_downloads.pop(mod_cache_key(dependency['projectID'], dependency['fileID']), None)
+    future.set_result(None)
+
+
+def install_joined_download(dependency, mods_path):
+    """
+    Installs a file another thread just downloaded, see join_in_flight_download.
+    :return: installed file name, or None if that download failed.
+    """
+    metrics_count("in_flight_joins")
+    cached_file = cached_mod_file(dependency)
+    if cached_file is None:
+        message = "ERROR FILE MISSING FROM SOURCE" if known_missing_file(dependency) else "ERROR DOWNLOAD FAILED"
+        report_progress(message, EVENT.file_failed, mod_cache_key(dependency['projectID'], dependency['fileID']))
+        return None
+    file_name = install_cached_mod(cached_file[0], cached_file[1], mods_path)
+    report_progress("%s (joined download)" % file_name, file_name=file_name)
+    return file_name
+
+
+def report_download_error(dependency, error):
+    """ Reports a dependency whose download raised, the other dependencies of the run go on without it. """
+    key = mod_cache_key(dependency['projectID'], dependency['fileID'])
+    log.error("Downloading " + key + " failed: " + str(error))
+    report_progress("ERROR DOWNLOAD FAILED, " + (str(error) or type(error).__name__), EVENT.file_failed, key)
+
+
+def download_mod_dependency(dependency, mods_path, host_limiter):
+    """
+    Fetches a single manifest dependency into the cache and copies it into mods_path.
+    Safe to run from several worker threads at once, a file is only downloaded by one of them at a time.
+    :param dependency: manifest 'files' entry with 'projectID' and 'fileID'.
+    :param mods_path: Path of the instance mods directory, None to only fill the cache.
+    :param host_limiter: HostLimiter shared by all workers of this download.
+    :return: file name installed into mods_path, or None if the file is missing from the source
+        or could not be downloaded.
+    """
+    if InstanceInfo.master_thread_running is False:
+        log.error("Main Thread Dead, Joining it in the after life.")
+        sys.exit()
+    cached_file = cached_mod_file(dependency)
+    if cached_file is not None:
+        # Cache access is successful,
+        # Don't download the file
+        file_name = install_cached_mod(cached_file[0], cached_file[1], mods_path)
+        report_progress("%s (in cache)" % file_name, file_name=file_name)
+        return file_name
+
+    in_flight, owner = join_in_flight_download(dependency)
+    if not owner:
+        in_flight.result()
+        return install_joined_download(dependency, mods_path)
+    downloaded = None
+    try:
+        with CacheFileLock(dependency['projectID'], dependency['fileID']):
+            # Another worker or process may have cached it since the check above.
+            cached_file = cached_mod_file(dependency)
+            if cached_file is None:
+                downloaded = download_mod_file(dependency, host_limiter)
+    except (OSError, ValueError) as e:  # requests.RequestException is an OSError, a bad json reply a ValueError.
+        report_download_error(dependency, e)
+        return None
+    finally:
+        finish_in_flight_download(dependency, in_flight)
+    if cached_file is not None:
+        file_name = install_cached_mod(cached_file[0], cached_file[1], mods_path)
+        report_progress("%s (in cache)" % file_name, file_name=file_name)
+        return file_name
+    if downloaded is None:
+        return None
+    cached_file, file_size = downloaded
+    file_name = install_cached_mod(cached_file[0], cached_file[1], mods_path)
+    report_downloaded(file_name, file_size)
+    return file_name
+
+
+def download_mod_file(dependency, host_limiter):
+    """
+    Downloads a dependency that is not cached into the cache, missing or damaged files are reported as progress.
+    Hold the dependency's CacheFileLock while calling this, connection errors are raised to the caller.
+    :return: [[object_path, file_name], file_size] or None if the file is missing from the source or damaged.
+    """
+    download_started = time.time()
+    for refresh in (False, True):
+        resolved_download = resolve_mod_download(dependency, host_limiter, refresh)
+        if resolved_download is None:
+            report_progress("ERROR FILE MISSING FROM SOURCE", EVENT.file_failed,
+                            mod_cache_key(dependency['projectID'], dependency['fileID']))
+            return None
+        file_url, file_name, remembered = resolved_download
+
+        part_path = mod_part_path(dependency, file_name)
+        with host_limiter.slot(file_url):
+            request_started = time.time()
+            requested_file_sess, open_mode, offset, file_size = request_part_download(file_url, part_path)
+            ttfb = time.time() - request_started
+            log.debug(str(requested_file_sess.headers.get('content-type')))
+            status = requested_file_sess.status_code
+            if status not in (200, 206):
+                requested_file_sess.close()
+                if refresh:
+                    report_progress("ERROR DOWNLOAD FAILED WITH STATUS " + str(status), EVENT.file_failed, file_name)
+                    return None
+                # A remembered url stopped working or the server failed once, resolve it again.
+                log.info("Download answered {0}, resolving again: {1}".format(status, file_url))
+                metrics_count("retries")
+                continue
+            report_download_started(file_name, file_size, offset)
+
+            if InstanceInfo.master_thread_running is False:
+                requested_file_sess.close()
+                log.error("Main Thread Dead, Joining it in the after life.")
+                sys.exit()
+
+            # The .part file and its sidecar are kept on cancel or error so the next attempt resumes them.
+            with DownloadWriter(part_path, open_mode, offset, file_size, file_name) as writer:
+                if not stream_response(requested_file_sess, writer):
+                    log.error("Main Thread Dead, Joining it in the after life.")
+                    sys.exit()
+        problem = check_file_integrity(part_path, file_name, file_size)
+        if problem:
+            # Cut off or damaged, the part can't be resumed so the file is requested once more from scratch.
+            quarantine_file(part_path, problem)
+            if refresh:
+                report_progress("ERROR DOWNLOAD DAMAGED, " + problem, EVENT.file_failed, file_name)
+                return None
+            metrics_count("retries")
+            continue
+        break
+    record_resolved_url(dependency, file_url, file_name, file_size)
+    metrics_file(file_name, writer.received, time.time() - download_started, ttfb)
+
+    # Try to add file to cache.
+    return [store_mod_in_cache(part_path, dependency, file_name, writer.content_hash), file_size]
+
+
+def prepare_mod_install(instance_dir, install_type=None):
+    """
+    Checks the instance manifest and moves the pack overrides into place if the zip was extracted as is.
     :param instance_dir: The minecraft directory that contains the curse manifest.json file.
-    :return: True on success, False on failure.
+    :param install_type: see instance_game_dir.
+    :return: [manifest_json, mods_path] or [None, None] if the manifest is not usable.
     """
-    InstanceInfo().reset_dl()
     manifest_path = os.path.abspath(os.path.join(instance_dir, "manifest.json"))
     log.debug(str(manifest_path))
     manifest_json = load_json_file(manifest_path)
 
     if 'manifestType' not in manifest_json or not manifest_json['manifestType'] == 'minecraftModpack':
         log.error('Manifest missing manifestType key entry.')
-        InstanceInfo.is_done = True
-        return False
+        return [None, None]
     elif 'manifestVersion' not in manifest_json or not manifest_json['manifestVersion'] == 1:
         log.error('Manifest missing manifestVersion key entry.')
-        InstanceInfo.is_done = True
-        return False
+        return [None, None]
     elif 'overrides' not in manifest_json:
         log.error('Manifest missing overrides key entry.')
-        InstanceInfo.is_done = True
-        return False
+        return [None, None]
     elif 'files' not in manifest_json:
         log.error('Manifest missing files key entries.')
-        InstanceInfo.is_done = True
-        return False
+        return [None, None]
 
     override_path = Path(instance_dir, manifest_json['overrides'])
-    minecraft_path = Path(instance_dir, "minecraft")
+    minecraft_path = Path(instance_game_dir(instance_dir, install_type))
     mods_path = Path(minecraft_path, "mods")
 
     if override_path.exists():
@@ -769,147 +3333,301 @@ def download_mods(instance_dir):
     if not mods_path.exists():
         log.debug("mkdir: " + str(mods_path))
         mods_path.mkdir()
+    return [manifest_json, mods_path]
 
-    InstanceInfo.total_progress = len(manifest_json['files'])
+
+def download_dependencies(dependencies, mods_path, max_workers, max_per_host):
+    """
+    Runs download_mod_dependency for every dependency on a bounded thread pool.
+    :return: list of installed file names, None for files missing from the source.
+    """
+    max_workers = max(1, int(max_workers))
+    host_limiter = HostLimiter(max_per_host)
+    ensure_http_pool_size(max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = [executor.submit(download_mod_dependency, dependency, mods_path, host_limiter)
+                   for dependency in dependencies]
+        try:
+            for future in as_completed(pending):
+                future.result()
+        except BaseException:
+            # Stop queued dependencies from starting, in flight ones notice master_thread_running.
+            for future in pending:
+                future.cancel()
+            raise
+    return [future.result() for future in pending]
+
+
+def fetch_dependencies(dependencies, mods_path, max_workers=None, max_per_host=None):
+    """
+    Fetches and installs the dependencies with the configured backend, reporting [n/total] progress.
+    :param max_workers: dependencies processed at once. Defaults to program_settings 'download_threads',
+        or 'async_connections' with the asyncio backend.
+    :param max_per_host: requests allowed in flight per host. Defaults to program_settings 'download_threads_per_host',
+        or 'async_connections_per_host' with the asyncio backend.
+    :return: dictionary of mod_cache_key -> installed file name for every file that was installed.
+    """
+    InstanceInfo.total_progress = len(dependencies)
 
     log.info("Cached files are stored here:\n {0}\n".format(os.path.abspath(CACHE_PATH)))
     log.info("{0} files to download".format(InstanceInfo.total_progress))
     print("Cached files are stored here:\n {0}\n".format(os.path.abspath(CACHE_PATH)))
     print("{0} files to download".format(InstanceInfo.total_progress))
 
-    # TODO: Split downloading into 2 parts.
-    # 1st processes the manifest.
-    # 2nd part does the downloading.
-    # this allows editing the manifest contents passed to the download, making merging and removing in memory
-    # instead of doing it directory in the original manifest. This should help with update portion.
+    installed_mods = {}
     InstanceInfo.current_progress = 1
-    for dependency in manifest_json['files']:
-        if InstanceInfo.master_thread_running is False:
-            log.error("Main Thread Dead, Joining it in the after life.")
-            sys.exit()
-        dep_cache_dir = Path(str(MOD_CACHE) + "/" + str(dependency['projectID']) + "/" + str(dependency['fileID']))
-        if dep_cache_dir.is_dir():
-            # File is cached
-            dep_files = [f for f in dep_cache_dir.iterdir()]
-            if len(dep_files) >= 1:
-                dep_file = dep_files[0]
-                target_file = minecraft_path / "mods" / dep_file.name
-                shutil.copyfile(str(dep_file), str(target_file))
-                print("[%d/%d] %s (in cache)" % (InstanceInfo.current_progress, InstanceInfo.total_progress, target_file.name))
-
-                InstanceInfo.current_progress += 1
-
-                # Cache access is successful,
-                # Don't download the file
-                continue
+    # One index query for the whole manifest, cache hits are linked here and only misses go to the backend.
+    cache_entries_found = lookup_cache_entries("mod", dependencies)
+    missing = []
+    for dependency in dependencies:
+        key = mod_cache_key(dependency['projectID'], dependency['fileID'])
+        cached_file = None
+        if key in cache_entries_found:
+            cached_file = cached_mod_file(dependency, cache_entries_found[key])
+        if cached_file is None:
+            missing.append(dependency)
+            continue
+        installed_mods[key] = install_cached_mod(cached_file[0], cached_file[1], mods_path)
+        report_progress("%s (in cache)" % installed_mods[key], file_name=installed_mods[key])
+    metrics_count("cache_misses", len(missing))
+    if not missing:
+        return installed_mods
+
+    if use_async_backend():
+        import downloader_async
+        file_names = downloader_async.run(downloader_async.fetch_mods, missing, mods_path,
+                                          limit=max_workers, limit_per_host=max_per_host)
+    else:
+        if max_workers is None:
+            max_workers = program_settings[KEY.download_threads]
+        if max_per_host is None:
+            max_per_host = program_settings[KEY.download_threads_per_host]
+        file_names = download_dependencies(missing, mods_path, max_workers, max_per_host)
+    for dependency, file_name in zip(missing, file_names):
+        if file_name is not None:
+            installed_mods[mod_cache_key(dependency['projectID'], dependency['fileID'])] = file_name
+    return installed_mods
+
+
+def load_installed_mods(instance_dir):
+    """
+    :return: dictionary of mod_cache_key -> file name the manager put into the instance mods directory.
+    """
+    installed_mods_file = os.path.join(instance_dir, PDM_INSTANCE_FOLDER, INSTALLED_MODS_FILE)
+    if os.path.exists(installed_mods_file):
+        return load_json_file(installed_mods_file)["mods"]
+    return {}
 
-        # File is not cached and needs to be downloaded
-        try:
-            file_response = req_sess.get(
-                "http://minecraft.curseforge.com/projects/{0}/files/{1}/download".format(
-                    dependency['projectID'], dependency['fileID']), stream=True)
-            requested_file_sess = req_sess.get(file_response.url, stream=True)
-
-            remote_url = Path(requested_file_sess.url)
-            file_name = unquote(remote_url.name).split('?')[0]  # If query data strip it and return just the file name.
-
-            log.debug(str(requested_file_sess.status_code))
-            log.debug(str(requested_file_sess.headers['content-type']))
-
-            if (requested_file_sess.status_code == 404) or (file_name == "download"):
-                print(str("[%d/%d] " + "Trying to resolve using alternate requesting.") % (InstanceInfo.current_progress, InstanceInfo.total_progress))
-
-                # If curse website fails to provide correct url try Dries API list.
-                # get the json from Dries:
-                metabase = "https://cursemeta.dries007.net"
-                metaurl = "%s/%s/%s.json" % (metabase, dependency['projectID'], dependency['fileID'])
-                r = req_sess.get(metaurl)
-                # TODO: catch 502 badgateway erros and continue with the rest of download?
-                r.raise_for_status()
-                main_json = r.json()
-                if "code" in main_json:
-                    print(str("[%d/%d] " + "ERROR FILE MISSING FROM SOURCE") % (InstanceInfo.current_progress, InstanceInfo.total_progress))
-                    # TODO: READD: erred_mod_downloads.append(metaurl.url)
-                    InstanceInfo.current_progress += 1
-                    continue
-                fileurl = main_json["DownloadURL"]
-                file_name = main_json["FileNameOnDisk"]
-                requested_file_sess = req_sess.get(fileurl, stream=True)
-
-            InstanceInfo.file_size = int(requested_file_sess.headers.get('content-length', 0))
-            if InstanceInfo.file_size:
-                print(
-                    str("[{0}/{1}] " + file_name + " (DL: " + get_human_readable(InstanceInfo.file_size) + ")").format(
-                        InstanceInfo.current_progress, InstanceInfo.total_progress))
-            else:
-                print(str("[%d/%d] " + "MISSING FILE SIZE") % (InstanceInfo.current_progress, InstanceInfo.total_progress))
-                InstanceInfo.file_size = 100
 
-            if InstanceInfo.master_thread_running is False:
-                log.error("Main Thread Dead, Joining it in the after life.")
-                sys.exit()
-            InstanceInfo.current_file_size = 0
-
-            mod_part_path = os.path.join(CACHE_PATH, file_name + '.part')
-            with open(mod_part_path, 'wb') as file_data:
-                for chunk in requested_file_sess.iter_content(chunk_size=1024):
-                    InstanceInfo.current_file_size += len(chunk)
-                    file_data.write(chunk)
-                    if InstanceInfo.master_thread_running is False:
-                        file_data.close()
-                        os.remove(mod_part_path)
-                        log.error("Main Thread Dead, Joining it in the after life.")
-                        sys.exit()
-
-            # Try to add file to cache.
-            if not dep_cache_dir.exists():
-                log.debug("dep_cache.mkdir: " + str(dep_cache_dir))
-                dep_cache_dir.mkdir(parents=True)
-
-            log.debug("shutil.move: src: " + str(mod_part_path) +
-                      " dst: " + str(dep_cache_dir / file_name))
-
-            shutil.move(mod_part_path,
-                        str(dep_cache_dir / file_name))
-
-            log.debug("shutil.copyfile: src: " + str(dep_cache_dir / file_name) +
-                      " dst: " + str(dep_cache_dir / file_name))
-
-            shutil.copyfile(str(dep_cache_dir / file_name),
-                            str(mods_path / file_name))  # Rename from temp to correct file name.
-
-            InstanceInfo.current_progress += 1
-            log.debug("InstanceInfo.current_progress: " + str(InstanceInfo.current_progress))
-
-            # TODO: ADD: ERRED MOD DOWNLOADS DISPLAY
-            # if len(erred_mod_downloads) is not 0:
-            #     print("\n!! WARNING !!\nThe following mod downloads failed.")
-            #     for index in erred_mod_downloads:
-            #         print("- " + index)
-            #     # Create log of failed download links to pack manifest directory for user to inspect manually.
-            #     log_file = open(str(target_dir_path / "cursePackDownloaderModErrors.log"), 'w')
-            #     log_file.write("\n".join(str(elem) for elem in erred_mod_downloads))
-            #     log_file.close()
-            #     print("See log in manifest directory for list.\n!! WARNING !!\n")
-            #     erred_mod_downloads.clear()
-
-            # Catch any threaded exceptions, mark the thread as finished and the re-raise the exception.
-            # this allows calling thread to detect the thread has finished processing and can continue doing "stuff".
-        except Exception as e:
-            InstanceInfo.is_done = True
-            raise e
+def save_installed_state(instance_dir, installed_mods):
+    """
+    Records the installed mod files and a copy of the manifest they came from, used by update_mods.
+    """
+    create_dir_if_not_exist(os.path.join(instance_dir, PDM_INSTANCE_FOLDER))
+    save_json_file({"mods": installed_mods}, os.path.join(instance_dir, PDM_INSTANCE_FOLDER, INSTALLED_MODS_FILE))
+    shutil.copyfile(os.path.join(instance_dir, "manifest.json"),
+                    os.path.join(instance_dir, PDM_INSTANCE_FOLDER, "manifest.json"))
+
+
+def diff_manifests(old_manifest_json, new_manifest_json):
+    """
+    Compares the 'files' of two manifests by (projectID, fileID).
+    A project that changed fileID shows up as removed with the old entry and added with the new one.
+    :return: [added, removed, unchanged] lists of manifest 'files' entries.
+    """
+    old_keys = set(mod_cache_key(dependency['projectID'], dependency['fileID'])
+                   for dependency in old_manifest_json['files'])
+    new_keys = set(mod_cache_key(dependency['projectID'], dependency['fileID'])
+                   for dependency in new_manifest_json['files'])
+    added = [dependency for dependency in new_manifest_json['files']
+             if mod_cache_key(dependency['projectID'], dependency['fileID']) not in old_keys]
+    removed = [dependency for dependency in old_manifest_json['files']
+               if mod_cache_key(dependency['projectID'], dependency['fileID']) not in new_keys]
+    unchanged = [dependency for dependency in new_manifest_json['files']
+                 if mod_cache_key(dependency['projectID'], dependency['fileID']) in old_keys]
+    return [added, removed, unchanged]
+
+
+def installed_mod_name(installed_mods, dependency):
+    """
+    :return: file name of an installed dependency, taken from the cache index for instances
+        installed before installed_mods.json was kept. None if unknown.
+    """
+    key = mod_cache_key(dependency['projectID'], dependency['fileID'])
+    if key in installed_mods:
+        return installed_mods[key]
+    cache_entry = lookup_cache_entry("mod", dependency['projectID'], dependency['fileID'])
+    if cache_entry is not None:
+        return cache_entry["name"]
+    return None
+
+
+def plan_mod_update(instance_dir, manifest_json, mods_path):
+    """
+    Works out which mods an instance still needs against the manifest of its previous install,
+    the files of mods the new manifest dropped are removed from mods_path.
+    Without a previous manifest every mod is needed.
+    :param manifest_json: the new manifest, from prepare_mod_install.
+    :return: [to_fetch, installed_mods] the manifest 'files' entries to fetch and
+        mod_cache_key -> file name of the mods already in place.
+    """
+    old_manifest_path = os.path.join(instance_dir, PDM_INSTANCE_FOLDER, "manifest.json")
+    if not os.path.exists(old_manifest_path):
+        return [list(manifest_json['files']), {}]
+    added, removed, unchanged = diff_manifests(load_json_file(old_manifest_path), manifest_json)
+    installed_mods = load_installed_mods(instance_dir)
+    log.info("Update: {0} added, {1} removed, {2} unchanged".format(len(added), len(removed), len(unchanged)))
+
+    for dependency in removed:
+        file_name = installed_mod_name(installed_mods, dependency)
+        installed_mods.pop(mod_cache_key(dependency['projectID'], dependency['fileID']), None)
+        if file_name is None:
+            log.warning("Unknown file for removed mod {0}/{1}, left in place.".format(
+                dependency['projectID'], dependency['fileID']))
+        elif os.path.lexists(str(mods_path / file_name)):
+            log.debug("os.remove: " + str(mods_path / file_name))
+            os.remove(str(mods_path / file_name))
+            print("Removed " + file_name)
+
+    to_fetch = list(added)
+    for dependency in unchanged:
+        file_name = installed_mod_name(installed_mods, dependency)
+        if file_name is None or not os.path.lexists(str(mods_path / file_name)):
+            to_fetch.append(dependency)  # Went missing from mods/, put it back.
+        else:
+            installed_mods[mod_cache_key(dependency['projectID'], dependency['fileID'])] = file_name
+    return [to_fetch, installed_mods]
+
+
+def failed_downloads(dependencies, installed_mods):
+    """
+    :param installed_mods: fetch_dependencies result for dependencies.
+    :return: the dependencies that were not installed although their source has them, e.g. after a connection error.
+    """
+    return [dependency for dependency in dependencies
+            if mod_cache_key(dependency['projectID'], dependency['fileID']) not in installed_mods and
+            not known_missing_file(dependency)]
+
+
+def failed_downloads_message(failed):
+    return "{0} mods failed to download, run it again to retry them.".format(len(failed))
+
+
+def record_failed_downloads(instance_dir, failed):
+    """
+    Lists the files that failed to download with their download links in the instance's MOD_ERRORS_LOG_FILE,
+    for the user to inspect or fetch by hand. The log of an earlier run is removed once nothing failed.
+    """
+    log_path = os.path.join(instance_dir, MOD_ERRORS_LOG_FILE)
+    if not failed:
+        if os.path.exists(log_path):
+            os.remove(log_path)
+        return
+    lines = [mod_cache_key(dependency['projectID'], dependency['fileID']) + " " + mod_download_url(dependency)
+             for dependency in failed]
+    print("\n!! WARNING !!\nThe following mod downloads failed.")
+    for line in lines:
+        print("- " + line)
+    with open(log_path, 'w') as log_file:
+        log_file.write("\n".join(lines) + "\n")
+    print("See " + log_path + " for the list.\n!! WARNING !!\n")
+
+
+def finish_mods_phase(failed):
+    """ Last progress event of download_mods and update_mods, PHASE.failed if any file failed to download. """
+    if failed:
+        emit_progress(EVENT.phase, PHASE.failed, message=failed_downloads_message(failed))
+    else:
+        emit_progress(EVENT.phase, PHASE.done)
+
+
+@measured_run("download_mods")
+def download_mods(instance_dir, max_workers=None, max_per_host=None, install_type=None):
+    """
+    Downloads every dependency in the instance manifest, several at a time.
+    :param instance_dir: The minecraft directory that contains the curse manifest.json file.
+    :param max_workers: see fetch_dependencies.
+    :param max_per_host: see fetch_dependencies.
+    :param install_type: see instance_game_dir.
+    :return: list of the manifest 'files' entries that failed to download, empty on success.
+        None if the manifest is not usable.
+    """
+    InstanceInfo.is_done = False
+    InstanceInfo().reset_dl()
+    manifest_json, mods_path = prepare_mod_install(instance_dir, install_type)
+    if manifest_json is None:
+        InstanceInfo.is_done = True
+        emit_progress(EVENT.phase, PHASE.failed, message="Instance manifest.json is not usable.")
+        return None
+
+    # Catch any threaded exceptions, mark the thread as finished and the re-raise the exception.
+    # this allows calling thread to detect the thread has finished processing and can continue doing "stuff".
+    try:
+        emit_progress(EVENT.phase, PHASE.mods, total=len(manifest_json['files']))
+        installed_mods = fetch_dependencies(manifest_json['files'], mods_path, max_workers, max_per_host)
+        save_installed_state(instance_dir, installed_mods)
+        failed = failed_downloads(manifest_json['files'], installed_mods)
+        record_failed_downloads(instance_dir, failed)
+    except BaseException as e:
+        InstanceInfo.is_done = True
+        emit_progress(EVENT.phase, PHASE.failed, message=str(e) or type(e).__name__)
+        raise e
     log.info("Finished Processing All Mods Listed In Manifest.")
-    print("Unpacking Complete")
-    req_sess.close()
+    enforce_cache_budget()
     InstanceInfo.is_done = True  # End of thread workload.
+    finish_mods_phase(failed)
+    return failed
+
+
+@measured_run("update_mods")
+def update_mods(instance_dir, max_workers=None, max_per_host=None, install_type=None):
+    """
+    Brings the instance mods in line with a new manifest.json, only touching the mods that changed.
+    The manifest of the previous install is read from pdm_instance/manifest.json,
+    without it this is the same as download_mods.
+    :param instance_dir: The minecraft directory that contains the new curse manifest.json file.
+    :param install_type: see instance_game_dir.
+    :return: same as download_mods.
+    """
+    old_manifest_path = os.path.join(instance_dir, PDM_INSTANCE_FOLDER, "manifest.json")
+    if not os.path.exists(old_manifest_path):
+        log.info("No previous manifest in " + PDM_INSTANCE_FOLDER + ", doing a full install.")
+        return download_mods(instance_dir, max_workers, max_per_host, install_type)
+
+    InstanceInfo.is_done = False
+    InstanceInfo().reset_dl()
+    manifest_json, mods_path = prepare_mod_install(instance_dir, install_type)
+    if manifest_json is None:
+        InstanceInfo.is_done = True
+        emit_progress(EVENT.phase, PHASE.failed, message="Instance manifest.json is not usable.")
+        return None
+
+    try:
+        to_fetch, installed_mods = plan_mod_update(instance_dir, manifest_json, mods_path)
+        emit_progress(EVENT.phase, PHASE.mods, total=len(to_fetch))
+        installed_mods.update(fetch_dependencies(to_fetch, mods_path, max_workers, max_per_host))
+        save_installed_state(instance_dir, installed_mods)
+        failed = failed_downloads(to_fetch, installed_mods)
+        record_failed_downloads(instance_dir, failed)
+    except BaseException as e:
+        InstanceInfo.is_done = True
+        emit_progress(EVENT.phase, PHASE.failed, message=str(e) or type(e).__name__)
+        raise e
+    log.info("Finished Updating Mods Listed In Manifest.")
+    enforce_cache_budget()
+    InstanceInfo.is_done = True
+    finish_mods_phase(failed)
+    return failed
 
 
 def initialize_program_environment():
     global installed_instances
+    init_logging()
     log.debug("Curse PDM: Checking/Initializing program environment")
     init_pdm_settings()
     create_dir_if_not_exist(MODPACK_ZIP_CACHE)
     create_dir_if_not_exist(MOD_CACHE)
+    migrate_mod_cache()
     if os.path.exists(INSTALLED_INSTANCE_FILE):
         installed_instances[:] = load_json_file(INSTALLED_INSTANCE_FILE)["instances"]
     else:
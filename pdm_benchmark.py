@@ -0,0 +1,563 @@
+import argparse
+import hashlib
+import io
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+import downloader_core as core
+
+'''
+Author(s): TOLoneWolf
+
+Offline benchmark of the downloader core.
+A local stand-in for curseforge and cursemeta serves a synthetic modpack, so download_mods,
+download_modpack_zip and the version list parser can be timed without the network.
+
+    python pdm_benchmark.py --mods 50 250 1000 --latency 0.05 --bandwidth 2000000
+    python pdm_benchmark.py --serve --mods 250   (only run the stand-in server)
+    python pdm_benchmark.py --startup 10   (only time cold starts of the modules and the CLI)
+'''
+
+PACK_NAME = 'bench-pack'
+PACK_PROJECT_ID = 900000
+PACK_FIRST_FILE_ID = 3000000
+MOD_FIRST_PROJECT_ID = 100000
+MOD_FIRST_FILE_ID = 2000000
+FILES_PER_PAGE = 25
+WRITE_CHUNK_SIZE = 16 * 1024
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+# Only imported by the core once networking is needed, a cold start that loads them got slower.
+LAZY_MODULES = ("requests", "urllib3", "aiohttp")
+STARTUP_SCENARIOS = [
+    ("interpreter", "pass"),
+    ("import_core", "import downloader_core"),
+    ("import_cli", "import curseforgePackDownloadManagerCLI"),
+    ("import_gui", "import curseforgePackDownloadManagerGUI"),
+    ("cli_check", "import runpy, sys\n"
+                  "sys.argv = ['curseforgePackDownloadManagerCLI.py', '--json', 'check']\n"
+                  "try:\n"
+                  "    runpy.run_path(%r, run_name='__main__')\n"
+                  "except SystemExit:\n"
+                  "    pass" % os.path.join(REPO_DIR, 'curseforgePackDownloadManagerCLI.py'))]
+
+
+class StandInConfig:
+    """
+    What the stand-in server serves and how badly it behaves.
+    The pack has mod_count mods and as many released versions, so every pack size also gives
+    the version list parser a matching number of rows.
+    """
+    def __init__(self, mod_count=50, mod_size=64 * 1024, latency=0.0, bandwidth=0, error_rate=0.0,
+                 missing_rate=0.0, seed=0):
+        """
+        :param mod_size: bytes of each mod file.
+        :param latency: seconds waited before answering any request.
+        :param bandwidth: bytes per second per response body, 0 = no limit.
+        :param error_rate: part of all requests answered with 503.
+        :param missing_rate: part of the mods whose curseforge download is 404, so cursemeta is asked instead.
+        """
+        self.mod_count = mod_count
+        self.version_count = mod_count
+        self.mod_size = mod_size
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.missing_rate = missing_rate
+        self.seed = seed
+
+    def newest_pack_file_id(self):
+        return PACK_FIRST_FILE_ID + self.version_count - 1
+
+    def page_count(self):
+        return max(1, (self.version_count + FILES_PER_PAGE - 1) // FILES_PER_PAGE)
+
+    def mod_is_missing(self, project_id):
+        """ Same answer every run for the same seed, the pick does not depend on request order. """
+        digest = hashlib.sha256("{0}:{1}".format(self.seed, project_id).encode('utf-8')).digest()
+        return int.from_bytes(digest[:4], 'big') / 2 ** 32 < self.missing_rate
+
+    def dependencies(self):
+        return [{"projectID": MOD_FIRST_PROJECT_ID + i, "fileID": MOD_FIRST_FILE_ID + i, "required": True}
+                for i in range(self.mod_count)]
+
+
+def mod_file_name(project_id, file_id):
+    return "bench-mod-{0}-{1}.jar".format(project_id, file_id)
+
+
+def pack_file_name(file_id):
+    return "{0}-{1}.zip".format(PACK_NAME, file_id)
+
+
+def mod_file_body(project_id, file_id, size):
+    """
+    A jar of about size bytes, different for every file so each one gets its own cache object.
+    Entries are stored with a fixed date so every request gets the same bytes.
+    """
+    block = hashlib.sha256("{0}/{1}".format(project_id, file_id).encode('utf-8')).digest()
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED) as jar_file:
+        jar_file.writestr(zipfile.ZipInfo("META-INF/MANIFEST.MF", (2018, 1, 1, 0, 0, 0)),
+                          "Manifest-Version: 1.0\n")
+        jar_file.writestr(zipfile.ZipInfo("bench/mod.bin", (2018, 1, 1, 0, 0, 0)),
+                          (block * (size // len(block) + 1))[:max(0, size - 256)])
+    return buffer.getvalue()
+
+
+def build_pack_zip(config, file_id):
+    manifest = {
+        "minecraft": {"version": "1.12.2", "modLoaders": [{"id": "forge-14.23.5.2768", "primary": True}]},
+        "manifestType": "minecraftModpack",
+        "manifestVersion": 1,
+        "name": "Bench Pack",
+        "version": str(file_id),
+        "author": "pdm_benchmark",
+        "files": config.dependencies(),
+        "overrides": "overrides"}
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr("manifest.json", json.dumps(manifest, indent=2))
+        zip_file.writestr("modlist.html", "<ul>" + "".join(
+            "<li>{0}</li>".format(mod_file_name(dep["projectID"], dep["fileID"])) for dep in manifest["files"]) +
+            "</ul>")
+        for index in range(max(1, config.mod_count // 5)):
+            zip_file.writestr("overrides/config/bench/mod{0}.cfg".format(index),
+                              "# bench config {0}\nenabled=true\n".format(index) * 20)
+    return buffer.getvalue()
+
+
+def version_row_html(file_id, base_url):
+    phase = ["release", "beta", "alpha"][file_id % 3]
+    return '''<tr class="project-file-list-item">
+<td class="project-file-release-type"><div class="{0}-phase tip" title="{1}"></div></td>
+<td class="project-file-name" data-name="Bench Pack {2}">
+<div class="project-file-name-container">
+<a class="button tip fa-icon-download icon-only" href="{3}/projects/{4}/files/{2}/download"></a>
+<a class="overflow-tip twitch-link" href="/projects/{4}/files/{2}" data-action="modpack-file-link"
+data-id="{5}" data-name="Bench Pack {2}">Bench Pack {2}</a>
+</div></td>
+<td class="project-file-size">1.2 MB</td>
+<td class="project-file-date-uploaded"><abbr class="tip standard-date" data-epoch="1500000000"></abbr></td>
+</tr>
+'''.format(phase, phase.title(), file_id, base_url, PACK_NAME, PACK_PROJECT_ID)
+
+
+def version_page_html(config, page, base_url):
+    """ One /projects/<name>/files page, newest file first, with a window of page links like the site. """
+    newest = config.newest_pack_file_id() - (page - 1) * FILES_PER_PAGE
+    oldest = max(PACK_FIRST_FILE_ID, newest - FILES_PER_PAGE + 1)
+    page_links = sorted(set(range(max(1, page - 2), min(config.page_count(), page + 2) + 1)) |
+                        {config.page_count()})
+    return ''.join([
+        '<!DOCTYPE html><html><head><meta charset="utf-8"><title>Bench Pack - Files</title></head><body>\n',
+        '<a class="e-avatar64 lightbox" href="{0}/icon.png"><img src="{0}/icon.png"></a>\n'.format(base_url),
+        '<ul class="breadcrumbs"><li><a href="/modpacks">Modpacks</a></li></ul>\n',
+        '<table class="listing project-file-listing"><tbody>\n',
+        ''.join(version_row_html(file_id, base_url) for file_id in range(newest, oldest - 1, -1)),
+        '</tbody></table>\n<div class="listing-header"><ul class="b-pagination-list">\n',
+        ''.join('<li><a href="/projects/{0}/files?page={1}">{1}</a></li>\n'.format(PACK_NAME, page_number)
+                for page_number in page_links),
+        '</ul></div>\n', '<p>' + 'Lorem ipsum dolor sit amet. ' * 200 + '</p>\n' '</body></html>\n'])
+
+
+class StandInRequestHandler(BaseHTTPRequestHandler):
+    """
+    Routes of the sites the core talks to:
+    /projects/<name or id>/files[?page=N]        file listing pages, with ETag / If-None-Match.
+    /projects/<project>/files/<file>/download    302 to /files/..., 404 for missing mods.
+    /files/<project>/<file>/<name>               file bodies, with Range / If-Range.
+    /cursemeta/<project>/<file>.json             cursemeta fallback.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        core.log.debug("stand-in: " + format % args)
+
+    def do_GET(self):
+        config = self.server.config
+        self.server.count_request()
+        if config.latency:
+            time.sleep(config.latency)
+        if config.error_rate and self.server.random() < config.error_rate:
+            return self.send_body(503, b'Service Unavailable', 'text/plain')
+
+        path = urlparse(self.path).path
+        match = re.match(r'^/(?:ftb/)?projects/([\w-]+)/files/?$', path)
+        if match:
+            return self.send_version_page(match.group(1))
+        match = re.match(r'^/(?:ftb/)?projects/([\w-]+)/files/(\d+)/download$', path)
+        if match:
+            return self.send_download_redirect(match.group(1), int(match.group(2)))
+        match = re.match(r'^/files/(\d+)/(\d+)/([^/]+)$', path)
+        if match:
+            return self.send_file(int(match.group(1)), int(match.group(2)))
+        match = re.match(r'^/cursemeta/(\d+)/(\d+)\.json$', path)
+        if match:
+            return self.send_cursemeta(int(match.group(1)), int(match.group(2)))
+        if path == '/icon.png':
+            return self.send_body(200, b'\x89PNG\r\n\x1a\n' + bytes(512), 'image/png')
+        self.send_body(404, b'Not Found', 'text/plain')
+
+    do_HEAD = do_GET
+
+    def send_version_page(self, project):
+        config = self.server.config
+        if project not in (PACK_NAME, str(PACK_PROJECT_ID)) or self.path.startswith('/ftb/'):
+            return self.send_body(404, b'Not Found', 'text/html')
+        page = min(int(parse_qs(urlparse(self.path).query).get('page', ['1'])[0]), config.page_count())
+        etag = '"{0}-{1}"'.format(config.newest_pack_file_id(), page)
+        if self.headers.get('If-None-Match') == etag:
+            return self.send_body(304, b'', 'text/html', {'ETag': etag})
+        body = version_page_html(config, page, self.server.base_url).encode('utf-8')
+        self.send_body(200, body, 'text/html; charset=utf-8', {'ETag': etag})
+
+    def send_download_redirect(self, project, file_id):
+        config = self.server.config
+        if project in (PACK_NAME, str(PACK_PROJECT_ID)):
+            if not PACK_FIRST_FILE_ID <= file_id <= config.newest_pack_file_id():
+                return self.send_body(404, b'Not Found', 'text/html')
+            location = "/files/{0}/{1}/{2}".format(PACK_PROJECT_ID, file_id, pack_file_name(file_id))
+        elif project.isdigit() and self.server.is_mod(int(project), file_id):
+            if config.mod_is_missing(int(project)):
+                return self.send_body(404, b'Not Found', 'text/html')
+            location = "/files/{0}/{1}/{2}".format(project, file_id, mod_file_name(project, file_id))
+        else:
+            return self.send_body(404, b'Not Found', 'text/html')
+        self.send_body(302, b'', 'text/html', {'Location': self.server.base_url + location})
+
+    def send_file(self, project_id, file_id):
+        if project_id == PACK_PROJECT_ID:
+            body = self.server.pack_zip(file_id)
+        elif self.server.is_mod(project_id, file_id):
+            body = mod_file_body(project_id, file_id, self.server.config.mod_size)
+        else:
+            return self.send_body(404, b'Not Found', 'text/plain')
+        etag = '"{0}-{1}-{2}"'.format(project_id, file_id, len(body))
+        range_header = self.headers.get('Range')
+        match = re.match(r'^bytes=(\d+)-$', range_header or '')
+        if match and self.headers.get('If-Range', etag) == etag and int(match.group(1)) < len(body):
+            start = int(match.group(1))
+            return self.send_body(206, body[start:], 'application/octet-stream', {
+                'ETag': etag, 'Content-Range': 'bytes {0}-{1}/{2}'.format(start, len(body) - 1, len(body))})
+        if match and int(match.group(1)) >= len(body):
+            return self.send_body(416, b'', 'text/plain', {'Content-Range': 'bytes */{0}'.format(len(body))})
+        self.send_body(200, body, 'application/octet-stream', {'ETag': etag, 'Accept-Ranges': 'bytes'})
+
+    def send_cursemeta(self, project_id, file_id):
+        if not self.server.is_mod(project_id, file_id):
+            return self.send_body(200, json.dumps({"code": "NotFound"}).encode('utf-8'), 'application/json')
+        file_name = mod_file_name(project_id, file_id)
+        self.send_body(200, json.dumps({
+            "DownloadURL": "{0}/files/{1}/{2}/{3}".format(self.server.base_url, project_id, file_id, file_name),
+            "FileNameOnDisk": file_name}).encode('utf-8'), 'application/json')
+
+    def send_body(self, status_code, body, content_type, headers=None):
+        self.send_response(status_code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command == 'HEAD':
+            return
+        bandwidth = self.server.config.bandwidth
+        try:
+            for start in range(0, len(body), WRITE_CHUNK_SIZE):
+                chunk = body[start:start + WRITE_CHUNK_SIZE]
+                self.wfile.write(chunk)
+                if bandwidth:
+                    time.sleep(len(chunk) / bandwidth)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True  # Client gave up, e.g. a cancelled download.
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, config, address=('127.0.0.1', 0)):
+        HTTPServer.__init__(self, address, StandInRequestHandler)
+        self.config = config
+        self.base_url = "http://{0}:{1}".format(*self.server_address[:2])
+        self.requests_served = 0
+        self._lock = threading.Lock()
+        self._random = random.Random(config.seed)
+        self._pack_zips = {}
+
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], (ConnectionError, TimeoutError)):
+            return  # Clients closing their pooled connections at exit.
+        HTTPServer.handle_error(self, request, client_address)
+
+    def count_request(self):
+        with self._lock:
+            self.requests_served += 1
+
+    def random(self):
+        with self._lock:
+            return self._random.random()
+
+    def is_mod(self, project_id, file_id):
+        index = project_id - MOD_FIRST_PROJECT_ID
+        return 0 <= index < self.config.mod_count and file_id == MOD_FIRST_FILE_ID + index
+
+    def pack_zip(self, file_id):
+        with self._lock:
+            if file_id not in self._pack_zips:
+                self._pack_zips[file_id] = build_pack_zip(self.config, file_id)
+            return self._pack_zips[file_id]
+
+
+def start_stand_in(config, port=0):
+    """
+    Serves config from a daemon thread.
+    :return: the server, call shutdown() on it when done. Its base_url replaces the site urls.
+    """
+    server = StandInServer(config, ('127.0.0.1', port))
+    threading.Thread(target=server.serve_forever, name="stand-in", daemon=True).start()
+    return server
+
+
+def point_core_at(base_url):
+    """ Sends every site url of the core to the stand-in server. """
+    core.CURSEFORGE_URL = base_url
+    core.FTB_URL = base_url + "/ftb"
+    core.CURSEMETA_URL = base_url + "/cursemeta"
+
+
+def time_version_parser(config, repeat=3):
+    """ Parses every listing page from memory, no server involved. """
+    pages = [version_page_html(config, page, 'http://stand-in').encode('utf-8')
+             for page in range(1, config.page_count() + 1)]
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        rows = 0
+        for page_number, page in enumerate(pages, 1):
+            parser = core.VersionPageParser(page_number == 1)
+            for start in range(0, len(page), WRITE_CHUNK_SIZE):
+                parser.feed_bytes(page[start:start + WRITE_CHUNK_SIZE])
+            parser.finish()
+            rows += len(parser.rows)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return {"seconds": round(best, 4), "pages": len(pages), "bytes": sum(len(page) for page in pages),
+            "rows": rows, "rows_per_second": int(rows / best) if best else 0}
+
+
+class ScenarioRunner:
+    """ Times core calls, collecting the run metrics file and the failed file events of each. """
+
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+        self.results = []
+        self.failures = []
+        core.subscribe_progress(self.on_progress_event)
+
+    def on_progress_event(self, event):
+        if event.kind == core.EVENT.file_failed:
+            self.failures.append(event.name + ": " + event.message)
+
+    def run(self, mod_count, scenario, function, *args, **kwargs):
+        del self.failures[:]
+        if os.path.exists(core.program_settings[core.KEY.metrics_file]):
+            os.remove(core.program_settings[core.KEY.metrics_file])
+        result = {"mods": mod_count, "scenario": scenario}
+        started = time.perf_counter()
+        try:
+            if self.verbose:
+                returned = function(*args, **kwargs)
+            else:
+                with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                    returned = function(*args, **kwargs)
+        except Exception as e:
+            returned = None
+            result["error"] = "{0}: {1}".format(type(e).__name__, e)
+        result["seconds"] = round(time.perf_counter() - started, 4)
+        if os.path.exists(core.program_settings[core.KEY.metrics_file]):
+            summary = core.load_json_file(core.program_settings[core.KEY.metrics_file])
+            result.update({
+                "files_downloaded": summary["files_downloaded"],
+                "bytes_downloaded": summary["bytes_downloaded"],
+                "bytes_per_second": summary["bytes_per_second"],
+                "ttfb_p50": summary["ttfb_seconds"]["p50"],
+                "ttfb_p95": summary["ttfb_seconds"]["p95"],
+                "cache_hits": summary["counters"]["cache_hits"],
+                "cursemeta_fallbacks": summary["counters"]["cursemeta_fallbacks"],
+                "new_connections": summary["http_connections"]["new_connections"],
+                "reused_connections": summary["http_connections"]["reused_connections"]})
+        result["failed_files"] = len(self.failures)
+        self.results.append(result)
+        return returned
+
+
+def benchmark_pack(runner, config, work_dir, backend):
+    """
+    Runs every scenario on one pack size in an empty program directory, cold first and then warm.
+    """
+    server = start_stand_in(config)
+    point_core_at(server.base_url)
+    previous_dir = os.getcwd()
+    core.close_cache_db()
+    os.chdir(work_dir)
+    try:
+        core.program_settings.clear()
+        core.program_settings.update(core.DEFAULT_PROGRAM_SETTINGS)
+        core.program_settings[core.KEY.http_backend] = backend
+        core.initialize_program_environment()
+        core.program_settings[core.KEY.metrics_file] = "pdm_metrics.json"  # Off by default, the scenarios read it.
+        mods = config.mod_count
+        file_id = str(config.newest_pack_file_id())
+
+        parse_result = dict({"mods": mods, "scenario": "version_parser"}, **time_version_parser(config))
+        runner.results.append(parse_result)
+        runner.run(mods, "version_list_cold", core.get_modpack_version_list, PACK_NAME)
+        runner.run(mods, "version_list_cached", core.get_modpack_version_list, PACK_NAME)
+        zip_path = runner.run(mods, "modpack_zip_cold", core.download_modpack_zip,
+                              'curseforge', PACK_PROJECT_ID, PACK_NAME, file_id)
+        runner.run(mods, "modpack_zip_cached", core.download_modpack_zip,
+                   'curseforge', PACK_PROJECT_ID, PACK_NAME, file_id)
+        if not zip_path:
+            return server.requests_served
+        for scenario in ("mods_cold", "mods_warm"):
+            instance_dir = os.path.join(work_dir, "instances", scenario)
+            core.extract_modpack_zip(zip_path, instance_dir, 'custom')
+            runner.run(mods, scenario, core.download_mods, instance_dir, install_type='custom')
+        return server.requests_served
+    finally:
+        core.close_cache_db()
+        os.chdir(previous_dir)
+        server.shutdown()
+        server.server_close()
+
+
+def time_startup(code, work_dir, repeat):
+    """
+    Runs code in a new interpreter repeat times, in work_dir so no settings or logs of a real install are read.
+    :return: best and median wall seconds and the LAZY_MODULES that got loaded.
+    """
+    probe = "\nimport sys as _sys\nprint('loaded: ' + ' '.join(m for m in %r if m in _sys.modules))" % (LAZY_MODULES,)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, os.environ.get('PYTHONPATH')])))
+    times = []
+    output = ''
+    for _ in range(repeat):
+        started = time.perf_counter()
+        completed = subprocess.run([sys.executable, "-c", code + probe], cwd=work_dir, env=env,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        times.append(time.perf_counter() - started)
+        output = completed.stdout
+        if completed.returncode:
+            return {"error": completed.stderr.strip().splitlines()[-1]}
+    times.sort()
+    loaded = [line[len('loaded: '):] for line in output.splitlines() if line.startswith('loaded: ')]
+    return {"seconds": round(times[len(times) // 2], 4), "best": round(times[0], 4),
+            "loaded": (loaded[-1] if loaded else '') or '-'}
+
+
+def benchmark_startup(repeat):
+    """
+    Times cold starts of the core, both front ends and a CLI check with no instances, see time_startup.
+    """
+    results = []
+    work_dir = tempfile.mkdtemp(prefix="pdm_benchmark_startup_")
+    try:
+        for scenario, code in STARTUP_SCENARIOS:
+            results.append(dict({"scenario": scenario}, **time_startup(code, work_dir, repeat)))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def print_startup_results(results):
+    columns = ["scenario", "seconds", "best", "loaded"]
+    print(" ".join("{0:>19}".format(column) for column in columns))
+    for result in results:
+        print(" ".join("{0:>19}".format(str(result.get(column, '-'))) for column in columns))
+        if "error" in result:
+            print("    error: " + result["error"])
+
+
+def print_results(results):
+    columns = ["mods", "scenario", "seconds", "files_downloaded", "bytes_per_second", "ttfb_p50", "ttfb_p95",
+               "cache_hits", "new_connections", "reused_connections", "failed_files"]
+    print(" ".join("{0:>19}".format(column) for column in columns))
+    for result in results:
+        print(" ".join("{0:>19}".format(str(result.get(column, '-'))) for column in columns))
+        if "error" in result:
+            print("    error: " + result["error"])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the downloader against a local stand-in server.")
+    parser.add_argument("--mods", type=int, nargs='+', default=[50, 250, 1000], help="pack sizes to run.")
+    parser.add_argument("--mod-size", type=int, default=64 * 1024, help="bytes of each mod file.")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request.")
+    parser.add_argument("--bandwidth", type=int, default=0, help="bytes per second per response, 0 = no limit.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="part of requests answered with 503.")
+    parser.add_argument("--missing-rate", type=float, default=0.0,
+                        help="part of mods only found through cursemeta.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--backend", choices=["requests", "asyncio"], default="requests")
+    parser.add_argument("--json", help="also write the results to this file.")
+    parser.add_argument("--keep", action="store_true", help="keep the work directories.")
+    parser.add_argument("--serve", action="store_true", help="only run the stand-in server for the first size.")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--startup", type=int, default=0, metavar="REPEAT",
+                        help="only time cold starts, each REPEAT times.")
+    parser.add_argument("--verbose", action="store_true", help="show the core output.")
+    options, unknown = parser.parse_known_args(argv)
+
+    if options.serve:
+        server = start_stand_in(StandInConfig(
+            options.mods[0], options.mod_size, options.latency, options.bandwidth, options.error_rate,
+            options.missing_rate, options.seed), options.port)
+        print("Serving {0} at {1}, Ctrl+C to stop.".format(PACK_NAME, server.base_url))
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            server.shutdown()
+        return 0
+
+    if options.startup:
+        results = benchmark_startup(options.startup)
+        print_startup_results(results)
+        if options.json:
+            core.save_json_file({"options": vars(options), "results": results}, options.json)
+        return 1 if any("error" in result for result in results) else 0
+
+    runner = ScenarioRunner(options.verbose)
+    for mod_count in options.mods:
+        config = StandInConfig(mod_count, options.mod_size, options.latency, options.bandwidth,
+                               options.error_rate, options.missing_rate, options.seed)
+        work_dir = tempfile.mkdtemp(prefix="pdm_benchmark_{0}_".format(mod_count))
+        try:
+            served = benchmark_pack(runner, config, work_dir, options.backend)
+            print("{0} mods: {1} requests served".format(mod_count, served), file=sys.stderr)
+        finally:
+            if options.keep:
+                print("Kept " + work_dir, file=sys.stderr)
+            else:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_results(runner.results)
+    if options.json:
+        core.save_json_file({"options": vars(options), "results": runner.results}, options.json)
+    return 1 if any("error" in result or result.get("failed_files") for result in runner.results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
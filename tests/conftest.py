@@ -0,0 +1,14 @@
+import os
+import sys
+
+import pytest
+
+# The modules sit at the top of the repository next to the front ends, there is no package to install.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def work_dir(tmp_path, monkeypatch):
+    """ Runs the test in an empty directory, the core keeps its cache and settings relative to it. """
+    monkeypatch.chdir(str(tmp_path))
+    return tmp_path
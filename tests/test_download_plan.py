@@ -0,0 +1,32 @@
+import downloader_core as core
+
+
+def dependency(project_id, file_id):
+    return {"projectID": project_id, "fileID": file_id, "required": True}
+
+
+def test_merge_keeps_first_listed_order():
+    plan = core.merge_download_plan([
+        [dependency(3, 30), dependency(1, 10)],
+        [dependency(2, 20), dependency(1, 10), dependency(3, 31)]])
+    assert [(entry['projectID'], entry['fileID']) for entry in plan] == [(3, 30), (1, 10), (2, 20), (3, 31)]
+
+
+def test_merge_counts_duplicates():
+    core.metrics_begin("test")
+    try:
+        core.merge_download_plan([[dependency(1, 10)], [dependency(1, 10)], [dependency(1, 10), dependency(2, 20)]])
+    finally:
+        summary = core.metrics_end()
+    assert summary["counters"]["plan_duplicates"] == 2
+
+
+def test_merge_matches_ids_of_either_type():
+    # Keys are compared as text, see mod_cache_key.
+    plan = core.merge_download_plan([[dependency(1, 10)], [dependency("1", "10")]])
+    assert len(plan) == 1
+
+
+def test_merge_nothing():
+    assert core.merge_download_plan([]) == []
+    assert core.merge_download_plan([[], []]) == []
@@ -0,0 +1,65 @@
+import os
+
+import downloader_core as core
+
+
+def manifest(*files):
+    return {"manifestType": "minecraftModpack", "manifestVersion": 1, "overrides": "overrides",
+            "files": [{"projectID": project_id, "fileID": file_id, "required": True}
+                      for project_id, file_id in files]}
+
+
+def keys(dependencies):
+    return [core.mod_cache_key(dependency['projectID'], dependency['fileID']) for dependency in dependencies]
+
+
+def install_instance(instance_dir, old_manifest, installed_files):
+    """ Leaves instance_dir as a previous install of old_manifest would, installed_files is key -> file name. """
+    mods_path = instance_dir / "minecraft" / "mods"
+    os.makedirs(str(mods_path))
+    for file_name in installed_files.values():
+        open(str(mods_path / file_name), 'wb').close()
+    core.save_json_file(old_manifest, str(instance_dir / "manifest.json"))
+    core.save_installed_state(str(instance_dir), installed_files)
+    return mods_path
+
+
+def test_diff_manifests():
+    old_manifest = manifest((1, 10), (2, 20), (3, 30))
+    new_manifest = manifest((1, 10), (2, 21), (4, 40))
+    added, removed, unchanged = core.diff_manifests(old_manifest, new_manifest)
+    assert keys(added) == ["2/21", "4/40"]
+    assert keys(removed) == ["2/20", "3/30"]
+    assert keys(unchanged) == ["1/10"]
+
+
+def test_diff_manifests_same_manifest():
+    added, removed, unchanged = core.diff_manifests(manifest((1, 10), (2, 20)), manifest((2, 20), (1, 10)))
+    assert added == [] and removed == []
+    assert keys(unchanged) == ["2/20", "1/10"]
+
+
+def test_plan_without_previous_install_fetches_everything(work_dir):
+    new_manifest = manifest((1, 10), (2, 20))
+    to_fetch, installed_mods = core.plan_mod_update(str(work_dir), new_manifest, work_dir / "mods")
+    assert keys(to_fetch) == ["1/10", "2/20"]
+    assert installed_mods == {}
+
+
+def test_plan_fetches_added_and_removes_dropped(work_dir):
+    installed_files = {"1/10": "a-1.jar", "2/20": "b-1.jar", "3/30": "c-1.jar"}
+    mods_path = install_instance(work_dir, manifest((1, 10), (2, 20), (3, 30)), installed_files)
+    to_fetch, installed_mods = core.plan_mod_update(
+        str(work_dir), manifest((1, 10), (2, 21), (4, 40)), mods_path)
+    assert keys(to_fetch) == ["2/21", "4/40"]
+    assert installed_mods == {"1/10": "a-1.jar"}
+    assert sorted(os.listdir(str(mods_path))) == ["a-1.jar"]
+
+
+def test_plan_fetches_unchanged_mod_missing_from_mods(work_dir):
+    installed_files = {"1/10": "a-1.jar", "2/20": "b-1.jar"}
+    mods_path = install_instance(work_dir, manifest((1, 10), (2, 20)), installed_files)
+    os.remove(str(mods_path / "b-1.jar"))
+    to_fetch, installed_mods = core.plan_mod_update(str(work_dir), manifest((1, 10), (2, 20)), mods_path)
+    assert keys(to_fetch) == ["2/20"]
+    assert installed_mods["1/10"] == "a-1.jar"
@@ -0,0 +1,93 @@
+import os
+
+import downloader_core as core
+
+URL = "http://stand-in/files/100000/2000000/bench-mod.jar"
+
+
+def write_part(part_path, size, **sidecar):
+    with open(part_path, 'wb') as part_file:
+        part_file.write(b'x' * size)
+    if sidecar:
+        core.save_json_file(dict({"url": URL, "etag": "", "last_modified": "", "length": 0}, **sidecar),
+                            core.part_sidecar_path(part_path))
+
+
+def test_resume_without_part_asks_for_whole_file(work_dir):
+    offset, headers = core.resume_request_headers(str(work_dir / "mod.jar.part"), URL)
+    assert offset == 0
+    assert headers == core.FILE_DOWNLOAD_HEADERS
+
+
+def test_resume_without_sidecar_starts_over(work_dir):
+    part_path = str(work_dir / "mod.jar.part")
+    write_part(part_path, 100)
+    assert core.resume_request_headers(part_path, URL) == [0, core.FILE_DOWNLOAD_HEADERS]
+
+
+def test_resume_asks_for_missing_bytes_of_same_file(work_dir):
+    part_path = str(work_dir / "mod.jar.part")
+    write_part(part_path, 100, etag='"abc"', length=300)
+    offset, headers = core.resume_request_headers(part_path, URL)
+    assert offset == 100
+    assert headers['Range'] == 'bytes=100-'
+    assert headers['If-Range'] == '"abc"'
+    assert headers['Accept-Encoding'] == 'identity'
+
+
+def test_resume_falls_back_to_last_modified(work_dir):
+    part_path = str(work_dir / "mod.jar.part")
+    write_part(part_path, 100, last_modified="Sat, 01 Jul 2017 00:00:00 GMT")
+    assert core.resume_request_headers(part_path, URL)[1]['If-Range'] == "Sat, 01 Jul 2017 00:00:00 GMT"
+
+
+def test_resume_ignores_part_of_other_url_or_complete_part(work_dir):
+    part_path = str(work_dir / "mod.jar.part")
+    write_part(part_path, 100, url=URL + "?moved")
+    assert core.resume_request_headers(part_path, URL)[0] == 0
+    write_part(part_path, 300, length=300)
+    assert core.resume_request_headers(part_path, URL)[0] == 0
+
+
+def test_resume_ignores_broken_sidecar(work_dir):
+    part_path = str(work_dir / "mod.jar.part")
+    write_part(part_path, 100)
+    with open(core.part_sidecar_path(part_path), 'w') as sidecar:
+        sidecar.write("{not json")
+    assert core.resume_request_headers(part_path, URL)[0] == 0
+
+
+def test_begin_new_download_records_sidecar(work_dir):
+    part_path = str(work_dir / "mod.jar.part")
+    headers = {'content-length': '300', 'etag': '"abc"'}
+    assert core.begin_part_download(part_path, URL, 200, headers, 0) == ['wb', 0, 300]
+    sidecar = core.load_json_file(core.part_sidecar_path(part_path))
+    assert sidecar["url"] == URL
+    assert sidecar["etag"] == '"abc"'
+    assert sidecar["length"] == 300
+
+
+def test_begin_continues_matching_partial_content(work_dir):
+    part_path = str(work_dir / "mod.jar.part")
+    headers = {'content-length': '200', 'content-range': 'bytes 100-299/300'}
+    assert core.begin_part_download(part_path, URL, 206, headers, 100) == ['ab', 100, 300]
+
+
+def test_begin_starts_over_when_server_sends_whole_file(work_dir):
+    # If-Range did not match, the file changed since the part was started.
+    part_path = str(work_dir / "mod.jar.part")
+    assert core.begin_part_download(part_path, URL, 200, {'content-length': '300'}, 100) == ['wb', 0, 300]
+
+
+def test_begin_starts_over_on_wrong_range(work_dir):
+    part_path = str(work_dir / "mod.jar.part")
+    headers = {'content-length': '250', 'content-range': 'bytes 50-299/300'}
+    assert core.begin_part_download(part_path, URL, 206, headers, 100) == ['wb', 0, 250]
+
+
+def test_begin_encoded_body_is_not_resumable(work_dir):
+    part_path = str(work_dir / "mod.jar.part")
+    write_part(part_path, 100, length=300)
+    headers = {'content-encoding': 'gzip', 'content-length': '80'}
+    assert core.begin_part_download(part_path, URL, 200, headers, 0) == ['wb', 0, 0]
+    assert not os.path.exists(core.part_sidecar_path(part_path))
@@ -0,0 +1,64 @@
+import downloader_core as core
+import pdm_benchmark as bench
+
+BASE_URL = "http://stand-in"
+
+
+def parse(html, chunk_size=None, **parser_options):
+    parser = core.VersionPageParser(**parser_options)
+    body = html.encode('utf-8')
+    chunk_size = chunk_size or len(body)
+    for start in range(0, len(body), chunk_size):
+        parser.feed_bytes(body[start:start + chunk_size])
+        if parser.reached_known_file:
+            break
+    parser.finish()
+    return parser
+
+
+def expected_rows(config, page):
+    newest = config.newest_pack_file_id() - (page - 1) * bench.FILES_PER_PAGE
+    oldest = max(bench.PACK_FIRST_FILE_ID, newest - bench.FILES_PER_PAGE + 1)
+    return [[file_id % 3 + 1, str(file_id), "Bench Pack {0}".format(file_id)]
+            for file_id in range(newest, oldest - 1, -1)]
+
+
+def test_first_page():
+    config = bench.StandInConfig(mod_count=60)
+    parser = parse(bench.version_page_html(config, 1, BASE_URL), first_page=True)
+    assert parser.is_modpack
+    assert parser.project_id == str(bench.PACK_PROJECT_ID)
+    assert parser.pack_icon_url == BASE_URL + "/icon.png"
+    assert parser.page_count == config.page_count() == 3
+    assert parser.rows == expected_rows(config, 1)
+    assert not parser.reached_known_file
+
+
+def test_sub_page_skips_first_page_details():
+    config = bench.StandInConfig(mod_count=60)
+    parser = parse(bench.version_page_html(config, 2, BASE_URL))
+    assert parser.pack_icon_url == ''
+    assert parser.rows == expected_rows(config, 2)
+
+
+def test_rows_split_across_chunks():
+    # Chunks end inside tags, titles and multi byte characters alike, rows must come out the same.
+    config = bench.StandInConfig(mod_count=30)
+    html = bench.version_page_html(config, 1, BASE_URL).replace("Bench Pack", "Bänch Päck")
+    parser = parse(html, chunk_size=7, first_page=True)
+    assert [row[2] for row in parser.rows] == [row[2].replace("Bench Pack", "Bänch Päck")
+                                               for row in expected_rows(config, 1)]
+
+
+def test_stops_at_known_file():
+    config = bench.StandInConfig(mod_count=60)
+    known_file_id = config.newest_pack_file_id() - 4
+    parser = parse(bench.version_page_html(config, 1, BASE_URL), chunk_size=512,
+                   first_page=True, known_file_id=known_file_id)
+    assert parser.reached_known_file
+    assert parser.rows == expected_rows(config, 1)[:5]
+
+
+def test_page_without_modpack_link_is_not_a_modpack():
+    html = bench.version_page_html(bench.StandInConfig(mod_count=5), 1, BASE_URL).replace('href="/modpacks"', '')
+    assert not parse(html, first_page=True).is_modpack